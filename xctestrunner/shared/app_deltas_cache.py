@@ -0,0 +1,239 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The retention of Xcode's EmbeddedAppDeltas directories.
+
+When running test on iOS real device, xcodebuild saves the deltas of the
+installed apps under
+DARWIN_USER_CACHE_DIR/com.apple.DeveloperTools/All/Xcode/EmbeddedAppDeltas
+and uses them to install the same app incrementally next time. Instead of
+deleting the directories after each test, the cache keeps them under a total
+size budget and evicts the least recently used ones. The last use time of each
+directory is recorded in an index shared by all test runner processes of the
+user.
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from xctestrunner.shared import cache_util
+from xctestrunner.shared import file_lock_util
+from xctestrunner.shared import xcode_info_util
+
+
+_INDEX_DIR_NAME = 'app_deltas'
+_INDEX_FILE_NAME = 'index.json'
+# The directories are moved into the trash directory before being deleted, so
+# xcodebuild never sees a partially deleted directory.
+_TRASH_DIR_NAME = '.xctestrunner_trash'
+_DEFAULT_MAX_TOTAL_BYTES = 5 * 1024 * 1024 * 1024
+# The directories used recently may be used by other running tests. They are
+# not evicted even if the cache is over the budget.
+_MIN_RETENTION_SEC = 10 * 60
+
+_max_total_bytes = _DEFAULT_MAX_TOTAL_BYTES
+
+
+class EmbeddedAppDeltasCache(object):
+  """Keeps the EmbeddedAppDeltas directories under a size budget with LRU."""
+
+  def __init__(self, deltas_dir=None, max_total_bytes=None,
+               index_file_path=None):
+    """Initializes the EmbeddedAppDeltasCache object.
+
+    Args:
+      deltas_dir: string, the path of the EmbeddedAppDeltas directory. By
+          default, it is Xcode's EmbeddedAppDeltas directory.
+      max_total_bytes: int, the budget of the total size of the directories.
+          0 means the directories are deleted as soon as they are released. By
+          default, it is the value of SetMaxTotalBytes.
+      index_file_path: string, the path of the index file. By default, it is
+          under the test runner cache directory.
+    """
+    if not deltas_dir:
+      deltas_dir = xcode_info_util.GetXcodeEmbeddedAppDeltasDir()
+    self._deltas_dir = deltas_dir
+    self._max_total_bytes = (_max_total_bytes if max_total_bytes is None
+                             else max_total_bytes)
+    if not index_file_path:
+      index_file_path = os.path.join(
+          cache_util.GetCacheDir(_INDEX_DIR_NAME), _INDEX_FILE_NAME)
+    self._index_file_path = index_file_path
+    self._lock = file_lock_util.FileLock(index_file_path + '.lock')
+
+  def Touch(self, delta_dirs):
+    """Records the use of the directories.
+
+    Args:
+      delta_dirs: a list of string, the paths of the EmbeddedAppDeltas
+          directories used by a test.
+    """
+    if not delta_dirs:
+      return
+    now = time.time()
+    with self._lock:
+      index = self._ReadIndex()
+      for delta_dir in delta_dirs:
+        entry = index.setdefault(os.path.basename(delta_dir), {})
+        entry['last_used_time'] = now
+      self._WriteIndex(index)
+
+  def Release(self, delta_dirs, background=True):
+    """Records the use of the directories and evicts the cache if necessary.
+
+    Args:
+      delta_dirs: a list of string, the paths of the EmbeddedAppDeltas
+          directories used by a test.
+      background: bool, whether evicts the cache in a background thread.
+
+    Returns:
+      the eviction thread if background is True, otherwise None.
+    """
+    if not self._max_total_bytes:
+      # Keeps the behavior of deleting the directories after each test.
+      for delta_dir in delta_dirs:
+        self._Delete(delta_dir)
+      return None
+    self.Touch(delta_dirs)
+    if not background:
+      self.Evict()
+      return None
+    thread = threading.Thread(target=self._EvictSafely)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+  def Evict(self):
+    """Evicts the least recently used directories over the size budget.
+
+    Returns:
+      a list of string, the paths of the evicted directories.
+    """
+    self._EmptyTrash()
+    if not os.path.isdir(self._deltas_dir):
+      return []
+    with self._lock:
+      index = self._ReadIndex()
+      names = set(name for name in os.listdir(self._deltas_dir)
+                  if name != _TRASH_DIR_NAME and
+                  os.path.isdir(os.path.join(self._deltas_dir, name)))
+      for name in list(index):
+        if name not in names:
+          del index[name]
+      for name in names:
+        entry = index.setdefault(name, {})
+        path = os.path.join(self._deltas_dir, name)
+        if 'last_used_time' not in entry:
+          # The directory was not created by test runner.
+          entry['last_used_time'] = os.path.getmtime(path)
+        if entry.get('size_time', 0) < entry['last_used_time']:
+          entry['size'] = _GetDirSize(path)
+          entry['size_time'] = time.time()
+      total_bytes = sum(entry['size'] for entry in index.values())
+      evicted_dirs = []
+      now = time.time()
+      for name in sorted(index, key=lambda n: index[n]['last_used_time']):
+        if total_bytes <= self._max_total_bytes:
+          break
+        if now - index[name]['last_used_time'] < _MIN_RETENTION_SEC:
+          break
+        path = os.path.join(self._deltas_dir, name)
+        self._MoveToTrash(path)
+        total_bytes -= index[name]['size']
+        del index[name]
+        evicted_dirs.append(path)
+      self._WriteIndex(index)
+    if evicted_dirs:
+      logging.info('Evicted %d EmbeddedAppDeltas directories. The cache size '
+                   'is %d bytes now.', len(evicted_dirs), total_bytes)
+    self._EmptyTrash()
+    return evicted_dirs
+
+  def _EvictSafely(self):
+    """Evicts the cache and logs the error instead of raising it."""
+    try:
+      self.Evict()
+    except (IOError, OSError) as e:
+      logging.warning('Failed to evict the EmbeddedAppDeltas cache: %s', e)
+
+  def _Delete(self, delta_dir):
+    """Deletes the directory directly."""
+    if os.path.exists(delta_dir):
+      logging.info('Removing cache files directory: %s', delta_dir)
+      shutil.rmtree(delta_dir)
+
+  def _MoveToTrash(self, delta_dir):
+    """Moves the directory into the trash directory atomically."""
+    trash_dir = os.path.join(self._deltas_dir, _TRASH_DIR_NAME)
+    if not os.path.exists(trash_dir):
+      os.mkdir(trash_dir)
+    os.rename(delta_dir, os.path.join(
+        trash_dir, '%s.%s' % (os.path.basename(delta_dir), time.time())))
+
+  def _EmptyTrash(self):
+    """Deletes the directories in the trash directory."""
+    trash_dir = os.path.join(self._deltas_dir, _TRASH_DIR_NAME)
+    if os.path.isdir(trash_dir):
+      shutil.rmtree(trash_dir, ignore_errors=True)
+
+  def _ReadIndex(self):
+    """Reads the index. Should be called with the lock held."""
+    if not os.path.exists(self._index_file_path):
+      return {}
+    try:
+      with open(self._index_file_path) as index_file:
+        return json.load(index_file)
+    except ValueError as e:
+      logging.warning('Ignored the broken EmbeddedAppDeltas index %s: %s',
+                      self._index_file_path, e)
+      return {}
+
+  def _WriteIndex(self, index):
+    """Writes the index atomically. Should be called with the lock held."""
+    temp_file_path = self._index_file_path + '.tmp'
+    with open(temp_file_path, 'w') as index_file:
+      json.dump(index, index_file)
+    os.rename(temp_file_path, self._index_file_path)
+
+
+def SetMaxTotalBytes(max_total_bytes):
+  """Sets the default size budget of the EmbeddedAppDeltas cache.
+
+  Args:
+    max_total_bytes: int, the budget in bytes. 0 means the directories are
+        deleted after each test.
+  """
+  global _max_total_bytes
+  _max_total_bytes = max_total_bytes
+
+
+def GetMaxTotalBytes():
+  """Gets the default size budget of the EmbeddedAppDeltas cache."""
+  return _max_total_bytes
+
+
+def _GetDirSize(dir_path):
+  """Gets the total size of the files in the directory."""
+  total_size = 0
+  for root, _, files in os.walk(dir_path):
+    for file_name in files:
+      try:
+        total_size += os.lstat(os.path.join(root, file_name)).st_size
+      except OSError:
+        pass
+  return total_size
@@ -0,0 +1,244 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The incremental Merkle digest of the bundle directories.
+
+The digest of a file is the SHA-256 of its contents. The digest of a symlink is
+the SHA-256 of its target. The digest of a directory is the SHA-256 of the
+records of its children, sorted by name, and each record has the type, the
+mode, the name and the digest of the child. So the digest of the bundle
+changes with any relative path, mode, symlink target or file contents in it,
+but not with the modification times or the location of the bundle.
+
+The file digests of each bundle path are kept in a sidecar file under the test
+runner cache directory, keyed by the inode, size and modification time of the
+file. Only the files which are changed since the last digest are read again,
+so digesting an unchanged bundle only costs the lstat calls of its entries.
+The files are hashed on a pool of threads. hashlib releases the GIL while
+hashing, so the threads run in parallel.
+"""
+
+import hashlib
+import json
+import logging
+import multiprocessing
+from multiprocessing import pool as multiprocessing_pool
+import os
+import stat
+import tempfile
+import time
+
+from xctestrunner.shared import bundle_sync
+from xctestrunner.shared import cache_util
+from xctestrunner.shared import ios_errors
+from xctestrunner.shared import metrics_util
+from xctestrunner.shared import trace_util
+
+
+_CACHE_DIR_NAME = 'bundle_digests'
+_HASH_CHUNK_BYTES = 1024 * 1024
+_MAX_WORKERS = 8
+# The file which is modified within the window after it is hashed may keep the
+# same modification time, so its digest is not kept in the sidecar file.
+_RACY_WINDOW_SEC = 2
+# The sidecar files which are not used longer than the retention are deleted
+# when a sidecar file is written.
+_RETENTION_SEC = 30 * 24 * 3600
+
+
+def ComputeBundleDigest(bundle_path, cache_dir=None, max_workers=None):
+  """Computes the Merkle digest of the bundle directory.
+
+  Args:
+    bundle_path: string, the path of the bundle directory, e.g., the .app or
+        the .xctest. If it is a symlink, the directory which it points to is
+        digested.
+    cache_dir: string, the directory of the sidecar files. It is created if
+        it does not exist. By default, it is under the test runner cache
+        directory.
+    max_workers: int, the max number of the threads which hash the files. By
+        default, it is the number of CPUs, but at most 8.
+
+  Returns:
+    string, the hex SHA-256 digest of the bundle.
+
+  Raises:
+    ios_errors.BundleError: when the bundle is not a directory.
+  """
+  bundle_path = os.path.realpath(bundle_path)
+  if not os.path.isdir(bundle_path):
+    raise ios_errors.BundleError(
+        'The bundle %s is not a directory.' % bundle_path)
+  cache_dir = cache_dir or cache_util.GetCacheDir(_CACHE_DIR_NAME)
+  sidecar_file_path = os.path.join(
+      cache_dir, hashlib.sha256(bundle_path).hexdigest() + '.json')
+
+  with trace_util.Span('compute_bundle_digest', path=bundle_path) as span:
+    entries = bundle_sync.ListTree(bundle_path)
+    cached_files = _ReadSidecarFile(sidecar_file_path)
+    file_digests = {}
+    files_to_hash = []
+    for rel_path, entry_stat in entries.items():
+      if not stat.S_ISREG(entry_stat.st_mode):
+        continue
+      cached_file = cached_files.get(rel_path)
+      if cached_file and cached_file[:3] == _GetFileKey(entry_stat):
+        file_digests[rel_path] = cached_file[3]
+      else:
+        files_to_hash.append(rel_path)
+
+    if files_to_hash:
+      if not max_workers:
+        max_workers = min(multiprocessing.cpu_count(), _MAX_WORKERS)
+      # A large file hashed last would keep one worker busy after the others
+      # are idle, so the files are hashed in the descending order of size.
+      files_to_hash.sort(key=lambda p: entries[p].st_size, reverse=True)
+      file_paths = [os.path.join(bundle_path, p) for p in files_to_hash]
+      if max_workers > 1 and len(file_paths) > 1:
+        worker_pool = multiprocessing_pool.ThreadPool(
+            min(max_workers, len(file_paths)))
+        try:
+          digests = worker_pool.map(_HashFile, file_paths)
+        finally:
+          worker_pool.close()
+          worker_pool.join()
+      else:
+        digests = [_HashFile(file_path) for file_path in file_paths]
+      file_digests.update(zip(files_to_hash, digests))
+
+    children = {}
+    for rel_path in entries:
+      parent_rel_dir, name = os.path.split(rel_path)
+      children.setdefault(parent_rel_dir, []).append(name)
+    bundle_digest = _ComputeDirDigest(bundle_path, '', entries, children,
+                                      file_digests)
+    span.SetArg('hashed_files', len(files_to_hash))
+
+  metrics_util.IncrementCounter('bundle_digest_hashed_files_total',
+                                len(files_to_hash))
+  if files_to_hash or len(cached_files) != len(file_digests):
+    racy_time = time.time() - _RACY_WINDOW_SEC
+    _WriteSidecarFile(sidecar_file_path, dict(
+        (rel_path, _GetFileKey(entries[rel_path]) + [digest])
+        for rel_path, digest in file_digests.items()
+        if entries[rel_path].st_mtime < racy_time))
+    _DeleteExpiredSidecarFiles(cache_dir)
+  else:
+    # The modification time of the sidecar file is its last use time.
+    try:
+      os.utime(sidecar_file_path, None)
+    except OSError:
+      pass
+  logging.debug('The digest of the bundle %s is %s. Hashed %d files.',
+                bundle_path, bundle_digest, len(files_to_hash))
+  return bundle_digest
+
+
+def _GetFileKey(file_stat):
+  """Gets the key of the file digest in the sidecar file."""
+  return [file_stat.st_ino, file_stat.st_size, file_stat.st_mtime]
+
+
+def _HashFile(file_path):
+  """Gets the hex SHA-256 digest of the file contents."""
+  sha256 = hashlib.sha256()
+  with open(file_path, 'rb') as hashed_file:
+    for chunk in iter(lambda: hashed_file.read(_HASH_CHUNK_BYTES), ''):
+      sha256.update(chunk)
+  return sha256.hexdigest()
+
+
+def _ComputeDirDigest(root_dir, rel_dir, entries, children, file_digests):
+  """Computes the digest of the directory from the records of its children."""
+  sha256 = hashlib.sha256()
+  for name in sorted(children.get(rel_dir, [])):
+    rel_path = os.path.join(rel_dir, name)
+    mode = entries[rel_path].st_mode
+    if stat.S_ISDIR(mode):
+      entry_type = 'dir'
+      digest = _ComputeDirDigest(root_dir, rel_path, entries, children,
+                                 file_digests)
+    elif stat.S_ISLNK(mode):
+      entry_type = 'link'
+      # The mode of a symlink depends on the umask on macOS and is not used.
+      mode = 0
+      digest = hashlib.sha256(
+          os.readlink(os.path.join(root_dir, rel_path))).hexdigest()
+    elif stat.S_ISREG(mode):
+      entry_type = 'file'
+      digest = file_digests[rel_path]
+    else:
+      continue
+    sha256.update('%s %o %s\0%s\n' % (entry_type, stat.S_IMODE(mode), name,
+                                      digest))
+  return sha256.hexdigest()
+
+
+def _ReadSidecarFile(sidecar_file_path):
+  """Reads the file digests of the bundle kept by the last digest."""
+  if not os.path.exists(sidecar_file_path):
+    return {}
+  try:
+    with open(sidecar_file_path) as sidecar_file:
+      cached_files = json.load(sidecar_file)
+    # The paths are the UTF-8 encoded strings from os.walk.
+    return dict(
+        (rel_path.encode('utf-8'), cached_file[:3] + [str(cached_file[3])])
+        for rel_path, cached_file in cached_files.items())
+  except (IOError, ValueError) as e:
+    logging.warning('Ignored the broken bundle digest cache %s: %s',
+                    sidecar_file_path, e)
+    return {}
+
+
+def _WriteSidecarFile(sidecar_file_path, cached_files):
+  """Writes the file digests of the bundle atomically.
+
+  The errors are logged instead of being raised, so the cache never fails the
+  digest.
+  """
+  try:
+    cache_dir = os.path.dirname(sidecar_file_path)
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    fd, temp_file_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'w') as temp_file:
+        json.dump(cached_files, temp_file)
+      os.rename(temp_file_path, sidecar_file_path)
+    finally:
+      if os.path.exists(temp_file_path):
+        os.remove(temp_file_path)
+  except (IOError, OSError) as e:
+    logging.warning('Failed to write the bundle digest cache %s: %s',
+                    sidecar_file_path, e)
+
+
+def _DeleteExpiredSidecarFiles(cache_dir):
+  """Deletes the sidecar files which are not used longer than the retention."""
+  expire_time = time.time() - _RETENTION_SEC
+  try:
+    names = os.listdir(cache_dir)
+  except OSError as e:
+    logging.warning('Failed to list the bundle digest cache %s: %s',
+                    cache_dir, e)
+    return
+  for name in names:
+    path = os.path.join(cache_dir, name)
+    try:
+      if os.path.getmtime(path) < expire_time:
+        os.remove(path)
+    except OSError:
+      # Another process may delete the file at the same time.
+      pass
@@ -0,0 +1,249 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The host-local content-addressed store of the extracted bundle archives.
+
+The same .ipa/.zip archives are often tested many times on a host, e.g., the
+retries, the shards and the device matrix of a CI build. The store extracts
+each archive once into a directory named by the SHA-256 digest of the archive
+and stages the extracted files into the work directory of each test run with
+staging_util, so the later runs of the same archive skip decompression.
+
+The digest of an archive is remembered by its path, inode, size and
+modification time, so an unchanged archive is not read again either.
+
+The store is shared by all test runner processes of the user. Each entry is
+protected by a file lock while it is extracted or staged. The least recently
+used entries are evicted when the total size is over the budget.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from xctestrunner.shared import cache_util
+from xctestrunner.shared import file_lock_util
+from xctestrunner.shared import metrics_util
+from xctestrunner.shared import staging_util
+from xctestrunner.shared import trace_util
+
+
+_STORE_DIR_NAME = 'bundle_store'
+_INDEX_FILE_NAME = 'index.json'
+_EXTRACTING_DIR_PREFIX = '.extracting'
+_DEFAULT_MAX_TOTAL_BYTES = 10 * 1024 * 1024 * 1024
+# The entries used recently may be staged by other running tests. They are not
+# evicted even if the store is over the budget.
+_MIN_RETENTION_SEC = 10 * 60
+_HASH_CHUNK_BYTES = 1024 * 1024
+
+_max_total_bytes = _DEFAULT_MAX_TOTAL_BYTES
+
+
+class BundleStore(object):
+  """Keeps the extracted archives by digest under a size budget with LRU."""
+
+  def __init__(self, store_dir=None, max_total_bytes=None):
+    """Initializes the BundleStore object.
+
+    Args:
+      store_dir: string, the directory of the store. By default, it is under
+          the test runner cache directory.
+      max_total_bytes: int, the budget of the total size of the extracted
+          archives. By default, it is the value of SetMaxTotalBytes.
+    """
+    self._store_dir = store_dir or cache_util.GetCacheDir(_STORE_DIR_NAME)
+    self._max_total_bytes = (_max_total_bytes if max_total_bytes is None
+                             else max_total_bytes)
+    self._index_file_path = os.path.join(self._store_dir, _INDEX_FILE_NAME)
+    self._index_lock = file_lock_util.FileLock(self._index_file_path + '.lock')
+
+  def StageExtractedArchive(self, archive_path, target_dir, extract_archive,
+                            variant=None, mutable=False):
+    """Stages the extracted files of the archive into the target directory.
+
+    The archive is extracted into the store first if it is not there.
+
+    Args:
+      archive_path: string, the path of the .ipa/.zip archive.
+      target_dir: string, the existing directory to stage the extracted files
+          into.
+      extract_archive: function, called with the archive path and an empty
+          directory to extract the archive into.
+      variant: string, distinguishes the extractions of the same archive which
+          extract different entries, e.g., the entry name prefixes.
+      mutable: bool, whether the staged files may be modified in place. See
+          staging_util.StageTree.
+    """
+    digest = self._GetArchiveDigest(archive_path)
+    if variant:
+      digest = hashlib.sha256('%s:%s' % (digest, variant)).hexdigest()
+    entry_dir = os.path.join(self._store_dir, digest)
+    with file_lock_util.FileLock(entry_dir + '.lock'):
+      if os.path.isdir(entry_dir):
+        logging.info('Found the extracted archive %s in the bundle store.',
+                     archive_path)
+        metrics_util.IncrementCounter('bundle_store_total', result='hit')
+        entry_size = None
+      else:
+        metrics_util.IncrementCounter('bundle_store_total', result='miss')
+        with trace_util.Span('extract_archive', path=archive_path):
+          extracting_dir = tempfile.mkdtemp(
+              dir=self._store_dir, prefix=_EXTRACTING_DIR_PREFIX)
+          try:
+            extract_archive(archive_path, extracting_dir)
+            os.rename(extracting_dir, entry_dir)
+          finally:
+            if os.path.exists(extracting_dir):
+              shutil.rmtree(extracting_dir, ignore_errors=True)
+        entry_size = _GetDirSize(entry_dir)
+      for name in os.listdir(entry_dir):
+        src_path = os.path.join(entry_dir, name)
+        if os.path.isdir(src_path) and not os.path.islink(src_path):
+          staging_util.StageTree(src_path, os.path.join(target_dir, name),
+                                 mutable=mutable)
+        else:
+          shutil.copy2(src_path, os.path.join(target_dir, name))
+      self._TouchEntry(digest, entry_size)
+    try:
+      self.Evict()
+    except (IOError, OSError) as e:
+      logging.warning('Failed to evict the bundle store: %s', e)
+
+  def Evict(self):
+    """Evicts the least recently used entries over the size budget.
+
+    Returns:
+      a list of string, the digests of the evicted entries.
+    """
+    evicted_digests = []
+    with self._index_lock:
+      index = self._ReadIndex()
+      entries = index['entries']
+      for digest in list(entries):
+        if not os.path.isdir(os.path.join(self._store_dir, digest)):
+          del entries[digest]
+      total_bytes = sum(entry['size'] for entry in entries.values())
+      now = time.time()
+      for digest in sorted(entries, key=lambda d: entries[d]['last_used_time']):
+        if total_bytes <= self._max_total_bytes:
+          break
+        if now - entries[digest]['last_used_time'] < _MIN_RETENTION_SEC:
+          break
+        entry_dir = os.path.join(self._store_dir, digest)
+        entry_lock = file_lock_util.FileLock(entry_dir + '.lock')
+        # The entry being staged by another test run is skipped.
+        if not entry_lock.Acquire(timeout_sec=0):
+          continue
+        try:
+          shutil.rmtree(entry_dir, ignore_errors=True)
+        finally:
+          entry_lock.Release()
+        total_bytes -= entries.pop(digest)['size']
+        evicted_digests.append(digest)
+      index['archives'] = dict(
+          (path, archive) for path, archive in index['archives'].items()
+          if archive['digest'] in entries)
+      self._WriteIndex(index)
+    if evicted_digests:
+      logging.info('Evicted %d extracted archives. The bundle store size is %d '
+                   'bytes now.', len(evicted_digests), total_bytes)
+    return evicted_digests
+
+  def _GetArchiveDigest(self, archive_path):
+    """Gets the SHA-256 digest of the archive, which is remembered by stat."""
+    archive_path = os.path.realpath(archive_path)
+    stat = os.stat(archive_path)
+    archive_key = {'inode': stat.st_ino, 'size': stat.st_size,
+                   'mtime': stat.st_mtime}
+    with self._index_lock:
+      archive = self._ReadIndex()['archives'].get(archive_path)
+    if archive and all(archive.get(key) == value
+                       for key, value in archive_key.items()):
+      return archive['digest']
+    with trace_util.Span('digest_archive', path=archive_path):
+      sha256 = hashlib.sha256()
+      with open(archive_path, 'rb') as archive_file:
+        for chunk in iter(lambda: archive_file.read(_HASH_CHUNK_BYTES), ''):
+          sha256.update(chunk)
+    archive_key['digest'] = sha256.hexdigest()
+    with self._index_lock:
+      index = self._ReadIndex()
+      index['archives'][archive_path] = archive_key
+      self._WriteIndex(index)
+    return archive_key['digest']
+
+  def _TouchEntry(self, digest, size=None):
+    """Records the use of the entry and its size if it is given."""
+    with self._index_lock:
+      index = self._ReadIndex()
+      entry = index['entries'].setdefault(digest, {})
+      entry['last_used_time'] = time.time()
+      if size is not None or 'size' not in entry:
+        entry['size'] = (size if size is not None else
+                         _GetDirSize(os.path.join(self._store_dir, digest)))
+      self._WriteIndex(index)
+
+  def _ReadIndex(self):
+    """Reads the index. Should be called with the index lock held."""
+    index = {}
+    if os.path.exists(self._index_file_path):
+      try:
+        with open(self._index_file_path) as index_file:
+          index = json.load(index_file)
+      except ValueError as e:
+        logging.warning('Ignored the broken bundle store index %s: %s',
+                        self._index_file_path, e)
+    index.setdefault('entries', {})
+    index.setdefault('archives', {})
+    return index
+
+  def _WriteIndex(self, index):
+    """Writes the index atomically. Should be called with the lock held."""
+    temp_file_path = self._index_file_path + '.tmp'
+    with open(temp_file_path, 'w') as index_file:
+      json.dump(index, index_file)
+    os.rename(temp_file_path, self._index_file_path)
+
+
+def SetMaxTotalBytes(max_total_bytes):
+  """Sets the default size budget of the bundle store.
+
+  Args:
+    max_total_bytes: int, the budget in bytes. 0 means the store is not used
+        and the archives are extracted into the work directory directly.
+  """
+  global _max_total_bytes
+  _max_total_bytes = max_total_bytes
+
+
+def GetMaxTotalBytes():
+  """Gets the default size budget of the bundle store."""
+  return _max_total_bytes
+
+
+def _GetDirSize(dir_path):
+  """Gets the total size of the files in the directory."""
+  total_size = 0
+  for root, _, files in os.walk(dir_path):
+    for file_name in files:
+      try:
+        total_size += os.lstat(os.path.join(root, file_name)).st_size
+      except OSError:
+        pass
+  return total_size
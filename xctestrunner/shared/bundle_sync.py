@@ -0,0 +1,192 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incrementally syncs a bundle directory into its previously synced copy.
+
+The successive builds of the same app usually change only a few binaries and
+assets. SyncTree only copies the files which are added or changed since the
+last sync and deletes the removed ones, so the cost scales with the diff
+instead of the bundle size.
+
+A file is unchanged if it has the same size and modification time as its
+copy. If only the modification time differs, e.g., the bundle is rebuilt or
+extracted again, the contents are compared and the equal file only gets the
+new modification time.
+
+The changed files are written to a temporary file and renamed over the copy.
+The copy gets a new inode, so the hard links which were staged from the old
+copy by staging_util are never modified.
+
+The relative symlinks which resolve inside the tree are synced as they are.
+The other symlinks are synced as absolute symlinks to their real targets, so
+they still resolve from the copy and staging_util copies their targets when
+the copy is staged.
+"""
+
+import filecmp
+import os
+import shutil
+import stat
+import tempfile
+
+from xctestrunner.shared import metrics_util
+from xctestrunner.shared import staging_util
+from xctestrunner.shared import trace_util
+
+
+# The float modification times may lose precision when they are copied.
+_MTIME_TOLERANCE_SEC = 0.001
+
+
+def SyncTree(src_dir, des_dir):
+  """Syncs the directory tree into the destination directory.
+
+  Args:
+    src_dir: string, the path of the source directory. If it is a symlink, the
+        directory which it points to is synced.
+    des_dir: string, the path of the destination directory. It is created if
+        it does not exist.
+
+  Returns:
+    a dict of the change summary, which contains:
+      added: a list of string, the relative paths of the added files.
+      modified: a list of string, the relative paths of the modified files.
+      removed: a list of string, the relative paths of the removed files.
+      unchanged_count: int, the number of the unchanged files.
+      copied_bytes: int, the number of bytes copied.
+    The directories are not counted. The symlinks are counted as files.
+  """
+  src_dir = os.path.realpath(src_dir)
+  changes = {'added': [], 'modified': [], 'removed': [],
+             'unchanged_count': 0, 'copied_bytes': 0}
+  with trace_util.Span('sync_tree', path=des_dir) as span:
+    if not os.path.isdir(des_dir) or os.path.islink(des_dir):
+      if os.path.lexists(des_dir):
+        os.remove(des_dir)
+      os.makedirs(des_dir)
+    src_entries = ListTree(src_dir)
+    des_entries = ListTree(des_dir)
+
+    # Deletes the removed entries and the entries whose types are changed. The
+    # children are deleted before their parents.
+    replaced_paths = set()
+    for rel_path in sorted(des_entries, reverse=True):
+      des_mode = des_entries[rel_path].st_mode
+      src_stat = src_entries.get(rel_path)
+      if src_stat and stat.S_IFMT(src_stat.st_mode) == stat.S_IFMT(des_mode):
+        continue
+      des_path = os.path.join(des_dir, rel_path)
+      if stat.S_ISDIR(des_mode):
+        os.rmdir(des_path)
+      else:
+        os.remove(des_path)
+        if src_stat:
+          replaced_paths.add(rel_path)
+        else:
+          changes['removed'].append(rel_path)
+      del des_entries[rel_path]
+
+    synced_dirs = [(src_dir, des_dir)]
+    for rel_path in sorted(src_entries):
+      src_path = os.path.join(src_dir, rel_path)
+      des_path = os.path.join(des_dir, rel_path)
+      src_stat = src_entries[rel_path]
+      des_stat = des_entries.get(rel_path)
+      if stat.S_ISDIR(src_stat.st_mode):
+        if not des_stat:
+          os.mkdir(des_path)
+        synced_dirs.append((src_path, des_path))
+        continue
+      if stat.S_ISLNK(src_stat.st_mode):
+        link_target = os.readlink(src_path)
+        if (os.path.exists(src_path) and
+            not staging_util.IsInternalSymlink(src_path, src_dir)):
+          link_target = os.path.realpath(src_path)
+        if des_stat and os.readlink(des_path) == link_target:
+          changes['unchanged_count'] += 1
+          continue
+        if des_stat:
+          os.remove(des_path)
+        os.symlink(link_target, des_path)
+      elif des_stat and _IsSameFile(src_path, src_stat, des_path, des_stat):
+        changes['unchanged_count'] += 1
+        continue
+      else:
+        _ReplaceFile(src_path, des_path)
+        changes['copied_bytes'] += src_stat.st_size
+      if des_stat or rel_path in replaced_paths:
+        changes['modified'].append(rel_path)
+      else:
+        changes['added'].append(rel_path)
+
+    # Sets the modes after the children are synced, in case of the read-only
+    # directories.
+    for src_path, des_path in reversed(synced_dirs):
+      shutil.copystat(src_path, des_path)
+
+    span.SetArg('changed_files',
+                len(changes['added']) + len(changes['modified']) +
+                len(changes['removed']))
+    span.SetArg('copied_bytes', changes['copied_bytes'])
+  metrics_util.IncrementCounter('synced_copied_bytes_total',
+                                changes['copied_bytes'])
+  return changes
+
+
+def ListTree(root_dir):
+  """Lists the entries of the directory tree without following the symlinks.
+
+  Args:
+    root_dir: string, the path of the root directory.
+
+  Returns:
+    a dict of the relative path to the os.lstat result of each entry. The root
+    directory itself is not included.
+  """
+  entries = {}
+  for root, dirs, files in os.walk(root_dir):
+    for name in dirs + files:
+      path = os.path.join(root, name)
+      entries[os.path.relpath(path, root_dir)] = os.lstat(path)
+  return entries
+
+
+def _IsSameFile(src_path, src_stat, des_path, des_stat):
+  """Checks whether the copy has the same contents and mode as the source.
+
+  If only the modification time differs, the contents are compared and the
+  modification time of the equal copy is updated.
+  """
+  if (src_stat.st_size != des_stat.st_size or
+      stat.S_IMODE(src_stat.st_mode) != stat.S_IMODE(des_stat.st_mode)):
+    return False
+  if abs(src_stat.st_mtime - des_stat.st_mtime) < _MTIME_TOLERANCE_SEC:
+    return True
+  if not filecmp.cmp(src_path, des_path, shallow=False):
+    return False
+  os.utime(des_path, (src_stat.st_atime, src_stat.st_mtime))
+  return True
+
+
+def _ReplaceFile(src_path, des_path):
+  """Copies the file to a temporary file and renames it to the destination."""
+  fd, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(des_path),
+                                        prefix='.sync')
+  os.close(fd)
+  try:
+    shutil.copy2(src_path, temp_file_path)
+    os.rename(temp_file_path, des_path)
+  finally:
+    if os.path.exists(temp_file_path):
+      os.remove(temp_file_path)
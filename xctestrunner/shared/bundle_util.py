@@ -19,18 +19,28 @@ import os
 import subprocess
 import tempfile
 
+from xctestrunner.shared import bundle_digest
+from xctestrunner.shared import bundle_store
 from xctestrunner.shared import ios_errors
 from xctestrunner.shared import plist_util
+from xctestrunner.shared import subprocess_ledger
+from xctestrunner.shared import trace_util
+from xctestrunner.shared import zip_util
 
 
-def ExtractApp(compressed_app_path, working_dir):
+def ExtractApp(compressed_app_path, working_dir, mutable=False):
   """Creates a temp directory and extracts compressed file of the app there.
 
+  If the bundle store is enabled, the archive is extracted into the store once
+  and staged into the temp directory.
+
   Args:
     compressed_app_path: string, full path of compressed file. The file
       extension name must end with .ipa.
     working_dir: string, the working directory where the extracted bundle
       places.
+    mutable: bool, whether the files of the extracted app may be modified in
+      place. See staging_util.StageTree.
 
   Returns:
     string, the path of extracted bundle, which is
@@ -43,14 +53,19 @@ def ExtractApp(compressed_app_path, working_dir):
   if not compressed_app_path.endswith('.ipa'):
     ios_errors.BundleError(
         'The extension of the compressed file should be .ipa.')
-  unzip_target_dir = tempfile.mkdtemp(dir=working_dir)
-  _UnzipWithShell(compressed_app_path, unzip_target_dir)
+  # Only the app under Payload is needed, e.g., not the SwiftSupport and
+  # Symbols directories.
+  unzip_target_dir = _ExtractArchive(
+      compressed_app_path, working_dir, prefixes=['Payload/'], mutable=mutable)
   return _ExtractBundleFile('%s/Payload' % unzip_target_dir, 'app')
 
 
 def ExtractTestBundle(compressed_test_path, working_dir):
   """Creates a temp directory and extracts compressed file of the test bundle.
 
+  If the bundle store is enabled, the archive is extracted into the store once
+  and staged into the temp directory.
+
   Args:
     compressed_test_path: string, full path of compressed file. The file
       extension name must end with .ipa/.zip.
@@ -69,14 +84,32 @@ def ExtractTestBundle(compressed_test_path, working_dir):
           compressed_test_path.endswith('.zip')):
     ios_errors.BundleError(
         'The extension of the compressed file should be .ipa/zip.')
-  unzip_target_dir = tempfile.mkdtemp(dir=working_dir)
-  _UnzipWithShell(compressed_test_path, unzip_target_dir)
+  unzip_target_dir = _ExtractArchive(compressed_test_path, working_dir)
   try:
     return _ExtractBundleFile(unzip_target_dir, 'xctest')
   except ios_errors.BundleError:
     return _ExtractBundleFile('%s/Payload' % unzip_target_dir, 'xctest')
 
 
+def ComputeBundleDigest(bundle_path):
+  """Computes the digest of the bundle, which identifies its contents.
+
+  The digest covers the relative paths, the modes, the symlink targets and the
+  file contents of the bundle. Only the files changed since the last digest of
+  the same bundle path are hashed again. See bundle_digest for details.
+
+  Args:
+    bundle_path: string, full path of bundle folder.
+
+  Returns:
+    string, the hex SHA-256 digest of the bundle.
+
+  Raises:
+    ios_errors.BundleError: when the bundle is not a directory.
+  """
+  return bundle_digest.ComputeBundleDigest(bundle_path)
+
+
 def GetMinimumOSVersion(bundle_path):
   """Gets the minimum OS version of the bundle deployment.
 
@@ -125,8 +158,8 @@ def GetCodesignIdentity(bundle_path):
       bundle.
   """
   command = ('codesign', '-dvv', bundle_path)
-  process = subprocess.Popen(command, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
+  process = subprocess_ledger.Popen(command, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
   output = process.communicate()[0]
   for line in output.split('\n'):
     if line.startswith('Authority='):
@@ -150,8 +183,8 @@ def GetDevelopmentTeam(bundle_path):
       bundle.
   """
   command = ('codesign', '-dvv', bundle_path)
-  process = subprocess.Popen(command, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
+  process = subprocess_ledger.Popen(command, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
   output = process.communicate()[0]
   for line in output.split('\n'):
     if line.startswith('TeamIdentifier='):
@@ -161,18 +194,21 @@ def GetDevelopmentTeam(bundle_path):
                                output)
 
 
-def CodesignBundle(bundle_path):
+def CodesignBundle(bundle_path, identity=None):
   """Codesigns the bundle.
 
   Args:
     bundle_path: string, full path of bundle folder.
+    identity: string, the codesign identity. '-' means ad-hoc signing. By
+      default, it is the identity which signs the bundle now.
 
   Raises:
     ios_errors.BundleError: when failed to codesign the bundle.
   """
-  identity = GetCodesignIdentity(bundle_path)
+  if not identity:
+    identity = GetCodesignIdentity(bundle_path)
   try:
-    subprocess.check_output(
+    subprocess_ledger.CheckOutput(
         ['codesign', '-f', '--preserve-metadata=identifier,entitlements',
          '--timestamp=none', '-s', identity, bundle_path])
   except subprocess.CalledProcessError as e:
@@ -221,15 +257,27 @@ def _ExtractBundleFile(target_dir, bundle_extension):
   return extracted_bundles[0]
 
 
-def _UnzipWithShell(src_file_path, des_file_path):
-  """Unzips the file in shell.
+def _ExtractArchive(compressed_file_path, working_dir, prefixes=None,
+                    mutable=False):
+  """Extracts the archive into a new temp directory under working directory.
 
   Args:
-    src_file_path: string, full path of the file to be unzipped.
-    des_file_path: string, full path of the extracted file.
+    compressed_file_path: string, full path of the .ipa/.zip file.
+    working_dir: string, the directory where the temp directory is created.
+    prefixes: a list of string, only extracts the entries whose names start
+      with one of the prefixes. By default, all entries are extracted.
+    mutable: bool, whether the extracted files may be modified in place.
+
+  Returns:
+    string, the path of the temp directory with the extracted files.
   """
-  # Python zipfile extractall method silently removes file permission bits.
-  # See https://bugs.python.org/issue15795. As workaround for now, use shell
-  # command unzip.
-  subprocess.check_call(['unzip', '-q', '-o',
-                         src_file_path, '-d', des_file_path])
+  unzip_target_dir = tempfile.mkdtemp(dir=working_dir)
+  extract_archive = lambda src, des: zip_util.ExtractZip(src, des, prefixes)
+  if bundle_store.GetMaxTotalBytes():
+    bundle_store.BundleStore().StageExtractedArchive(
+        compressed_file_path, unzip_target_dir, extract_archive,
+        variant=','.join(prefixes) if prefixes else None, mutable=mutable)
+  else:
+    with trace_util.Span('extract_archive', path=compressed_file_path):
+      extract_archive(compressed_file_path, unzip_target_dir)
+  return unzip_target_dir
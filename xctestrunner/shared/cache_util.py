@@ -0,0 +1,45 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Utility methods for the host-local cache directories of test runner."""
+
+import os
+import pwd
+
+
+_CACHE_ROOT_RELATIVE_DIR = 'Library/Caches/xctestrunner'
+
+
+def GetCacheDir(*sub_dirs):
+  """Gets the cache directory of test runner in current login user.
+
+  The directory is shared by all test runner processes of the user and will be
+  created if it does not exist.
+
+  Args:
+    *sub_dirs: strings, the sub directory names under the cache root directory.
+
+  Returns:
+    string, the path of the cache directory.
+  """
+  home_dir = pwd.getpwuid(os.geteuid()).pw_dir
+  path = os.path.join(home_dir, _CACHE_ROOT_RELATIVE_DIR, *sub_dirs)
+  if not os.path.exists(path):
+    try:
+      os.makedirs(path)
+    except OSError:
+      # Another process may create the directory at the same time.
+      if not os.path.isdir(path):
+        raise
+  return path
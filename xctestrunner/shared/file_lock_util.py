@@ -0,0 +1,97 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The file lock shared across processes in the host."""
+
+import errno
+import fcntl
+import os
+import time
+
+
+_LOCK_POLL_INTERVAL_SEC = 0.1
+
+
+class FileLock(object):
+  """The exclusive lock backed by flock(2) on a lock file.
+
+  The lock is released by the OS automatically when the process exits, so a
+  crashed process will not leave a stale lock.
+  """
+
+  def __init__(self, lock_file_path):
+    """Initializes the FileLock object.
+
+    Args:
+      lock_file_path: string, the path of the lock file. It will be created if
+          it does not exist.
+    """
+    self._lock_file_path = lock_file_path
+    self._lock_fd = None
+
+  def __enter__(self):
+    self.Acquire()
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.Release()
+
+  @property
+  def locked(self):
+    """Whether the lock is held by this object."""
+    return self._lock_fd is not None
+
+  def Acquire(self, timeout_sec=None):
+    """Acquires the lock.
+
+    Args:
+      timeout_sec: float, the max time to wait for the lock in seconds. If it is
+          None, waits until the lock is acquired. If it is 0, returns
+          immediately.
+
+    Returns:
+      True if the lock is acquired, False if it is timeout.
+    """
+    if self._lock_fd is not None:
+      return True
+    lock_fd = os.open(self._lock_file_path, os.O_RDWR | os.O_CREAT, 0o644)
+    if timeout_sec is None:
+      fcntl.flock(lock_fd, fcntl.LOCK_EX)
+      self._lock_fd = lock_fd
+      return True
+
+    deadline = time.time() + timeout_sec
+    while True:
+      try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._lock_fd = lock_fd
+        return True
+      except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+          os.close(lock_fd)
+          raise
+      if time.time() >= deadline:
+        os.close(lock_fd)
+        return False
+      time.sleep(_LOCK_POLL_INTERVAL_SEC)
+
+  def Release(self):
+    """Releases the lock if it is held."""
+    if self._lock_fd is None:
+      return
+    try:
+      fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+    finally:
+      os.close(self._lock_fd)
+      self._lock_fd = None
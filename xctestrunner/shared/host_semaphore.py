@@ -0,0 +1,131 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The counting semaphore shared by all test runner processes in the host.
+
+The semaphore limits the concurrent simulator create/boot operations and the
+concurrent test sessions of the host. A burst of concurrent simulator boots
+thrashes CoreSimulatorService and makes the boots fail, so queueing them makes
+the overall throughput higher. The limits are opt-in, because the simulator
+boot slot is held until the test starts, which includes the app install.
+
+Each semaphore has max_concurrency slots. Each slot is a lock file. A process
+holds the semaphore by holding the flock of any slot, so the slot is released by
+the OS if the process crashes.
+"""
+
+import logging
+import os
+import random
+import time
+
+from xctestrunner.shared import cache_util
+from xctestrunner.shared import file_lock_util
+
+
+SIM_BOOT = 'sim_boot'
+TEST_SESSION = 'test_session'
+
+_LOCKS_DIR_NAME = 'host_semaphores'
+_ACQUIRE_POLL_INTERVAL_SEC = 0.2
+_LOG_WAIT_TIME_THRESHOLD_SEC = 1
+# The max concurrency of each semaphore. 0 means unlimited.
+_max_concurrency = {
+    SIM_BOOT: 0,
+    TEST_SESSION: 0,
+}
+
+
+def SetMaxConcurrency(name, max_concurrency):
+  """Sets the max concurrency of the semaphore in this process.
+
+  Args:
+    name: string, the name of the semaphore, e.g., host_semaphore.SIM_BOOT.
+    max_concurrency: int, the max number of the holders in the host. 0 means
+        unlimited.
+  """
+  _max_concurrency[name] = max(0, int(max_concurrency))
+
+
+def GetMaxConcurrency(name):
+  """Gets the max concurrency of the semaphore. 0 means unlimited."""
+  return _max_concurrency.get(name, 0)
+
+
+class HostSemaphore(object):
+  """The counting semaphore shared across processes in the host."""
+
+  def __init__(self, name, max_concurrency=None):
+    """Initializes the HostSemaphore object.
+
+    Args:
+      name: string, the name of the semaphore, e.g., host_semaphore.SIM_BOOT.
+      max_concurrency: int, the max number of the holders in the host. If it is
+          not given, uses the value set by SetMaxConcurrency.
+    """
+    self._name = name
+    if max_concurrency is None:
+      max_concurrency = GetMaxConcurrency(name)
+    self._max_concurrency = max_concurrency
+    self._slot_lock = None
+    self._wait_time_sec = 0.0
+
+  def __enter__(self):
+    self.Acquire()
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.Release()
+
+  @property
+  def wait_time_sec(self):
+    """The time in seconds waited in queue by the last Acquire call."""
+    return self._wait_time_sec
+
+  def Acquire(self):
+    """Acquires a slot of the semaphore. Blocks until a slot is free.
+
+    Returns:
+      float, the time in seconds waited in queue.
+    """
+    if self._slot_lock or not self._max_concurrency:
+      return 0.0
+    locks_dir = cache_util.GetCacheDir(_LOCKS_DIR_NAME)
+    slot_locks = [
+        file_lock_util.FileLock(
+            os.path.join(locks_dir, '%s.%d.lock' % (self._name, i)))
+        for i in range(self._max_concurrency)]
+    # Starts from a random slot to spread the holders over the slots.
+    offset = random.randrange(self._max_concurrency)
+    slot_locks = slot_locks[offset:] + slot_locks[:offset]
+    start_time = time.time()
+    while not self._slot_lock:
+      for slot_lock in slot_locks:
+        if slot_lock.Acquire(timeout_sec=0):
+          self._slot_lock = slot_lock
+          break
+      else:
+        time.sleep(_ACQUIRE_POLL_INTERVAL_SEC)
+    self._wait_time_sec = time.time() - start_time
+    if self._wait_time_sec >= _LOG_WAIT_TIME_THRESHOLD_SEC:
+      logging.info('Waited %.1fs in queue for host semaphore %s (max '
+                   'concurrency %d).', self._wait_time_sec, self._name,
+                   self._max_concurrency)
+    return self._wait_time_sec
+
+  def Release(self):
+    """Releases the held slot of the semaphore."""
+    if self._slot_lock:
+      self._slot_lock.Release()
+      self._slot_lock = None
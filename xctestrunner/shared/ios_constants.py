@@ -24,10 +24,19 @@ OS = enum(IOS='iOS', WATCHOS='watchOS', TVOS='tvOS')
 TestType = enum(XCUITEST='xcuitest', XCTEST='xctest', LOGIC_TEST='logic_test')
 SimState = enum(CREATING='Creating', SHUTDOWN='Shutdown', BOOTED='Booted',
                 UNKNOWN='Unknown')
+ConsoleMode = enum(FULL='full', FAILURES_ONLY='failures_only',
+                   SUMMARY='summary')
+StagingStrategy = enum(AUTO='auto', CLONE='clone', HARDLINK='hardlink',
+                       SYMLINK='symlink', COPY='copy')
 
 SUPPORTED_SDKS = [SDK.IPHONESIMULATOR, SDK.IPHONEOS]
 SUPPORTED_TEST_TYPES = [TestType.XCUITEST, TestType.XCTEST, TestType.LOGIC_TEST]
 SUPPORTED_SIM_OSS = [OS.IOS]
+SUPPORTED_CONSOLE_MODES = [ConsoleMode.FULL, ConsoleMode.FAILURES_ONLY,
+                           ConsoleMode.SUMMARY]
+SUPPORTED_STAGING_STRATEGIES = [
+    StagingStrategy.AUTO, StagingStrategy.CLONE, StagingStrategy.HARDLINK,
+    StagingStrategy.SYMLINK, StagingStrategy.COPY]
 
 TEST_STARTED_SIGNAL = 'Test Suite'
 XCTRUNNER_STARTED_SIGNAL = 'Running tests...'
@@ -62,6 +71,11 @@ Available keys for the json:
     The specific test classes or test methods to skip. Each item should be
     string and its format is Test-Class-Name[/Test-Method-Name]. Logic test
     does not support that.
+  max_resumes: int
+    The max times of resuming the test after a test case is interrupted by the
+    crash of the app or a hang. The interrupted test case is marked failed and
+    the tests which have not run are relaunched on the same device. It is
+    supported in Xcode 8+. By default, it is 0.
   uitest_auto_screenshots: bool
     Whether captures screenshots automatically in ui test. If yes, will save the
     screenshots when the test failed. By default, it is false. Prior Xcode 9,
@@ -0,0 +1,233 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The counters and histograms of the test runs for fleet-level telemetry.
+
+The metrics are disabled by default. Every metric has the label xcode_version.
+When they are enabled, they can be exported in two ways:
+- Written to a file in Prometheus text exposition format, e.g., for the
+  textfile collector of node_exporter. The file is replaced atomically when the
+  metrics are flushed.
+- Sent to a StatsD server as UDP datagrams when they are recorded. The labels
+  are sent as DogStatsD tags.
+
+Example:
+  metrics_util.EnableMetrics(textfile_path='/var/lib/node_exporter/xt.prom')
+  metrics_util.IncrementCounter('test_sessions_total', sdk='iphonesimulator')
+  metrics_util.ObserveHistogram('test_startup_seconds', 12.3)
+  metrics_util.Flush()
+"""
+
+import logging
+import os
+import socket
+import subprocess
+import threading
+
+from xctestrunner.shared import xcode_info_util
+
+
+_METRIC_NAME_PREFIX = 'xctestrunner_'
+# The upper bounds of the histogram buckets. Most of the observed values are
+# latencies in seconds or small counts, e.g., the attempts.
+_HISTOGRAM_BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, float('inf'))
+
+_registry = None
+
+
+class MetricsRegistry(object):
+  """Keeps the counters and histograms and sends them to StatsD."""
+
+  def __init__(self, textfile_path=None, statsd_address=None):
+    """Initializes the MetricsRegistry object.
+
+    Args:
+      textfile_path: string, the path of the Prometheus text file written by
+          Flush.
+      statsd_address: tuple of host and port of the StatsD server.
+    """
+    self._textfile_path = textfile_path
+    self._statsd_address = statsd_address
+    self._statsd_socket = None
+    if statsd_address:
+      self._statsd_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self._counters = {}
+    self._histograms = {}
+    self._lock = threading.Lock()
+    self._xcode_version_label = None
+
+  def IncrementCounter(self, name, value, labels):
+    """Increments the counter with the labels."""
+    labels = self._AddDefaultLabels(labels)
+    key = (name, _GetLabelsKey(labels))
+    with self._lock:
+      self._counters[key] = self._counters.get(key, 0) + value
+    self._SendToStatsd(name, value, 'c', labels)
+
+  def ObserveHistogram(self, name, value, labels):
+    """Observes a value of the histogram with the labels."""
+    labels = self._AddDefaultLabels(labels)
+    key = (name, _GetLabelsKey(labels))
+    with self._lock:
+      histogram = self._histograms.get(key)
+      if histogram is None:
+        histogram = {'buckets': [0] * len(_HISTOGRAM_BUCKETS), 'sum': 0.0,
+                     'count': 0}
+        self._histograms[key] = histogram
+      for i, bound in enumerate(_HISTOGRAM_BUCKETS):
+        if value <= bound:
+          histogram['buckets'][i] += 1
+      histogram['sum'] += value
+      histogram['count'] += 1
+    self._SendToStatsd(name, value, 'h', labels)
+
+  def FormatPrometheusText(self):
+    """Formats the metrics in Prometheus text exposition format."""
+    lines = []
+    with self._lock:
+      counter_names = sorted(set(name for name, _ in self._counters))
+      for name in counter_names:
+        full_name = _METRIC_NAME_PREFIX + name
+        lines.append('# TYPE %s counter' % full_name)
+        for (key_name, labels_key), value in sorted(self._counters.items()):
+          if key_name == name:
+            lines.append('%s%s %s' % (full_name, _FormatLabels(labels_key),
+                                      _FormatValue(value)))
+      histogram_names = sorted(set(name for name, _ in self._histograms))
+      for name in histogram_names:
+        full_name = _METRIC_NAME_PREFIX + name
+        lines.append('# TYPE %s histogram' % full_name)
+        for (key_name, labels_key), histogram in sorted(
+            self._histograms.items()):
+          if key_name != name:
+            continue
+          for bound, count in zip(_HISTOGRAM_BUCKETS, histogram['buckets']):
+            bucket_labels_key = labels_key + (('le', _FormatValue(bound)),)
+            lines.append('%s_bucket%s %d' % (
+                full_name, _FormatLabels(bucket_labels_key), count))
+          lines.append('%s_sum%s %s' % (full_name, _FormatLabels(labels_key),
+                                        _FormatValue(histogram['sum'])))
+          lines.append('%s_count%s %d' % (full_name, _FormatLabels(labels_key),
+                                          histogram['count']))
+    return ''.join(line + '\n' for line in lines)
+
+  def Flush(self):
+    """Writes the Prometheus text file if its path is given."""
+    if not self._textfile_path:
+      return
+    temp_file_path = '%s.%d.tmp' % (self._textfile_path, os.getpid())
+    with open(temp_file_path, 'w') as textfile:
+      textfile.write(self.FormatPrometheusText())
+    os.rename(temp_file_path, self._textfile_path)
+
+  def _AddDefaultLabels(self, labels):
+    """Adds the labels shared by all metrics of the process."""
+    if self._xcode_version_label is None:
+      try:
+        self._xcode_version_label = str(
+            xcode_info_util.GetXcodeVersionNumber())
+      except (OSError, subprocess.CalledProcessError) as e:
+        logging.debug('Failed to get the Xcode version for metrics: %s', e)
+        self._xcode_version_label = 'unknown'
+    labels = dict(labels)
+    labels.setdefault('xcode_version', self._xcode_version_label)
+    return labels
+
+  def _SendToStatsd(self, name, value, metric_type, labels):
+    """Sends the metric to StatsD. The errors are ignored."""
+    if not self._statsd_socket:
+      return
+    datagram = '%s%s:%s|%s' % (_METRIC_NAME_PREFIX, name, _FormatValue(value),
+                               metric_type)
+    if labels:
+      datagram += '|#' + ','.join(
+          '%s:%s' % item for item in _GetLabelsKey(labels))
+    try:
+      self._statsd_socket.sendto(datagram, self._statsd_address)
+    except socket.error as e:
+      logging.debug('Failed to send metric to StatsD: %s', e)
+
+
+def EnableMetrics(textfile_path=None, statsd_address=None):
+  """Enables the metrics in this process.
+
+  Args:
+    textfile_path: string, the path of the Prometheus text file written by
+        Flush.
+    statsd_address: string, the address of the StatsD server in format
+        host:port.
+  """
+  global _registry
+  if statsd_address:
+    host, _, port = statsd_address.rpartition(':')
+    statsd_address = (host or 'localhost', int(port))
+  _registry = MetricsRegistry(textfile_path, statsd_address)
+
+
+def IsMetricsEnabled():
+  return _registry is not None
+
+
+def IncrementCounter(name, value=1, **labels):
+  """Increments the counter if the metrics are enabled.
+
+  Args:
+    name: string, the name of the counter without the xctestrunner_ prefix.
+    value: int, the increment.
+    **labels: the labels of the counter.
+  """
+  if _registry is not None:
+    _registry.IncrementCounter(name, value, labels)
+
+
+def ObserveHistogram(name, value, **labels):
+  """Observes a value of the histogram if the metrics are enabled.
+
+  Args:
+    name: string, the name of the histogram without the xctestrunner_ prefix.
+    value: float, the observed value.
+    **labels: the labels of the histogram.
+  """
+  if _registry is not None:
+    _registry.ObserveHistogram(name, value, labels)
+
+
+def Flush():
+  """Writes the Prometheus text file if the metrics are enabled."""
+  if _registry is not None:
+    _registry.Flush()
+
+
+def _GetLabelsKey(labels):
+  """Gets the sorted tuple of the labels with string values."""
+  return tuple(sorted((key, str(value)) for key, value in labels.items()
+                      if value is not None))
+
+
+def _FormatLabels(labels_key):
+  """Formats the labels in Prometheus format."""
+  if not labels_key:
+    return ''
+  return '{%s}' % ','.join(
+      '%s="%s"' % (key, value.replace('\\', '\\\\').replace('"', '\\"'))
+      for key, value in labels_key)
+
+
+def _FormatValue(value):
+  """Formats the number in Prometheus format."""
+  if value == float('inf'):
+    return '+Inf'
+  if isinstance(value, float) and value.is_integer():
+    return str(int(value))
+  return str(value)
@@ -21,6 +21,7 @@ import subprocess
 import xml.parsers.expat
 
 from xctestrunner.shared import ios_errors
+from xctestrunner.shared import subprocess_ledger
 try:
   import biplist
 except ImportError:
@@ -252,7 +253,8 @@ def _GetPlistFieldByPlistBuddy(plist_path, field):
   """
   command = [PLIST_BUDDY, '-c', 'Print :"%s"' % field, plist_path]
   try:
-    return subprocess.check_output(command, stderr=subprocess.STDOUT).strip()
+    return subprocess_ledger.CheckOutput(
+        command, stderr=subprocess.STDOUT).strip()
   except subprocess.CalledProcessError as e:
     raise ios_errors.PlistError(
         'Failed to get field %s in plist %s: %s', field, plist_path, e.output)
@@ -276,7 +278,7 @@ def _SetPlistFieldByPlistBuddy(plist_path, field, value):
   """
   command = [PLIST_BUDDY, '-c', 'Set :"%s" "%s"' % (field, value), plist_path]
   try:
-    subprocess.check_output(command, stderr=subprocess.STDOUT)
+    subprocess_ledger.CheckOutput(command, stderr=subprocess.STDOUT)
   except subprocess.CalledProcessError as e:
     raise ios_errors.PlistError('Failed to set field %s in plist %s: %s'
                                 % (field, plist_path, e.output))
@@ -298,7 +300,7 @@ def _DeletePlistFieldByPlistBuddy(plist_path, field):
   """
   command = [PLIST_BUDDY, '-c', 'Delete :"%s"' % field, plist_path]
   try:
-    subprocess.check_output(command, stderr=subprocess.STDOUT)
+    subprocess_ledger.CheckOutput(command, stderr=subprocess.STDOUT)
   except subprocess.CalledProcessError as e:
     raise ios_errors.PlistError('Failed to delete field %s in plist %s: %s'
                                 % (field, plist_path, e.output))
@@ -24,6 +24,7 @@ import uuid
 
 from xctestrunner.shared import ios_errors
 from xctestrunner.shared import plist_util
+from xctestrunner.shared import subprocess_ledger
 
 
 class ProvisiongProfile(object):
@@ -79,8 +80,8 @@ class ProvisiongProfile(object):
     command = ('security', 'cms', '-D', '-i', self._provisioning_profile_path,
                '-o', decode_provisioning_profile)
     logging.debug('Running command "%s"', ' '.join(command))
-    subprocess.Popen(command, stdout=subprocess.PIPE,
-                     stderr=subprocess.PIPE).communicate()
+    subprocess_ledger.Popen(command, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE).communicate()
     if not os.path.exists(decode_provisioning_profile):
       raise ios_errors.ProvisioningProfileError(
           'Failed to decode the provisioning profile.')
@@ -0,0 +1,246 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The history of the test runs in a host-local SQLite database.
+
+Each run appends one row with its exit code, retry count and dimensions, e.g.,
+the device type, the simulator runtime and the Xcode version, and the total
+duration of each phase. The phase durations are collected from the
+trace_util spans, which only cost a dict update per span. The percentiles of
+the phase durations can be queried per dimension to find the regressions, e.g.,
+a new Xcode version makes the simulator creation slower.
+
+The database is shared by all test runner processes of the user. The runs older
+than the retention are deleted when a new run is recorded.
+"""
+
+import logging
+import math
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+
+from xctestrunner.shared import cache_util
+from xctestrunner.shared import trace_util
+from xctestrunner.shared import xcode_info_util
+
+
+_DB_DIR_NAME = 'run_history'
+_DB_FILE_NAME = 'history.sqlite3'
+_RETENTION_SEC = 90 * 24 * 3600
+_DB_TIMEOUT_SEC = 10
+# The phase of the whole run in the statistics.
+TOTAL_PHASE = 'total'
+# The dimensions of the run. The values are taken from the args of the spans.
+DIMENSIONS = ('sdk', 'test_type', 'device_type', 'os_version', 'xcode_version')
+# The spans whose repeats in a run are retries.
+_RETRIED_SPANS = ('xcodebuild_test', 'create_simulator')
+_PERCENTILES = (50, 95, 99)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    start_time REAL NOT NULL,
+    duration_sec REAL NOT NULL,
+    command TEXT,
+    exit_code INTEGER,
+    retry_count INTEGER,
+    sdk TEXT,
+    test_type TEXT,
+    device_type TEXT,
+    os_version TEXT,
+    xcode_version TEXT);
+CREATE INDEX IF NOT EXISTS runs_start_time ON runs (start_time);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL,
+    phase TEXT NOT NULL,
+    duration_sec REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS phases_run_id ON phases (run_id);
+"""
+
+
+class RunHistoryRecorder(object):
+  """Collects the phase durations of a run and appends them to the history."""
+
+  def __init__(self, command, db_path=None):
+    """Initializes the RunHistoryRecorder object.
+
+    Args:
+      command: string, the sub command of the run, e.g., simulator_test.
+      db_path: string, the path of the database. By default, it is under the
+          test runner cache directory.
+    """
+    self._command = command
+    self._db_path = db_path
+    self._start_time = None
+    self._phase_durations = {}
+    self._phase_counts = {}
+    self._dimensions = {}
+    self._lock = threading.Lock()
+
+  def Start(self):
+    """Starts collecting the phase durations of the run."""
+    self._start_time = time.time()
+    trace_util.AddSpanListener(self._HandleSpan)
+
+  def SetDimension(self, key, value):
+    """Sets a dimension of the run explicitly.
+
+    Args:
+      key: string, one of DIMENSIONS.
+      value: string, the value of the dimension.
+    """
+    with self._lock:
+      self._dimensions[key] = value
+
+  def Finish(self, exit_code):
+    """Stops collecting and appends the run to the history.
+
+    The errors of the database are logged instead of being raised, so the
+    history never fails the run.
+
+    Args:
+      exit_code: int, the exit code of the run.
+    """
+    trace_util.RemoveSpanListener(self._HandleSpan)
+    duration_sec = time.time() - self._start_time
+    with self._lock:
+      phase_durations = dict(self._phase_durations)
+      retry_count = sum(max(0, self._phase_counts.get(name, 0) - 1)
+                        for name in _RETRIED_SPANS)
+      dimensions = dict(self._dimensions)
+    if 'xcode_version' not in dimensions:
+      dimensions['xcode_version'] = _GetXcodeVersion()
+    try:
+      connection = _Connect(self._db_path)
+      try:
+        with connection:
+          cursor = connection.execute(
+              'INSERT INTO runs (start_time, duration_sec, command, exit_code, '
+              'retry_count, %s) VALUES (?, ?, ?, ?, ?, %s)'
+              % (', '.join(DIMENSIONS), ', '.join('?' * len(DIMENSIONS))),
+              (self._start_time, duration_sec, self._command, exit_code,
+               retry_count) + tuple(dimensions.get(key) for key in DIMENSIONS))
+          connection.executemany(
+              'INSERT INTO phases (run_id, phase, duration_sec) '
+              'VALUES (?, ?, ?)',
+              [(cursor.lastrowid, phase, phase_duration_sec)
+               for phase, phase_duration_sec in phase_durations.items()])
+          _DeleteExpiredRuns(connection)
+      finally:
+        connection.close()
+    except sqlite3.Error as e:
+      logging.warning('Failed to record the run history: %s', e)
+
+  def _HandleSpan(self, name, duration_sec, args):
+    """Accumulates the duration of the span and takes its dimensions."""
+    with self._lock:
+      self._phase_durations[name] = (
+          self._phase_durations.get(name, 0.0) + duration_sec)
+      self._phase_counts[name] = self._phase_counts.get(name, 0) + 1
+      for key in DIMENSIONS:
+        if args.get(key) is not None and key not in self._dimensions:
+          self._dimensions[key] = str(args[key])
+
+
+def GetPhaseStats(db_path=None, phase=None, since_time=None, **dimensions):
+  """Gets the percentiles of the phase durations in the history.
+
+  Args:
+    db_path: string, the path of the database. By default, it is under the test
+        runner cache directory.
+    phase: string, only gets the stats of the phase.
+    since_time: float, only counts the runs started after the time.
+    **dimensions: the values of DIMENSIONS to filter the runs.
+
+  Returns:
+    a list of tuples of the phase name, the number of the samples, and the
+    p50, p95 and p99 of the durations in seconds, sorted by the phase name. The
+    duration of the whole run is the phase TOTAL_PHASE.
+  """
+  conditions = []
+  params = []
+  for key, value in sorted(dimensions.items()):
+    if key not in DIMENSIONS:
+      raise ValueError('Unknown dimension %s. Supported dimensions are %s.'
+                       % (key, DIMENSIONS))
+    if value is not None:
+      conditions.append('runs.%s = ?' % key)
+      params.append(value)
+  if since_time is not None:
+    conditions.append('runs.start_time >= ?')
+    params.append(since_time)
+  where = ' AND '.join(conditions) if conditions else '1'
+  connection = _Connect(db_path)
+  try:
+    durations = {}
+    if phase is None or phase == TOTAL_PHASE:
+      durations[TOTAL_PHASE] = [
+          row[0] for row in connection.execute(
+              'SELECT duration_sec FROM runs WHERE %s' % where, params)]
+    phase_where = where
+    phase_params = list(params)
+    if phase is not None:
+      phase_where += ' AND phases.phase = ?'
+      phase_params.append(phase)
+    for phase_name, duration_sec in connection.execute(
+        'SELECT phases.phase, phases.duration_sec FROM phases '
+        'JOIN runs ON phases.run_id = runs.id WHERE %s' % phase_where,
+        phase_params):
+      durations.setdefault(phase_name, []).append(duration_sec)
+  finally:
+    connection.close()
+  stats = []
+  for phase_name in sorted(durations):
+    values = sorted(durations[phase_name])
+    if not values:
+      continue
+    stats.append((phase_name, len(values)) + tuple(
+        _GetPercentile(values, percentile) for percentile in _PERCENTILES))
+  return stats
+
+
+def _Connect(db_path):
+  """Connects to the database and creates the tables if necessary."""
+  if not db_path:
+    db_path = os.path.join(cache_util.GetCacheDir(_DB_DIR_NAME), _DB_FILE_NAME)
+  connection = sqlite3.connect(db_path, timeout=_DB_TIMEOUT_SEC)
+  connection.executescript(_SCHEMA)
+  return connection
+
+
+def _DeleteExpiredRuns(connection):
+  """Deletes the runs older than the retention."""
+  expire_time = time.time() - _RETENTION_SEC
+  connection.execute(
+      'DELETE FROM phases WHERE run_id IN '
+      '(SELECT id FROM runs WHERE start_time < ?)', (expire_time,))
+  connection.execute('DELETE FROM runs WHERE start_time < ?', (expire_time,))
+
+
+def _GetPercentile(sorted_values, percentile):
+  """Gets the percentile of the sorted values with the nearest-rank method."""
+  rank = int(math.ceil(percentile / 100.0 * len(sorted_values)))
+  return sorted_values[max(0, rank - 1)]
+
+
+def _GetXcodeVersion():
+  """Gets the Xcode version number as a string or None."""
+  try:
+    return str(xcode_info_util.GetXcodeVersionNumber())
+  except (OSError, subprocess.CalledProcessError) as e:
+    logging.debug('Failed to get the Xcode version for run history: %s', e)
+    return None
@@ -0,0 +1,239 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stages the bundle directories into the work directory without copying.
+
+The methods of staging a directory tree, from the cheapest:
+- clone: clones the files by clonefile(2) with `cp -c`. The clones share the
+  blocks with the originals until one of them is modified. It is only
+  supported on APFS.
+- hardlink: creates new directories and hard links to the original files. The
+  files must not be modified in place, otherwise the originals are modified
+  too.
+- symlink: links the whole directory. Only the bundles which Xcode tolerates
+  as symlinks can be staged in this way.
+- copy: copies the files.
+
+The staging strategy decides which methods are tried. When a method is not
+supported, e.g., cloning on a non-APFS volume or hard linking across volumes,
+the next one is tried. Copying always works.
+
+The relative symlinks which resolve inside the tree are kept as symlinks. The
+other symlinks, e.g., the absolute ones or the ones out of the tree in a Bazel
+runfiles tree, are replaced with copies of their targets, so the staged bundle
+is self-contained.
+"""
+
+import errno
+import logging
+import os
+import shutil
+import subprocess
+import sys
+
+from xctestrunner.shared import ios_constants
+from xctestrunner.shared import metrics_util
+from xctestrunner.shared import subprocess_ledger
+from xctestrunner.shared import trace_util
+
+
+_CLONE = 'clone'
+_HARDLINK = 'hardlink'
+_SYMLINK = 'symlink'
+_COPY = 'copy'
+_STRATEGY_METHODS = {
+    ios_constants.StagingStrategy.AUTO: (_CLONE, _HARDLINK, _COPY),
+    ios_constants.StagingStrategy.CLONE: (_CLONE, _COPY),
+    ios_constants.StagingStrategy.HARDLINK: (_HARDLINK, _COPY),
+    ios_constants.StagingStrategy.SYMLINK: (_SYMLINK, _CLONE, _HARDLINK,
+                                            _COPY),
+    ios_constants.StagingStrategy.COPY: (_COPY,),
+}
+
+_staging_strategy = ios_constants.StagingStrategy.AUTO
+
+
+def StageTree(src_dir, des_dir, mutable=False, allow_symlink=False):
+  """Stages the directory tree with the cheapest supported method.
+
+  Args:
+    src_dir: string, the path of the source directory. If it is a symlink, the
+        directory which it points to is staged.
+    des_dir: string, the path of the staged directory. It must not exist.
+    mutable: bool, whether the files of the staged directory may be modified
+        in place, e.g., Info.plist is rewritten or the bundle is re-signed.
+        The mutable directory is never hard linked or symlinked to the source.
+    allow_symlink: bool, whether the staged directory can be a symlink to the
+        source. It only takes effect with the symlink staging strategy.
+
+  Returns:
+    int, the number of bytes actually copied.
+  """
+  src_dir = os.path.realpath(src_dir)
+  methods = [method for method in _STRATEGY_METHODS[_staging_strategy]
+             if not (method == _HARDLINK and mutable) and
+             not (method == _SYMLINK and (mutable or not allow_symlink))]
+  with trace_util.Span('stage_tree', path=des_dir) as span:
+    for method in methods:
+      try:
+        copied_bytes = _STAGING_FUNCTIONS[method](src_dir, des_dir)
+        if method != _SYMLINK:
+          copied_bytes += _CopyExternalSymlinkTargets(src_dir, des_dir)
+      except (OSError, IOError, shutil.Error,
+              subprocess.CalledProcessError) as e:
+        if method == _COPY:
+          raise
+        logging.debug('Failed to stage %s by %s, will try the next method: %s',
+                      src_dir, method, e)
+        _RemovePartialTree(des_dir)
+        continue
+      span.SetArg('method', method)
+      span.SetArg('copied_bytes', copied_bytes)
+      logging.info('Staged %s to %s by %s, copied %d bytes.', src_dir,
+                   des_dir, method, copied_bytes)
+      metrics_util.IncrementCounter('staged_trees_total', method=method)
+      metrics_util.IncrementCounter('staged_copied_bytes_total', copied_bytes,
+                                    method=method)
+      return copied_bytes
+
+
+def SetStagingStrategy(staging_strategy):
+  """Sets the strategy of staging the bundles.
+
+  Args:
+    staging_strategy: string, one of ios_constants.StagingStrategy.
+  """
+  global _staging_strategy
+  _staging_strategy = staging_strategy
+
+
+def GetStagingStrategy():
+  return _staging_strategy
+
+
+def _CloneTree(src_dir, des_dir):
+  """Clones the tree by clonefile(2). Only supported on macOS."""
+  if sys.platform != 'darwin':
+    raise OSError(errno.ENOTSUP, 'Cloning is only supported on macOS.')
+  subprocess_ledger.CheckOutput(['cp', '-c', '-R', '-p', src_dir, des_dir],
+                                stderr=subprocess.STDOUT)
+  return 0
+
+
+def _HardlinkTree(src_dir, des_dir):
+  """Creates the directories and hard links the files of the tree."""
+  os.mkdir(des_dir)
+  created_dirs = [(src_dir, des_dir)]
+  for root, dirs, files in os.walk(src_dir):
+    des_root = os.path.join(des_dir, os.path.relpath(root, src_dir))
+    for name in dirs:
+      src_path = os.path.join(root, name)
+      des_path = os.path.join(des_root, name)
+      if os.path.islink(src_path):
+        os.symlink(os.readlink(src_path), des_path)
+      else:
+        os.mkdir(des_path)
+        created_dirs.append((src_path, des_path))
+    for name in files:
+      src_path = os.path.join(root, name)
+      des_path = os.path.join(des_root, name)
+      if os.path.islink(src_path):
+        os.symlink(os.readlink(src_path), des_path)
+      else:
+        os.link(src_path, des_path)
+  # Sets the modes after the children are created, in case of the read-only
+  # directories.
+  for src_path, des_path in reversed(created_dirs):
+    shutil.copystat(src_path, des_path)
+  return 0
+
+
+def _SymlinkTree(src_dir, des_dir):
+  """Links the directory to the source."""
+  os.symlink(src_dir, des_dir)
+  return 0
+
+
+def _CopyTree(src_dir, des_dir):
+  """Copies the tree and returns the total size of the copied files."""
+  shutil.copytree(src_dir, des_dir, symlinks=True)
+  copied_bytes = 0
+  for root, _, files in os.walk(des_dir):
+    for name in files:
+      path = os.path.join(root, name)
+      if not os.path.islink(path):
+        copied_bytes += os.path.getsize(path)
+  return copied_bytes
+
+
+def IsInternalSymlink(link_path, root_dir):
+  """Checks whether the symlink is relative and resolves inside the tree.
+
+  Args:
+    link_path: string, the path of the symlink in the tree.
+    root_dir: string, the real path of the root directory of the tree.
+
+  Returns:
+    True if the symlink is relative and its target is inside the tree.
+  """
+  link_target = os.readlink(link_path)
+  if os.path.isabs(link_target):
+    return False
+  real_target = os.path.realpath(
+      os.path.join(os.path.dirname(link_path), link_target))
+  return real_target.startswith(root_dir + os.sep)
+
+
+def _CopyExternalSymlinkTargets(src_dir, des_dir):
+  """Replaces the staged external symlinks with copies of their targets.
+
+  Returns:
+    int, the total size of the copied files.
+  """
+  copied_bytes = 0
+  for root, dirs, files in os.walk(src_dir):
+    for name in dirs + files:
+      src_path = os.path.join(root, name)
+      if not os.path.islink(src_path) or IsInternalSymlink(src_path, src_dir):
+        continue
+      if not os.path.exists(src_path):
+        logging.warning('The symlink %s is dangling and is staged as it is.',
+                        src_path)
+        continue
+      des_path = os.path.join(des_dir, os.path.relpath(src_path, src_dir))
+      os.remove(des_path)
+      if os.path.isdir(src_path):
+        real_target = os.path.realpath(src_path)
+        copied_bytes += _CopyTree(real_target, des_path)
+        copied_bytes += _CopyExternalSymlinkTargets(real_target, des_path)
+      else:
+        shutil.copy2(src_path, des_path)
+        copied_bytes += os.path.getsize(des_path)
+  return copied_bytes
+
+
+def _RemovePartialTree(des_dir):
+  """Removes the partially staged tree after a failed method."""
+  if os.path.islink(des_dir):
+    os.remove(des_dir)
+  elif os.path.exists(des_dir):
+    shutil.rmtree(des_dir, ignore_errors=True)
+
+
+_STAGING_FUNCTIONS = {
+    _CLONE: _CloneTree,
+    _HARDLINK: _HardlinkTree,
+    _SYMLINK: _SymlinkTree,
+    _COPY: _CopyTree,
+}
@@ -0,0 +1,191 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The ledger of the external commands run by the test runner.
+
+All external commands, e.g., xcrun, simctl, xcodebuild, codesign and
+PlistBuddy, are launched by Popen, CheckOutput or CheckCall of this module
+instead of the subprocess module. The ledger records the calls, duration, exit
+status and output size of each distinct command line, so the redundant probes
+can be found in the summary at the end of the session.
+"""
+
+import logging
+import subprocess
+import threading
+import time
+
+
+# The number of the slowest commands shown in the summary.
+_SUMMARY_TOP_COMMANDS = 10
+
+_entries = {}
+_entries_lock = threading.Lock()
+
+
+class Popen(subprocess.Popen):
+  """The subprocess.Popen which records the command in the ledger.
+
+  The duration and the exit status are recorded when the exit of the process
+  is observed by wait, poll or communicate.
+  """
+
+  def __init__(self, args, *popen_args, **popen_kwargs):
+    self._ledger_key = _GetLedgerKey(args)
+    self._ledger_start_time = time.time()
+    self._ledger_recorded = False
+    super(Popen, self).__init__(args, *popen_args, **popen_kwargs)
+    _AddCall(self._ledger_key)
+
+  def poll(self):
+    return_code = super(Popen, self).poll()
+    if return_code is not None:
+      self._RecordExit()
+    return return_code
+
+  def wait(self, *args, **kwargs):
+    return_code = super(Popen, self).wait(*args, **kwargs)
+    self._RecordExit()
+    return return_code
+
+  def communicate(self, *args, **kwargs):
+    stdout, stderr = super(Popen, self).communicate(*args, **kwargs)
+    self.AddOutputBytes(len(stdout or '') + len(stderr or ''))
+    return stdout, stderr
+
+  def AddOutputBytes(self, output_bytes):
+    """Adds the size of the output read from the pipes by the caller."""
+    with _entries_lock:
+      _entries[self._ledger_key]['output_bytes'] += output_bytes
+
+  def _RecordExit(self):
+    """Records the duration and the exit status once."""
+    if self._ledger_recorded:
+      return
+    self._ledger_recorded = True
+    duration_sec = time.time() - self._ledger_start_time
+    with _entries_lock:
+      entry = _entries[self._ledger_key]
+      entry['finished_calls'] += 1
+      entry['failures'] += int(self.returncode != 0)
+      entry['total_duration_sec'] += duration_sec
+
+
+def CheckOutput(args, **kwargs):
+  """Runs the command and returns its output, like subprocess.check_output.
+
+  Args:
+    args: a list of string, the command to run.
+    **kwargs: the arguments of subprocess.Popen, except stdout.
+
+  Returns:
+    string, the stdout of the command.
+
+  Raises:
+    subprocess.CalledProcessError: when the command failed.
+  """
+  process = Popen(args, stdout=subprocess.PIPE, **kwargs)
+  output = process.communicate()[0]
+  if process.returncode:
+    raise subprocess.CalledProcessError(process.returncode, args, output)
+  return output
+
+
+def CheckCall(args, **kwargs):
+  """Runs the command and waits for it, like subprocess.check_call.
+
+  Args:
+    args: a list of string, the command to run.
+    **kwargs: the arguments of subprocess.Popen.
+
+  Raises:
+    subprocess.CalledProcessError: when the command failed.
+  """
+  return_code = Popen(args, **kwargs).wait()
+  if return_code:
+    raise subprocess.CalledProcessError(return_code, args)
+
+
+def GetEntries():
+  """Gets the records of the commands run in this process.
+
+  Returns:
+    a dict, the key is the command line and the value is a dict with fields:
+      calls: int, the number of the launches.
+      finished_calls: int, the number of the launches whose exit was observed.
+      failures: int, the number of the launches exited with non-zero status.
+      total_duration_sec: float, the sum of the duration of the finished
+          launches.
+      output_bytes: int, the total size of the output read from the pipes.
+  """
+  with _entries_lock:
+    return dict((key, dict(entry)) for key, entry in _entries.items())
+
+
+def GetDuplicateCommands():
+  """Gets the identical command lines which were run more than once.
+
+  Returns:
+    a list of tuples of the command line and its number of calls, in the order
+    of the most called first.
+  """
+  entries = GetEntries()
+  duplicates = [(key, entry['calls']) for key, entry in entries.items()
+                if entry['calls'] > 1]
+  return sorted(duplicates, key=lambda item: (-item[1], item[0]))
+
+
+def LogSummary():
+  """Logs the summary of the commands and the duplicate command lines."""
+  entries = GetEntries()
+  if not entries:
+    return
+  total_calls = sum(entry['calls'] for entry in entries.values())
+  total_duration_sec = sum(
+      entry['total_duration_sec'] for entry in entries.values())
+  logging.info('Ran %d external commands (%d distinct) in %.2fs.',
+               total_calls, len(entries), total_duration_sec)
+  slowest_keys = sorted(
+      entries, key=lambda k: entries[k]['total_duration_sec'],
+      reverse=True)[:_SUMMARY_TOP_COMMANDS]
+  for key in slowest_keys:
+    entry = entries[key]
+    logging.info('  %.2fs, %d calls, %d failures, %d output bytes: %s',
+                 entry['total_duration_sec'], entry['calls'],
+                 entry['failures'], entry['output_bytes'], key)
+  for key, calls in GetDuplicateCommands():
+    logging.info('The identical command ran %d times: %s', calls, key)
+
+
+def _GetLedgerKey(args):
+  """Gets the command line as the key of the ledger."""
+  if isinstance(args, basestring):
+    return args
+  return ' '.join(args)
+
+
+def _AddCall(key):
+  """Records a launch of the command."""
+  with _entries_lock:
+    entry = _entries.get(key)
+    if entry is None:
+      entry = {
+          'calls': 0,
+          'finished_calls': 0,
+          'failures': 0,
+          'total_duration_sec': 0.0,
+          'output_bytes': 0,
+      }
+      _entries[key] = entry
+    entry['calls'] += 1
@@ -0,0 +1,232 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The lightweight tracing of the phases of a test runner process.
+
+The spans of the phases, e.g., bundle extraction, `xcodebuild
+build-for-testing`, simulator creation and test execution, are recorded in
+memory and exported in the Chrome trace event format, which can be loaded by
+chrome://tracing or https://ui.perfetto.dev.
+
+Tracing is disabled by default. When it is disabled and there is no span
+listener, Span returns a shared no-op object, so the spans in the code cost
+almost nothing. The span listeners get the duration of each span even if
+tracing is disabled, e.g., to record the phase durations of the run.
+
+Example:
+  with trace_util.Span('extract_bundle', path=bundle_path):
+    ...
+  span = trace_util.StartSpan('xcodebuild_startup')
+  ...
+  span.End()
+"""
+
+import json
+import os
+import threading
+import time
+
+
+TRACE_FILE_NAME = 'xctestrunner_trace.json'
+
+_tracer = None
+_span_listeners = []
+
+
+class _NullSpan(object):
+  """The span which records nothing. It is used when tracing is disabled."""
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    pass
+
+  def SetArg(self, key, value):
+    pass
+
+  def End(self):
+    pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+  """A span of a traced phase."""
+
+  def __init__(self, tracer, name, args):
+    self._tracer = tracer
+    self._name = name
+    self._args = args
+    self._thread_id = threading.current_thread().ident
+    self._start_time = time.time()
+    self._ended = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, unused_value, unused_traceback):
+    if exc_type:
+      self._args['error'] = exc_type.__name__
+    self.End()
+
+  def SetArg(self, key, value):
+    """Sets an argument of the span, which is shown in the trace viewer."""
+    self._args[key] = value
+
+  def End(self):
+    """Ends the span. Ending an ended span does nothing."""
+    if self._ended:
+      return
+    self._ended = True
+    duration_sec = time.time() - self._start_time
+    if self._tracer:
+      self._tracer.AddCompleteEvent(self._name, self._start_time, duration_sec,
+                                    self._thread_id, self._args)
+    for listener in list(_span_listeners):
+      listener(self._name, duration_sec, self._args)
+
+
+class Tracer(object):
+  """Records the trace events of this process."""
+
+  def __init__(self):
+    self._events = []
+    self._lock = threading.Lock()
+    self._pid = os.getpid()
+
+  def AddCompleteEvent(self, name, start_time, duration_sec, thread_id, args):
+    """Adds a complete event.
+
+    Args:
+      name: string, the name of the event.
+      start_time: float, the start time in seconds since the epoch.
+      duration_sec: float, the duration in seconds.
+      thread_id: int, the id of the thread where the event happened.
+      args: dict, the arguments of the event.
+    """
+    event = {
+        'name': name,
+        'cat': 'xctestrunner',
+        'ph': 'X',
+        'ts': int(start_time * 1000000),
+        'dur': int(duration_sec * 1000000),
+        'pid': self._pid,
+        'tid': thread_id,
+    }
+    if args:
+      event['args'] = args
+    with self._lock:
+      self._events.append(event)
+
+  def AddInstantEvent(self, name, args=None):
+    """Adds an instant event, which marks a moment of the process."""
+    event = {
+        'name': name,
+        'cat': 'xctestrunner',
+        'ph': 'i',
+        's': 't',
+        'ts': int(time.time() * 1000000),
+        'pid': self._pid,
+        'tid': threading.current_thread().ident,
+    }
+    if args:
+      event['args'] = args
+    with self._lock:
+      self._events.append(event)
+
+  def WriteChromeTrace(self, file_path):
+    """Writes the recorded events to the file in Chrome trace event format.
+
+    Args:
+      file_path: string, the path of the trace file.
+    """
+    with self._lock:
+      events = list(self._events)
+    with open(file_path, 'w') as trace_file:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+def EnableTracing():
+  """Enables tracing in this process. It is a no-op if already enabled."""
+  global _tracer
+  if not _tracer:
+    _tracer = Tracer()
+
+
+def IsTracingEnabled():
+  return _tracer is not None
+
+
+def Span(name, **args):
+  """Creates a span to be used in a with statement.
+
+  Args:
+    name: string, the name of the traced phase.
+    **args: the arguments of the span, which are shown in the trace viewer.
+
+  Returns:
+    a span object with methods SetArg and End. If tracing is disabled and
+    there is no span listener, it is a shared no-op object.
+  """
+  if _tracer is None and not _span_listeners:
+    return _NULL_SPAN
+  return _Span(_tracer, name, args)
+
+
+def StartSpan(name, **args):
+  """Starts a span which ends when its End method is called.
+
+  It is for the phases which do not fit a with statement, e.g., the startup of
+  xcodebuild which ends when a line of its output is seen.
+  """
+  return Span(name, **args)
+
+
+def AddSpanListener(listener):
+  """Adds the span listener.
+
+  Args:
+    listener: function, called with the name, the duration in seconds and the
+        args dict of each ended span.
+  """
+  _span_listeners.append(listener)
+
+
+def RemoveSpanListener(listener):
+  """Removes the span listener added by AddSpanListener."""
+  if listener in _span_listeners:
+    _span_listeners.remove(listener)
+
+
+def AddInstantEvent(name, **args):
+  """Marks a moment of the process, e.g., a relaunch of the test."""
+  if _tracer is not None:
+    _tracer.AddInstantEvent(name, args)
+
+
+def WriteChromeTrace(file_path):
+  """Writes the trace of this process to the file if tracing is enabled.
+
+  Args:
+    file_path: string, the path of the trace file.
+
+  Returns:
+    True if the trace is written, otherwise False.
+  """
+  if _tracer is None:
+    return False
+  _tracer.WriteChromeTrace(file_path)
+  return True
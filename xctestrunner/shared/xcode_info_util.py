@@ -15,7 +15,8 @@
 """Utility methods for Xcode information."""
 
 import os
-import subprocess
+
+from xctestrunner.shared import subprocess_ledger
 
 
 _xcode_version_number = None
@@ -23,7 +24,7 @@ _xcode_version_number = None
 
 def GetXcodeDeveloperPath():
   """Gets the active developer path of Xcode command line tools."""
-  return subprocess.check_output(('xcode-select', '-p')).strip()
+  return subprocess_ledger.CheckOutput(('xcode-select', '-p')).strip()
 
 
 def GetXcodeVersionNumber():
@@ -41,7 +42,7 @@ def GetXcodeVersionNumber():
   # Example output:
   # Xcode 8.2.1
   # Build version 8C1002
-  output = subprocess.check_output(('xcodebuild', '-version'))
+  output = subprocess_ledger.CheckOutput(('xcodebuild', '-version'))
   xcode_version = output.split('\n')[0].split(' ')[1]
   parts = xcode_version.split('.')
   xcode_version_number = int(parts[0]) * 100
@@ -57,13 +58,13 @@ def GetXcodeVersionNumber():
 
 def GetSdkPlatformPath(sdk):
   """Gets the selected SDK platform path."""
-  return subprocess.check_output(
+  return subprocess_ledger.CheckOutput(
       ['xcrun', '--sdk', sdk, '--show-sdk-platform-path']).strip()
 
 
 def GetSdkVersion(sdk):
   """Gets the selected SDK version."""
-  return subprocess.check_output(
+  return subprocess_ledger.CheckOutput(
       ['xcrun', '--sdk', sdk, '--show-sdk-version']).strip()
 
 
@@ -75,7 +76,8 @@ def GetXctestToolPath(sdk):
 
 def GetDarwinUserCacheDir():
   """Gets the path of Darwin user cache directory."""
-  return subprocess.check_output(('getconf', 'DARWIN_USER_CACHE_DIR')).rstrip()
+  return subprocess_ledger.CheckOutput(
+      ('getconf', 'DARWIN_USER_CACHE_DIR')).rstrip()
 
 
 def GetXcodeEmbeddedAppDeltasDir():
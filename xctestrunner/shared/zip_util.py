@@ -0,0 +1,184 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process parallel extraction of zip archives, e.g., .ipa files.
+
+zipfile.ZipFile.extractall drops the Unix mode bits and writes the symlinks as
+regular files (https://bugs.python.org/issue15795), which breaks the
+executables and the frameworks of the bundles. ExtractZip restores the mode
+bits, the symlinks and the modification times from the entries, and
+decompresses the files on a pool of threads. zlib releases the GIL while
+decompressing, so the threads run in parallel. Each thread reads the archive
+with its own file handle.
+"""
+
+import multiprocessing
+from multiprocessing import pool as multiprocessing_pool
+import os
+import shutil
+import stat
+import threading
+import time
+import zipfile
+
+from xctestrunner.shared import ios_errors
+
+
+_COPY_BUFFER_BYTES = 1024 * 1024
+_MAX_WORKERS = 8
+
+
+def ExtractZip(zip_file_path, des_dir, prefixes=None, max_workers=None):
+  """Extracts the zip archive into the directory.
+
+  The existing files in the directory are overwritten.
+
+  Args:
+    zip_file_path: string, the path of the zip archive.
+    des_dir: string, the directory to extract the archive into.
+    prefixes: a list of string, only extracts the entries whose names start
+        with one of the prefixes, e.g., ['Payload/']. By default, all entries
+        are extracted.
+    max_workers: int, the max number of the threads which decompress the
+        files. By default, it is the number of CPUs, but at most 8.
+
+  Raises:
+    ios_errors.BundleError: when an entry would be extracted outside of the
+      directory.
+  """
+  des_dir = os.path.abspath(des_dir)
+  zip_file = zipfile.ZipFile(zip_file_path)
+  try:
+    infos = [info for info in zip_file.infolist()
+             if not prefixes or
+             any(info.filename.startswith(prefix) for prefix in prefixes)]
+  finally:
+    zip_file.close()
+
+  dir_infos = []
+  file_infos = []
+  for info in infos:
+    des_path = _GetDestinationPath(des_dir, info.filename)
+    mode = _GetUnixMode(info)
+    if info.filename.endswith('/') or stat.S_ISDIR(mode):
+      _MakeDirs(des_path)
+      dir_infos.append((info, des_path))
+    else:
+      _MakeDirs(os.path.dirname(des_path))
+      file_infos.append((info, des_path))
+
+  if not max_workers:
+    max_workers = min(multiprocessing.cpu_count(), _MAX_WORKERS)
+  # Extracts the large files first so the workers finish at about the same
+  # time.
+  file_infos.sort(key=lambda item: item[0].file_size, reverse=True)
+  extractor = _Extractor(zip_file_path)
+  try:
+    if max_workers > 1 and len(file_infos) > 1:
+      worker_pool = multiprocessing_pool.ThreadPool(
+          min(max_workers, len(file_infos)))
+      try:
+        worker_pool.map(extractor.ExtractFile, file_infos)
+      finally:
+        worker_pool.close()
+        worker_pool.join()
+    else:
+      for file_info in file_infos:
+        extractor.ExtractFile(file_info)
+  finally:
+    extractor.Close()
+
+  # Restores the directories after their children are created, in case of the
+  # read-only directories.
+  for info, des_path in sorted(dir_infos, key=lambda item: item[1],
+                               reverse=True):
+    mode = _GetUnixMode(info)
+    if mode:
+      os.chmod(des_path, stat.S_IMODE(mode))
+    _SetModificationTime(des_path, info)
+
+
+class _Extractor(object):
+  """Extracts the file entries with a zipfile.ZipFile object per thread."""
+
+  def __init__(self, zip_file_path):
+    self._zip_file_path = zip_file_path
+    self._local = threading.local()
+    self._zip_files = []
+    self._lock = threading.Lock()
+
+  def ExtractFile(self, file_info):
+    """Extracts a file or symlink entry.
+
+    Args:
+      file_info: a tuple of the zipfile.ZipInfo and the destination path.
+    """
+    info, des_path = file_info
+    zip_file = getattr(self._local, 'zip_file', None)
+    if zip_file is None:
+      zip_file = zipfile.ZipFile(self._zip_file_path)
+      self._local.zip_file = zip_file
+      with self._lock:
+        self._zip_files.append(zip_file)
+    mode = _GetUnixMode(info)
+    if os.path.islink(des_path) or (
+        stat.S_ISLNK(mode) and os.path.lexists(des_path)):
+      os.remove(des_path)
+    if stat.S_ISLNK(mode):
+      os.symlink(zip_file.read(info), des_path)
+      return
+    with zip_file.open(info) as src_file:
+      with open(des_path, 'wb') as des_file:
+        shutil.copyfileobj(src_file, des_file, _COPY_BUFFER_BYTES)
+    if mode:
+      os.chmod(des_path, stat.S_IMODE(mode))
+    _SetModificationTime(des_path, info)
+
+  def Close(self):
+    """Closes the zipfile.ZipFile objects of the threads."""
+    with self._lock:
+      for zip_file in self._zip_files:
+        zip_file.close()
+      self._zip_files = []
+
+
+def _GetUnixMode(info):
+  """Gets the Unix mode of the entry, or 0 if it is not created on Unix."""
+  return info.external_attr >> 16
+
+
+def _GetDestinationPath(des_dir, entry_name):
+  """Gets the destination path of the entry and checks it is in des_dir."""
+  des_path = os.path.normpath(os.path.join(des_dir, entry_name))
+  if des_path != des_dir and not des_path.startswith(des_dir + os.sep):
+    raise ios_errors.BundleError(
+        'The entry %s of the archive is outside of the extraction directory.'
+        % entry_name)
+  return des_path
+
+
+def _MakeDirs(dir_path):
+  """Creates the directory and its parents if they do not exist."""
+  if not os.path.isdir(dir_path):
+    try:
+      os.makedirs(dir_path)
+    except OSError:
+      if not os.path.isdir(dir_path):
+        raise
+
+
+def _SetModificationTime(des_path, info):
+  """Sets the modification time of the extracted file to the entry's."""
+  mtime = time.mktime(info.date_time + (0, 0, -1))
+  os.utime(des_path, (mtime, mtime))
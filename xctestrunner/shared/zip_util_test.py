@@ -0,0 +1,115 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for zip_util with synthetic archives."""
+
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+import zipfile
+
+from xctestrunner.shared import ios_errors
+from xctestrunner.shared import zip_util
+
+
+class ExtractZipTest(unittest.TestCase):
+
+  def setUp(self):
+    self._temp_dir = tempfile.mkdtemp()
+    self._zip_file_path = os.path.join(self._temp_dir, 'test.ipa')
+    self._des_dir = os.path.join(self._temp_dir, 'extracted')
+    os.mkdir(self._des_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self._temp_dir)
+
+  def _WriteZip(self, entries):
+    """Writes the archive with the (name, mode, data) entries."""
+    with zipfile.ZipFile(self._zip_file_path, 'w',
+                         zipfile.ZIP_DEFLATED) as zip_file:
+      for name, mode, data in entries:
+        info = zipfile.ZipInfo(name, date_time=(2017, 1, 2, 3, 4, 6))
+        info.create_system = 3
+        info.external_attr = mode << 16
+        zip_file.writestr(info, data)
+
+  def _GetPath(self, *names):
+    return os.path.join(self._des_dir, *names)
+
+  def testRestoresModes(self):
+    self._WriteZip([
+        ('Payload/', stat.S_IFDIR | 0o755, ''),
+        ('Payload/Foo.app/', stat.S_IFDIR | 0o755, ''),
+        ('Payload/Foo.app/Foo', stat.S_IFREG | 0o755, 'executable'),
+        ('Payload/Foo.app/Info.plist', stat.S_IFREG | 0o644, 'plist'),
+    ])
+    zip_util.ExtractZip(self._zip_file_path, self._des_dir, max_workers=2)
+    executable_path = self._GetPath('Payload', 'Foo.app', 'Foo')
+    with open(executable_path) as executable_file:
+      self.assertEqual('executable', executable_file.read())
+    self.assertEqual(0o755, stat.S_IMODE(os.stat(executable_path).st_mode))
+    self.assertEqual(0o644, stat.S_IMODE(
+        os.stat(self._GetPath('Payload', 'Foo.app', 'Info.plist')).st_mode))
+
+  def testRestoresSymlinks(self):
+    self._WriteZip([
+        ('Foo.framework/Versions/A/Foo', stat.S_IFREG | 0o755, 'binary'),
+        ('Foo.framework/Versions/Current', stat.S_IFLNK | 0o777, 'A'),
+        ('Foo.framework/Foo', stat.S_IFLNK | 0o777, 'Versions/Current/Foo'),
+    ])
+    zip_util.ExtractZip(self._zip_file_path, self._des_dir, max_workers=3)
+    link_path = self._GetPath('Foo.framework', 'Foo')
+    self.assertTrue(os.path.islink(link_path))
+    self.assertEqual('Versions/Current/Foo', os.readlink(link_path))
+    self.assertEqual(
+        'A', os.readlink(self._GetPath('Foo.framework', 'Versions', 'Current')))
+    with open(link_path) as linked_file:
+      self.assertEqual('binary', linked_file.read())
+
+  def testRestoresModificationTimes(self):
+    self._WriteZip([('Foo.xctest/Foo', stat.S_IFREG | 0o644, 'data')])
+    zip_util.ExtractZip(self._zip_file_path, self._des_dir)
+    mtime = os.path.getmtime(self._GetPath('Foo.xctest', 'Foo'))
+    self.assertEqual((2017, 1, 2, 3, 4, 6),
+                     tuple(time.localtime(mtime))[:6])
+
+  def testFiltersByPrefixes(self):
+    self._WriteZip([
+        ('Payload/Foo.app/Foo', stat.S_IFREG | 0o755, 'executable'),
+        ('Symbols/Foo.symbols', stat.S_IFREG | 0o644, 'symbols'),
+        ('SwiftSupport/libswiftCore.dylib', stat.S_IFREG | 0o644, 'swift'),
+    ])
+    zip_util.ExtractZip(self._zip_file_path, self._des_dir,
+                        prefixes=['Payload/'])
+    self.assertEqual(['Payload'], os.listdir(self._des_dir))
+    self.assertTrue(os.path.isfile(self._GetPath('Payload', 'Foo.app', 'Foo')))
+
+  def testRejectsEntriesOutsideOfDestination(self):
+    self._WriteZip([('../escaped', stat.S_IFREG | 0o644, 'data')])
+    with self.assertRaises(ios_errors.BundleError):
+      zip_util.ExtractZip(self._zip_file_path, self._des_dir)
+    self.assertFalse(
+        os.path.exists(os.path.join(self._temp_dir, 'escaped')))
+
+  def testRejectsAbsoluteEntries(self):
+    self._WriteZip([('/tmp/escaped', stat.S_IFREG | 0o644, 'data')])
+    with self.assertRaises(ios_errors.BundleError):
+      zip_util.ExtractZip(self._zip_file_path, self._des_dir)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,281 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The client to run `xcrun simctl` commands.
+
+Every simctl command runs with a timeout of its verb, so a hung CoreSimulator
+operation fails fast instead of blocking the test runner. The commands failed
+with the known transient errors of CoreSimulatorService are retried with
+jittered exponential backoff. The client also counts the calls and records the
+latency histogram of each verb.
+
+The streaming commands, e.g., `simctl spawn`, are launched by Popen and are
+supervised by the caller, so they have no timeout and are not retried, but
+they are still counted in the metrics of their verbs.
+"""
+
+import logging
+import random
+import subprocess
+import threading
+import time
+
+from xctestrunner.shared import ios_constants
+from xctestrunner.shared import ios_errors
+from xctestrunner.shared import subprocess_ledger
+
+
+_DEFAULT_TIMEOUT_SEC = 60
+# The timeout of each simctl verb in seconds.
+_VERB_TIMEOUTS_SEC = {
+    'list': 60,
+    'create': 120,
+    'delete': 60,
+    'shutdown': 60,
+    'boot': 180,
+    'erase': 120,
+    'install': 300,
+    'uninstall': 60,
+    'get_app_container': 30,
+}
+# The signatures of the transient simctl errors and the max attempts of the
+# command failed with them.
+_RETRYABLE_ERRORS = (
+    (ios_constants.CORESIMULATOR_INTERRUPTED_ERROR, 3),
+    ('CoreSimulatorService connection became invalid', 3),
+    ('Failed to initiate service connection to simulator', 2),
+)
+_RETRY_BACKOFF_BASE_SEC = 1
+_RETRY_BACKOFF_MAX_SEC = 10
+# The upper bounds of the latency histogram buckets in seconds.
+_LATENCY_BUCKETS_SEC = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, float('inf'))
+
+_simctl_client = None
+
+
+class SimctlClient(object):
+  """Runs simctl commands with timeouts, retries and metrics."""
+
+  def __init__(self, verb_timeouts_sec=None):
+    """Initializes the SimctlClient object.
+
+    Args:
+      verb_timeouts_sec: dict, the timeout in seconds of each simctl verb. It
+          overrides the default timeouts.
+    """
+    self._verb_timeouts_sec = dict(_VERB_TIMEOUTS_SEC)
+    if verb_timeouts_sec:
+      self._verb_timeouts_sec.update(verb_timeouts_sec)
+    self._metrics = {}
+    self._metrics_lock = threading.Lock()
+
+  def Run(self, args, timeout_sec=None):
+    """Runs the `xcrun simctl` command.
+
+    Args:
+      args: a list of string, the arguments of `xcrun simctl`. The first item is
+          the verb. E.g., ['shutdown', simulator_id].
+      timeout_sec: int, the timeout of the command in seconds. If it is not
+          given, uses the timeout of the verb.
+
+    Returns:
+      string, the stripped output of the command.
+
+    Raises:
+      subprocess.CalledProcessError: when the command failed.
+      ios_errors.SimError: when the command did not finish in timeout.
+    """
+    verb = args[0]
+    if timeout_sec is None:
+      timeout_sec = self._verb_timeouts_sec.get(verb, _DEFAULT_TIMEOUT_SEC)
+    command = ['xcrun', 'simctl'] + list(args)
+    attempt = 0
+    while True:
+      attempt += 1
+      start_time = time.time()
+      return_code, output, timed_out = _RunWithTimeout(command, timeout_sec)
+      self._Record(verb, time.time() - start_time,
+                   failed=return_code != 0, timed_out=timed_out,
+                   retried=attempt > 1)
+      if timed_out:
+        raise ios_errors.SimError(
+            'The command "%s" did not finish in %ss. Output is:\n%s'
+            % (' '.join(command), timeout_sec, output))
+      if return_code == 0:
+        return output.strip()
+      max_attempts = _GetMaxAttempts(output)
+      if attempt >= max_attempts:
+        raise subprocess.CalledProcessError(return_code, command, output)
+      backoff_sec = min(_RETRY_BACKOFF_MAX_SEC,
+                        _RETRY_BACKOFF_BASE_SEC * 2 ** (attempt - 1))
+      backoff_sec *= random.uniform(0.5, 1.5)
+      logging.warning(
+          'The command "%s" failed with transient error. Will retry in %.1fs. '
+          'Output is:\n%s', ' '.join(command), backoff_sec, output)
+      time.sleep(backoff_sec)
+
+  def Popen(self, args, **popen_kwargs):
+    """Launches the streaming `xcrun simctl` command.
+
+    The command is not retried and has no timeout. Its call, latency and
+    failure are recorded in the metrics of its verb when its exit is observed
+    by wait, poll or communicate.
+
+    Args:
+      args: a list of string, the arguments of `xcrun simctl`. The first item is
+          the verb. E.g., ['spawn', simulator_id, 'log', 'show'].
+      **popen_kwargs: the keyword arguments of subprocess.Popen.
+
+    Returns:
+      a subprocess_ledger.Popen object of the command.
+    """
+    return _SimctlPopen(self._Record, args[0],
+                        ['xcrun', 'simctl'] + list(args), **popen_kwargs)
+
+  def GetMetrics(self):
+    """Gets the metrics of the simctl commands.
+
+    Returns:
+      a dict, the key is the simctl verb and the value is a dict with fields:
+        calls: int, the number of the command runs, including retries.
+        failures: int, the number of the failed runs.
+        retries: int, the number of the retried runs.
+        timeouts: int, the number of the timed out runs.
+        total_latency_sec: float, the sum of the latency of the runs.
+        latency_buckets: a list of [upper bound in seconds, count] pairs. The
+            count is cumulative.
+    """
+    with self._metrics_lock:
+      metrics = {}
+      for verb, verb_metrics in self._metrics.items():
+        metrics[verb] = dict(verb_metrics)
+        metrics[verb]['latency_buckets'] = [
+            list(bucket) for bucket in verb_metrics['latency_buckets']]
+      return metrics
+
+  def LogMetrics(self):
+    """Logs the summary of the simctl commands' metrics."""
+    metrics = self.GetMetrics()
+    for verb in sorted(metrics):
+      verb_metrics = metrics[verb]
+      logging.info(
+          'simctl %s: %d calls, %d failures, %d retries, %d timeouts, '
+          'avg latency %.2fs.', verb, verb_metrics['calls'],
+          verb_metrics['failures'], verb_metrics['retries'],
+          verb_metrics['timeouts'],
+          verb_metrics['total_latency_sec'] / verb_metrics['calls'])
+
+  def _Record(self, verb, latency_sec, failed, timed_out, retried):
+    """Records the metrics of a simctl command run."""
+    with self._metrics_lock:
+      verb_metrics = self._metrics.get(verb)
+      if verb_metrics is None:
+        verb_metrics = {
+            'calls': 0,
+            'failures': 0,
+            'retries': 0,
+            'timeouts': 0,
+            'total_latency_sec': 0.0,
+            'latency_buckets': [[bound, 0] for bound in _LATENCY_BUCKETS_SEC],
+        }
+        self._metrics[verb] = verb_metrics
+      verb_metrics['calls'] += 1
+      verb_metrics['failures'] += int(failed)
+      verb_metrics['retries'] += int(retried)
+      verb_metrics['timeouts'] += int(timed_out)
+      verb_metrics['total_latency_sec'] += latency_sec
+      for bucket in verb_metrics['latency_buckets']:
+        if latency_sec <= bucket[0]:
+          bucket[1] += 1
+
+
+class _SimctlPopen(subprocess_ledger.Popen):
+  """The simctl process which records the metrics of its verb when it exits."""
+
+  def __init__(self, record_callback, verb, args, **popen_kwargs):
+    self._record_callback = record_callback
+    self._verb = verb
+    self._start_time = time.time()
+    self._verb_recorded = False
+    super(_SimctlPopen, self).__init__(args, **popen_kwargs)
+
+  def poll(self):
+    return_code = super(_SimctlPopen, self).poll()
+    if return_code is not None:
+      self._RecordVerb()
+    return return_code
+
+  def wait(self, *args, **kwargs):
+    return_code = super(_SimctlPopen, self).wait(*args, **kwargs)
+    self._RecordVerb()
+    return return_code
+
+  def _RecordVerb(self):
+    """Records the metrics of the verb once."""
+    if self._verb_recorded:
+      return
+    self._verb_recorded = True
+    self._record_callback(
+        self._verb, time.time() - self._start_time,
+        failed=self.returncode != 0, timed_out=False, retried=False)
+
+
+def GetSimctlClient():
+  """Gets the SimctlClient object shared in the process."""
+  global _simctl_client
+  if _simctl_client is None:
+    _simctl_client = SimctlClient()
+  return _simctl_client
+
+
+def _GetMaxAttempts(output):
+  """Gets the max attempts of the command according to its error output."""
+  for signature, max_attempts in _RETRYABLE_ERRORS:
+    if signature in output:
+      return max_attempts
+  return 1
+
+
+def _RunWithTimeout(command, timeout_sec):
+  """Runs the command and kills it if it does not finish in timeout.
+
+  Args:
+    command: a list of string, the command to run.
+    timeout_sec: int, the timeout of the command in seconds.
+
+  Returns:
+    a tuple with three items:
+      int, the return code of the command.
+      string, the output of the command, including stderr.
+      bool, whether the command was killed for timeout.
+  """
+  process = subprocess_ledger.Popen(command, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+  timed_out = threading.Event()
+
+  def _Kill():
+    timed_out.set()
+    try:
+      process.kill()
+    except OSError:
+      # The process has exited.
+      pass
+
+  timer = threading.Timer(timeout_sec, _Kill)
+  timer.start()
+  try:
+    output = process.communicate()[0]
+  finally:
+    timer.cancel()
+  return process.returncode, output, timed_out.is_set()
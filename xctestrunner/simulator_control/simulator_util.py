@@ -15,7 +15,9 @@
 """The utility class for simulator."""
 
 import ast
+import glob
 import logging
+from multiprocessing import pool
 import os
 import pwd
 import re
@@ -23,10 +25,15 @@ import shutil
 import subprocess
 import time
 
+from xctestrunner.shared import host_semaphore
 from xctestrunner.shared import ios_constants
 from xctestrunner.shared import ios_errors
+from xctestrunner.shared import metrics_util
 from xctestrunner.shared import plist_util
+from xctestrunner.shared import subprocess_ledger
+from xctestrunner.shared import trace_util
 from xctestrunner.shared import xcode_info_util
+from xctestrunner.simulator_control import simctl_client
 from xctestrunner.simulator_control import simtype_profile
 
 
@@ -39,6 +46,11 @@ _SIMULATOR_CREATING_TO_SHUTDOWN_TIMEOUT_SEC = 10
 _SIMULATOR_SHUTDOWN_TIMEOUT_SEC = 30
 _SIM_ERROR_RETRY_INTERVAL_SEC = 2
 _SIM_CHECK_STATE_INTERVAL_SEC = 0.5
+_APP_DATA_CONTAINERS_RELATIVE_DIR = 'data/Containers/Data/Application'
+_APP_CONTAINER_METADATA_PLIST_NAME = (
+    '.com.apple.mobile_container_manager.metadata.plist')
+_DEFAULT_APP_ARTIFACT_SUB_DIRS = ('Documents', 'Library/Caches', 'tmp')
+_PULL_APP_ARTIFACTS_MAX_WORKERS = 8
 _PATTERN_APP_CRASH_ON_SIM = (
     r'com\.apple\.CoreSimulator\.SimDevice\.[A-Z0-9\-]+(.+) '
     r'\(UIKitApplication:%s(.+)\): Service exited '
@@ -62,6 +74,7 @@ class Simulator(object):
     self._simulator_root_dir = None
     self._simulator_log_root_dir = None
     self._device_plist_object = None
+    self._app_data_container_index = None
 
   @property
   def simulator_id(self):
@@ -119,15 +132,17 @@ class Simulator(object):
       raise ios_errors.SimError(
           'Can not shut down the simulator in state CREATING.')
     logging.info('Shutting down simulator %s.', self.simulator_id)
-    try:
-      _RunSimctlCommand(['xcrun', 'simctl', 'shutdown', self.simulator_id])
-    except subprocess.CalledProcessError as e:
-      if 'Unable to shutdown device in current state: Shutdown' in e.output:
-        logging.info('Simulator %s has already shut down.', self.simulator_id)
-        return
-      raise ios_errors.SimError(
-          'Failed to shutdown simulator %s: %s' % (self.simulator_id, e.output))
-    self.WaitUntilStateShutdown()
+    with trace_util.Span('shutdown_simulator', simulator_id=self.simulator_id):
+      try:
+        _RunSimctlCommand(['shutdown', self.simulator_id])
+      except subprocess.CalledProcessError as e:
+        if 'Unable to shutdown device in current state: Shutdown' in e.output:
+          logging.info('Simulator %s has already shut down.',
+                       self.simulator_id)
+          return
+        raise ios_errors.SimError('Failed to shutdown simulator %s: %s'
+                                  % (self.simulator_id, e.output))
+      self.WaitUntilStateShutdown()
     logging.info('Shut down simulator %s.', self.simulator_id)
 
   def Delete(self):
@@ -144,14 +159,15 @@ class Simulator(object):
       raise ios_errors.SimError(
           'Can only delete the simulator with state SHUTDOWN. The current '
           'state of simulator %s is %s.' % (self._simulator_id, sim_state))
-    try:
-      _RunSimctlCommand(['xcrun', 'simctl', 'delete', self.simulator_id])
-    except subprocess.CalledProcessError as e:
-      raise ios_errors.SimError(
-          'Failed to delete simulator %s: %s' % (self.simulator_id, e.output))
-    # The delete command won't delete the simulator log directory.
-    if os.path.exists(self.simulator_log_root_dir):
-      shutil.rmtree(self.simulator_log_root_dir)
+    with trace_util.Span('delete_simulator', simulator_id=self.simulator_id):
+      try:
+        _RunSimctlCommand(['delete', self.simulator_id])
+      except subprocess.CalledProcessError as e:
+        raise ios_errors.SimError('Failed to delete simulator %s: %s'
+                                  % (self.simulator_id, e.output))
+      # The delete command won't delete the simulator log directory.
+      if os.path.exists(self.simulator_log_root_dir):
+        shutil.rmtree(self.simulator_log_root_dir)
     logging.info('Deleted simulator %s.', self.simulator_id)
     self._simulator_id = None
 
@@ -162,50 +178,144 @@ class Simulator(object):
       output_file_path: string, the path of the stdout file.
       start_time: datetime, the start time of the simulatro log.
       end_time: datetime, the end time of the simulatro log.
+
+    Raises:
+      ios_errors.SimError: when the `log` tool failed.
     """
-    command = [
-        'xcrun', 'simctl', 'spawn', self._simulator_id, 'log', 'show',
-        '--style', 'syslog']
+    args = ['spawn', self._simulator_id, 'log', 'show', '--style', 'syslog']
     if start_time:
-      command.extend(('--start', start_time.strftime('%Y-%m-%d %H:%M:%S')))
+      args.extend(('--start', start_time.strftime('%Y-%m-%d %H:%M:%S')))
     if end_time:
-      command.extend(('--end', end_time.strftime('%Y-%m-%d %H:%M:%S')))
+      args.extend(('--end', end_time.strftime('%Y-%m-%d %H:%M:%S')))
     with open(output_file_path, 'w') as stdout_file:
-      try:
-        subprocess.Popen(
-            command, stdout=stdout_file, stderr=subprocess.STDOUT)
-      except subprocess.CalledProcessError as e:
-        raise ios_errors.SimError(
-            'Failed to get log on simulator %s: %s'
-            % (self.simulator_id, e.output))
+      return_code = simctl_client.GetSimctlClient().Popen(
+          args, stdout=stdout_file, stderr=subprocess.STDOUT).wait()
+    if return_code != 0:
+      raise ios_errors.SimError(
+          'Failed to get log on simulator %s. The output is saved in %s.'
+          % (self.simulator_id, output_file_path))
 
   def GetAppDocumentsPath(self, app_bundle_id):
     """Gets the path of the app's Documents directory."""
+    return os.path.join(self.GetAppDataContainer(app_bundle_id), 'Documents')
+
+  def GetAppDataContainer(self, app_bundle_id):
+    """Gets the path of the app's data container in the simulator.
+
+    The container is looked up in the app data container index first. The
+    index is refreshed once if the app is not found, e.g., the app was installed
+    after the index was built.
+
+    Args:
+      app_bundle_id: string, the bundle id of the app.
+
+    Returns:
+      string, the path of the app's data container.
+
+    Raises:
+      ios_errors.SimError: when failed to get the data container of the app.
+    """
+    container = self.GetAppDataContainerIndex().get(app_bundle_id)
+    if not container:
+      container = self.GetAppDataContainerIndex(refresh=True).get(app_bundle_id)
+    if container:
+      return container
+
     if xcode_info_util.GetXcodeVersionNumber() >= 830:
       try:
-        app_data_container = _RunSimctlCommand(
-            ['xcrun', 'simctl', 'get_app_container', self._simulator_id,
-             app_bundle_id, 'data'])
-        return os.path.join(app_data_container, 'Documents')
+        return _RunSimctlCommand(
+            ['get_app_container', self._simulator_id, app_bundle_id, 'data'])
       except subprocess.CalledProcessError as e:
         raise ios_errors.SimError(
-            'Failed to get data container of the app %s in simulator %s: %s',
-            app_bundle_id, self._simulator_id, e.output)
-
-    apps_dir = os.path.join(
-        self.simulator_root_dir, 'data/Containers/Data/Application')
-    for sub_dir_name in os.listdir(apps_dir):
-      container_manager_plist = plist_util.Plist(
-          os.path.join(
-              apps_dir, sub_dir_name,
-              '.com.apple.mobile_container_manager.metadata.plist'))
-      current_app_bundle_id = container_manager_plist.GetPlistField(
-          'MCMMetadataIdentifier')
-      if current_app_bundle_id == app_bundle_id:
-        return os.path.join(apps_dir, sub_dir_name, 'Documents')
+            'Failed to get data container of the app %s in simulator %s: %s'
+            % (app_bundle_id, self._simulator_id, e.output))
     raise ios_errors.SimError(
-        'Failed to get Documents directory of the app %s in simulator %s: %s',
-        app_bundle_id, self._simulator_id)
+        'Failed to get data container of the app %s in simulator %s.'
+        % (app_bundle_id, self._simulator_id))
+
+  def GetAppDataContainerIndex(self, refresh=False):
+    """Gets the index which maps app bundle id to its data container.
+
+    The index is built by scanning the container manager metadata plist of every
+    app data container once. The result is cached in the Simulator object.
+
+    Args:
+      refresh: bool, whether rescans the app data containers.
+
+    Returns:
+      a dict, the key is the app bundle id and the value is the path of the
+      app's data container.
+    """
+    if self._app_data_container_index is not None and not refresh:
+      return self._app_data_container_index
+    index = {}
+    metadata_plist_paths = glob.glob(
+        os.path.join(self.simulator_root_dir,
+                     _APP_DATA_CONTAINERS_RELATIVE_DIR, '*',
+                     _APP_CONTAINER_METADATA_PLIST_NAME))
+    for metadata_plist_path in metadata_plist_paths:
+      try:
+        app_bundle_id = plist_util.Plist(metadata_plist_path).GetPlistField(
+            'MCMMetadataIdentifier')
+      except ios_errors.PlistError as e:
+        logging.debug('Failed to read the container metadata %s: %s',
+                      metadata_plist_path, e)
+        continue
+      index[app_bundle_id] = os.path.dirname(metadata_plist_path)
+    self._app_data_container_index = index
+    return self._app_data_container_index
+
+  def PullAppArtifacts(self, app_bundle_ids, output_dir, since_time=None,
+                       sub_dirs=_DEFAULT_APP_ARTIFACT_SUB_DIRS,
+                       max_workers=_PULL_APP_ARTIFACTS_MAX_WORKERS):
+    """Pulls the files in the apps' data containers to the output directory.
+
+    The files are copied to output_dir/{app_bundle_id}/{sub_dir} in parallel.
+    The pull is incremental: the file which is not modified after since_time or
+    whose copy in output_dir is already up to date will be skipped.
+
+    Args:
+      app_bundle_ids: a list of string, the bundle ids of the apps.
+      output_dir: string, the directory where the pulled files will go.
+      since_time: float, the seconds since the epoch. Only the files which are
+          modified after this time will be pulled. E.g., the start time of test.
+      sub_dirs: a list of string, the sub directories of the app data container
+          to be pulled.
+      max_workers: int, the max number of threads to copy files.
+
+    Returns:
+      a list of string, the paths of the pulled files under output_dir.
+    """
+    copy_tasks = []
+    for app_bundle_id in app_bundle_ids:
+      try:
+        container = self.GetAppDataContainer(app_bundle_id)
+      except ios_errors.SimError as e:
+        logging.warning('Skip pulling artifacts of the app %s: %s',
+                        app_bundle_id, e)
+        continue
+      for sub_dir in sub_dirs:
+        src_root_dir = os.path.join(container, sub_dir)
+        des_root_dir = os.path.join(output_dir, app_bundle_id, sub_dir)
+        for root, _, files in os.walk(src_root_dir):
+          for file_name in files:
+            src_path = os.path.join(root, file_name)
+            des_path = os.path.join(
+                des_root_dir, os.path.relpath(src_path, src_root_dir))
+            if _NeedPullFile(src_path, des_path, since_time):
+              copy_tasks.append((src_path, des_path))
+    if not copy_tasks:
+      return []
+
+    logging.info('Pulling %d files from simulator %s to %s.',
+                 len(copy_tasks), self.simulator_id, output_dir)
+    thread_pool = pool.ThreadPool(max(1, min(max_workers, len(copy_tasks))))
+    try:
+      pulled_files = thread_pool.map(_PullFile, copy_tasks)
+    finally:
+      thread_pool.close()
+      thread_pool.join()
+    return [path for path in pulled_files if path]
 
   def WaitUntilStateShutdown(self, timeout_sec=_SIMULATOR_SHUTDOWN_TIMEOUT_SEC):
     """Waits until the simulator state becomes SHUTDOWN.
@@ -309,33 +419,54 @@ def CreateNewSimulator(device_type=None, os_version=None, name=None):
   runtime_id = _PREFIX_RUNTIME_ID + os_type + '-' + os_version.replace('.', '-')
   logging.info('Creating a new simulator:\nName: %s\nOS: %s %s\nType: %s',
                name, os_type, os_version, device_type)
+  start_time = time.time()
   for i in range(0, _SIM_OPERATION_MAX_ATTEMPTS):
-    try:
-      new_simulator_id = _RunSimctlCommand(
-          ['xcrun', 'simctl', 'create', name, device_type, runtime_id])
-    except subprocess.CalledProcessError as e:
-      raise ios_errors.SimError(
-          'Failed to create simulator: %s' % e.output)
-    new_simulator_obj = Simulator(new_simulator_id)
-    # After creating a new simulator, its state is CREATING. When the
-    # simulator's state becomes SHUTDOWN, the simulator is created.
-    try:
-      new_simulator_obj.WaitUntilStateShutdown(
-          _SIMULATOR_CREATING_TO_SHUTDOWN_TIMEOUT_SEC)
-      logging.info('Created new simulator %s.', new_simulator_id)
-      return new_simulator_id, device_type, os_version, name
-    except ios_errors.SimError as error:
-      logging.debug('Failed to create simulator %s: %s.',
-                    new_simulator_id, error)
-      logging.debug('Deleted half-created simulator %s.', new_simulator_id)
-      new_simulator_obj.Delete()
-      if i != _SIM_OPERATION_MAX_ATTEMPTS - 1:
-        logging.debug('Will sleep %ss and retry again.',
-                      _SIM_ERROR_RETRY_INTERVAL_SEC)
-        # If the simulator's state becomes SHUTDOWN, there may be something
-        # wrong in CoreSimulatorService. Sleeps a short interval(2s) can help
-        # reduce flakiness.
-        time.sleep(_SIM_ERROR_RETRY_INTERVAL_SEC)
+    # Limits the concurrent simulator creations in the host. Too many
+    # concurrent creations make CoreSimulatorService fail.
+    with host_semaphore.HostSemaphore(host_semaphore.SIM_BOOT):
+      with trace_util.Span('create_simulator', device_type=device_type,
+                           os_version=os_version, attempt=i):
+        try:
+          new_simulator_id = _RunSimctlCommand(
+              ['create', name, device_type, runtime_id])
+        except subprocess.CalledProcessError as e:
+          raise ios_errors.SimError(
+              'Failed to create simulator: %s' % e.output)
+        new_simulator_obj = Simulator(new_simulator_id)
+        # After creating a new simulator, its state is CREATING. When the
+        # simulator's state becomes SHUTDOWN, the simulator is created.
+        try:
+          new_simulator_obj.WaitUntilStateShutdown(
+              _SIMULATOR_CREATING_TO_SHUTDOWN_TIMEOUT_SEC)
+          logging.info('Created new simulator %s.', new_simulator_id)
+          metrics_util.IncrementCounter(
+              'simulator_creations_total', device_type=device_type,
+              os_version=os_version, result='succeeded')
+          metrics_util.ObserveHistogram(
+              'simulator_creation_attempts', i + 1, device_type=device_type,
+              os_version=os_version)
+          metrics_util.ObserveHistogram(
+              'simulator_creation_seconds', time.time() - start_time,
+              device_type=device_type, os_version=os_version)
+          return new_simulator_id, device_type, os_version, name
+        except ios_errors.SimError as error:
+          logging.debug('Failed to create simulator %s: %s.',
+                        new_simulator_id, error)
+          metrics_util.IncrementCounter(
+              'simulator_creation_retries_total', device_type=device_type,
+              os_version=os_version)
+          logging.debug('Deleted half-created simulator %s.', new_simulator_id)
+          new_simulator_obj.Delete()
+    if i != _SIM_OPERATION_MAX_ATTEMPTS - 1:
+      logging.debug('Will sleep %ss and retry again.',
+                    _SIM_ERROR_RETRY_INTERVAL_SEC)
+      # If the simulator's state becomes SHUTDOWN, there may be something
+      # wrong in CoreSimulatorService. Sleeps a short interval(2s) can help
+      # reduce flakiness.
+      time.sleep(_SIM_ERROR_RETRY_INTERVAL_SEC)
+  metrics_util.IncrementCounter(
+      'simulator_creations_total', device_type=device_type,
+      os_version=os_version, result='failed')
   raise ios_errors.SimError('Failed to create simulator in %d attempts.'
                             % _SIM_OPERATION_MAX_ATTEMPTS)
 
@@ -369,7 +500,7 @@ def GetSupportedSimDeviceTypes(os_type=None):
   #
   # See more examples in testdata/simctl_list_devicetypes.json
   sim_types_infos_json = ast.literal_eval(
-      _RunSimctlCommand(('xcrun', 'simctl', 'list', 'devicetypes', '-j')))
+      _RunSimctlCommand(('list', 'devicetypes', '-j')))
   sim_types = []
   for sim_types_info in sim_types_infos_json['devicetypes']:
     sim_type = sim_types_info['name']
@@ -435,7 +566,7 @@ def GetSupportedSimOsVersions(os_type=ios_constants.OS.IOS):
   #
   # See more examples in testdata/simctl_list_runtimes.json
   sim_runtime_infos_json = ast.literal_eval(
-      _RunSimctlCommand(('xcrun', 'simctl', 'list', 'runtimes', '-j')))
+      _RunSimctlCommand(('list', 'runtimes', '-j')))
   sim_versions = []
   for sim_runtime_info in sim_runtime_infos_json['runtimes']:
     # Normally, the json does not contain unavailable runtimes. To be safe,
@@ -574,8 +705,8 @@ def QuitSimulatorApp():
     simulator_name = 'Simulator'
   else:
     simulator_name = 'iOS Simulator'
-  subprocess.Popen(['killall', simulator_name],
-                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  subprocess_ledger.Popen(['killall', simulator_name],
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
 
 def IsAppFailedToLaunchOnSim(sim_sys_log, app_bundle_id=''):
@@ -591,7 +722,7 @@ def IsAppFailedToLaunchOnSim(sim_sys_log, app_bundle_id=''):
   Returns:
     True if the app failed to launch on simulator.
   """
-  pattern = re.compile(_PATTERN_APP_CRASH_ON_SIM % app_bundle_id)
+  pattern = re.compile(GetAppCrashOnSimPattern(app_bundle_id))
   return pattern.search(sim_sys_log) is not None
 
 
@@ -604,16 +735,78 @@ def IsXctestFailedToLaunchOnSim(sim_sys_log):
   Returns:
     True if the xctest process failed to launch on simulator.
   """
-  pattern = re.compile(_PATTERN_XCTEST_PROCESS_CRASH_ON_SIM)
+  pattern = re.compile(GetXctestCrashOnSimPattern())
   return pattern.search(sim_sys_log) is not None
 
 
-def _RunSimctlCommand(command):
-  """Runs simctl command."""
-  for i in range(2):
-    try:
-      return subprocess.check_output(command, stderr=subprocess.STDOUT).strip()
-    except subprocess.CalledProcessError as e:
-      if i == 0 and ios_constants.CORESIMULATOR_INTERRUPTED_ERROR in e.output:
-        continue
-      raise e
+def GetAppCrashOnSimPattern(app_bundle_id=''):
+  """Gets the regex pattern of the app crash log in simulator's system.log.
+
+  Args:
+    app_bundle_id: string, the bundle id of the app. If it is not provided, the
+        pattern matches the crash of any UIKitApplication.
+
+  Returns:
+    string, the regex pattern.
+  """
+  return _PATTERN_APP_CRASH_ON_SIM % app_bundle_id
+
+
+def GetXctestCrashOnSimPattern():
+  """Gets the regex pattern of the xctest process crash log in system.log."""
+  return _PATTERN_XCTEST_PROCESS_CRASH_ON_SIM
+
+
+def _NeedPullFile(src_path, des_path, since_time):
+  """Checks if the file in simulator needs to be pulled."""
+  try:
+    src_stat = os.lstat(src_path)
+  except OSError:
+    return False
+  if since_time is not None and src_stat.st_mtime <= since_time:
+    return False
+  try:
+    des_stat = os.stat(des_path)
+  except OSError:
+    return True
+  # shutil.copy2 keeps the modification time, but the float timestamp may lose
+  # precision in the copy.
+  return (des_stat.st_size != src_stat.st_size or
+          abs(des_stat.st_mtime - src_stat.st_mtime) > 0.001)
+
+
+def _PullFile(copy_task):
+  """Copies the file in copy_task (src_path, des_path) with its metadata."""
+  src_path, des_path = copy_task
+  des_dir = os.path.dirname(des_path)
+  try:
+    if not os.path.exists(des_dir):
+      os.makedirs(des_dir)
+  except OSError:
+    # The directory may be created by another thread at the same time.
+    if not os.path.isdir(des_dir):
+      raise
+  try:
+    shutil.copy2(src_path, des_path)
+  except (IOError, OSError) as e:
+    # The app may delete the file during pulling.
+    logging.warning('Failed to pull file %s: %s', src_path, e)
+    return None
+  return des_path
+
+
+def _RunSimctlCommand(args):
+  """Runs simctl command via the SimctlClient shared in the process.
+
+  Args:
+    args: a list of string, the arguments of `xcrun simctl`. E.g.,
+        ['shutdown', simulator_id].
+
+  Returns:
+    string, the stripped output of the command.
+
+  Raises:
+    subprocess.CalledProcessError: when the command failed.
+    ios_errors.SimError: when the command did not finish in timeout.
+  """
+  return simctl_client.GetSimctlClient().Run(args)
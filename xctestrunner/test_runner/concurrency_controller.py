@@ -0,0 +1,189 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The adaptive controller of the simulator parallelism in the host.
+
+The controller adjusts the allowed number of concurrent simulator test sessions
+with AIMD (additive increase, multiplicative decrease):
+- When a test session shows the host is overloaded (the simulator needs to be
+  recreated, the test does not start or the startup latency is over the
+  target), the limit is halved. The simulator is booted by xcodebuild, so the
+  boot latency is part of the test startup latency.
+- When a window of healthy test sessions finishes, the limit is increased by 1.
+  The window size is the current limit, so the limit grows by about 1 for each
+  round of concurrent sessions.
+
+The learned limit is persisted per host and Xcode version and shared by all
+test runner processes of the host. Any multi-simulator scheduler can read the
+limit and feed the observations to the controller.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import time
+
+from xctestrunner.shared import cache_util
+from xctestrunner.shared import file_lock_util
+from xctestrunner.shared import xcode_info_util
+from xctestrunner.test_runner import runner_exit_codes
+
+
+_STATE_DIR_NAME = 'concurrency_controller'
+_MIN_LIMIT = 1
+_TEST_STARTUP_LATENCY_TARGET_SEC = 120
+_DECREASE_FACTOR = 0.5
+# Concurrent sessions usually fail at the same time in one overload burst. Only
+# decreases the limit once in the cooldown.
+_DECREASE_COOLDOWN_SEC = 30
+_OVERLOAD_EXIT_CODES = (runner_exit_codes.EXITCODE.NEED_RECREATE_SIM,
+                        runner_exit_codes.EXITCODE.TEST_NOT_START)
+_HEALTHY_EXIT_CODES = (runner_exit_codes.EXITCODE.SUCCEEDED,
+                       runner_exit_codes.EXITCODE.FAILED)
+
+_active_controller = None
+
+
+class AdaptiveConcurrencyController(object):
+  """Adjusts the simulator parallelism of the host with AIMD."""
+
+  def __init__(self, xcode_version=None, max_limit=None, initial_limit=None,
+               state_file_path=None):
+    """Initializes the AdaptiveConcurrencyController object.
+
+    Args:
+      xcode_version: int, the Xcode version number. The learned limit is stored
+          per Xcode version. By default, it is the current Xcode version.
+      max_limit: int, the upper bound of the limit. By default, it is the
+          number of the CPU cores.
+      initial_limit: int, the limit when there is no learned limit. By default,
+          it is half of max_limit.
+      state_file_path: string, the path of the file to persist the learned
+          limit. By default, it is under the test runner cache directory.
+    """
+    if xcode_version is None:
+      xcode_version = xcode_info_util.GetXcodeVersionNumber()
+    if max_limit is None:
+      max_limit = multiprocessing.cpu_count()
+    self._max_limit = max(_MIN_LIMIT, max_limit)
+    if initial_limit is None:
+      initial_limit = self._max_limit // 2
+    self._initial_limit = min(self._max_limit, max(_MIN_LIMIT, initial_limit))
+    if not state_file_path:
+      state_file_path = os.path.join(
+          cache_util.GetCacheDir(_STATE_DIR_NAME),
+          '%s_xcode%s.json' % (socket.gethostname(), xcode_version))
+    self._state_file_path = state_file_path
+    self._lock = file_lock_util.FileLock(state_file_path + '.lock')
+
+  @property
+  def limit(self):
+    """The current allowed number of concurrent simulator test sessions."""
+    with self._lock:
+      return self._ReadState()['limit']
+
+  def RecordTestStartup(self, latency_sec):
+    """Records the latency from launching xcodebuild to the test starts.
+
+    The latency includes the simulator boot by xcodebuild. The time waiting for
+    the host semaphore should not be counted in.
+
+    Args:
+      latency_sec: float, the latency in seconds.
+    """
+    if latency_sec > _TEST_STARTUP_LATENCY_TARGET_SEC:
+      self._Decrease('test startup latency %.1fs is over the target %ss'
+                     % (latency_sec, _TEST_STARTUP_LATENCY_TARGET_SEC))
+
+  def RecordOutcome(self, exit_code):
+    """Records the outcome of a test session on simulator.
+
+    Args:
+      exit_code: runner_exit_codes.EXITCODE, the exit code of the test session.
+    """
+    if exit_code in _OVERLOAD_EXIT_CODES:
+      self._Decrease('test session exited with %s'
+                     % runner_exit_codes.EXITCODE_INFOS[exit_code])
+    elif exit_code in _HEALTHY_EXIT_CODES:
+      self._Increase()
+
+  def _Increase(self):
+    """Increases the limit by 1 after a window of healthy sessions."""
+    with self._lock:
+      state = self._ReadState()
+      state['healthy_sessions'] += 1
+      if (state['healthy_sessions'] >= state['limit'] and
+          state['limit'] < self._max_limit):
+        state['limit'] += 1
+        state['healthy_sessions'] = 0
+        logging.info('Increased the simulator concurrency limit to %d.',
+                     state['limit'])
+      self._WriteState(state)
+
+  def _Decrease(self, reason):
+    """Decreases the limit multiplicatively."""
+    with self._lock:
+      state = self._ReadState()
+      state['healthy_sessions'] = 0
+      now = time.time()
+      if now - state['last_decrease_time'] >= _DECREASE_COOLDOWN_SEC:
+        new_limit = max(_MIN_LIMIT, int(state['limit'] * _DECREASE_FACTOR))
+        if new_limit < state['limit']:
+          logging.info(
+              'Decreased the simulator concurrency limit from %d to %d, '
+              'because %s.', state['limit'], new_limit, reason)
+        state['limit'] = new_limit
+        state['last_decrease_time'] = now
+      self._WriteState(state)
+
+  def _ReadState(self):
+    """Reads the persisted state. Should be called with the lock held."""
+    state = {
+        'limit': self._initial_limit,
+        'healthy_sessions': 0,
+        'last_decrease_time': 0,
+    }
+    if os.path.exists(self._state_file_path):
+      try:
+        with open(self._state_file_path) as state_file:
+          state.update(json.load(state_file))
+      except ValueError as e:
+        logging.warning('Ignored the broken concurrency controller state %s: '
+                        '%s', self._state_file_path, e)
+    state['limit'] = min(self._max_limit, max(_MIN_LIMIT, state['limit']))
+    return state
+
+  def _WriteState(self, state):
+    """Writes the state atomically. Should be called with the lock held."""
+    temp_file_path = self._state_file_path + '.tmp'
+    with open(temp_file_path, 'w') as state_file:
+      json.dump(state, state_file)
+    os.rename(temp_file_path, self._state_file_path)
+
+
+def SetActiveController(controller):
+  """Sets the controller which receives the observations in this process.
+
+  Args:
+    controller: AdaptiveConcurrencyController, or None to disable it.
+  """
+  global _active_controller
+  _active_controller = controller
+
+
+def GetActiveController():
+  """Gets the active controller in this process or None if it is not set."""
+  return _active_controller
@@ -31,6 +31,9 @@ from xctestrunner.shared import ios_constants
 from xctestrunner.shared import ios_errors
 from xctestrunner.shared import plist_util
 from xctestrunner.shared import provisioning_profile
+from xctestrunner.shared import staging_util
+from xctestrunner.shared import subprocess_ledger
+from xctestrunner.shared import trace_util
 from xctestrunner.shared import xcode_info_util
 from xctestrunner.test_runner import xcodebuild_test_executor
 
@@ -133,12 +136,13 @@ class DummyProject(object):
                '-derivedDataPath', derived_data_dir]
     run_env = dict(os.environ)
     run_env['NSUnbufferedIO'] = 'YES'
-    try:
-      output = subprocess.check_output(
-          command, env=run_env, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-      raise ios_errors.BuildFailureError('Failed to build the dummy project. '
-                                         'Output is:\n%s' % e.output)
+    with trace_util.Span('build_for_testing', scheme=self._test_scheme):
+      try:
+        output = subprocess_ledger.CheckOutput(
+            command, env=run_env, stderr=subprocess.STDOUT)
+      except subprocess.CalledProcessError as e:
+        raise ios_errors.BuildFailureError('Failed to build the dummy project. '
+                                           'Output is:\n%s' % e.output)
 
     if _SIGNAL_BUILD_FOR_TESTING_SUCCEEDED not in output:
       raise ios_errors.BuildFailureError('Failed to build the dummy project. '
@@ -175,7 +179,8 @@ class DummyProject(object):
       test_bundle_under_plugin_path = os.path.join(
           app_under_test_plugin_path, os.path.basename(self._test_bundle_dir))
       if not os.path.exists(test_bundle_under_plugin_path):
-        shutil.copytree(self._test_bundle_dir, test_bundle_under_plugin_path)
+        staging_util.StageTree(self._test_bundle_dir,
+                               test_bundle_under_plugin_path, mutable=True)
     self._PrepareBuildProductsDir(built_products_dir)
 
     logging.info('Running `xcodebuild test` with dummy project.\n'
@@ -196,7 +201,16 @@ class DummyProject(object):
         failed_signal=_SIGNAL_XCODEBUILD_TEST_FAILED,
         sdk=self._sdk,
         test_type=self._test_type,
-        device_id=device_id).Execute(return_output=False)
+        device_id=device_id,
+        app_bundle_id=bundle_util.GetBundleId(
+            self._app_under_test_dir)).Execute(
+                return_output=False,
+                output_file_path=os.path.join(
+                    derived_data_dir,
+                    xcodebuild_test_executor.OUTPUT_FILE_NAME),
+                test_events_file_path=os.path.join(
+                    derived_data_dir,
+                    xcodebuild_test_executor.TEST_EVENTS_FILE_NAME))
     return exit_code
 
   def GenerateDummyProject(self):
@@ -209,37 +223,38 @@ class DummyProject(object):
       return
     logging.info('Generating dummy project.')
 
-    if self._work_dir:
-      if not os.path.exists(self._work_dir):
-        os.mkdir(self._work_dir)
-    else:
-      self._work_dir = tempfile.mkdtemp()
-      self._delete_work_dir = True
-    self._dummy_project_path = os.path.join(self._work_dir,
-                                            _DUMMYPROJECT_DIR_NAME)
-    shutil.copytree(_GetTestProject(self._work_dir), self._dummy_project_path)
-    for root, dirs, files in os.walk(self._dummy_project_path):
-      for d in dirs:
-        os.chmod(os.path.join(root, d), _DEFAULT_PERMS)
-      for f in files:
-        os.chmod(os.path.join(root, f), _DEFAULT_PERMS)
-    self._xcodeproj_dir_path = os.path.join(
-        self._dummy_project_path, _DUMMYPROJECT_XCODEPROJ_NAME)
-    self._pbxproj_file_path = os.path.join(
-        self._xcodeproj_dir_path, _DUMMYPROJECT_PBXPROJ_NAME)
-
-    # Set the iOS deployment target in pbxproj.
-    # If don't set this field, the default value will be the latest supported
-    # iOS version which may make the app installation failure.
-    self._SetIosDeploymentTarget()
-
-    # Overwrite the pbxproj file content for test type specific.
-    if self._test_type == ios_constants.TestType.XCUITEST:
-      self._SetPbxprojForXcuitest()
-    elif self._test_type == ios_constants.TestType.XCTEST:
-      self._SetPbxprojForXctest()
-
-    self._is_dummy_project_generated = True
+    with trace_util.Span('generate_dummy_project', test_type=self._test_type):
+      if self._work_dir:
+        if not os.path.exists(self._work_dir):
+          os.mkdir(self._work_dir)
+      else:
+        self._work_dir = tempfile.mkdtemp()
+        self._delete_work_dir = True
+      self._dummy_project_path = os.path.join(self._work_dir,
+                                              _DUMMYPROJECT_DIR_NAME)
+      shutil.copytree(_GetTestProject(self._work_dir), self._dummy_project_path)
+      for root, dirs, files in os.walk(self._dummy_project_path):
+        for d in dirs:
+          os.chmod(os.path.join(root, d), _DEFAULT_PERMS)
+        for f in files:
+          os.chmod(os.path.join(root, f), _DEFAULT_PERMS)
+      self._xcodeproj_dir_path = os.path.join(
+          self._dummy_project_path, _DUMMYPROJECT_XCODEPROJ_NAME)
+      self._pbxproj_file_path = os.path.join(
+          self._xcodeproj_dir_path, _DUMMYPROJECT_PBXPROJ_NAME)
+
+      # Set the iOS deployment target in pbxproj.
+      # If don't set this field, the default value will be the latest supported
+      # iOS version which may make the app installation failure.
+      self._SetIosDeploymentTarget()
+
+      # Overwrite the pbxproj file content for test type specific.
+      if self._test_type == ios_constants.TestType.XCUITEST:
+        self._SetPbxprojForXcuitest()
+      elif self._test_type == ios_constants.TestType.XCTEST:
+        self._SetPbxprojForXctest()
+
+      self._is_dummy_project_generated = True
     logging.info('Dummy project is generated.')
 
   def Close(self):
@@ -274,12 +289,14 @@ class DummyProject(object):
     test_bundle_name = os.path.basename(self._test_bundle_dir)
     if not os.path.exists(
         os.path.join(built_products_dir, app_under_test_name)):
-      shutil.copytree(self._app_under_test_dir,
-                      os.path.join(built_products_dir, app_under_test_name))
+      staging_util.StageTree(
+          self._app_under_test_dir,
+          os.path.join(built_products_dir, app_under_test_name), mutable=True)
     if not os.path.exists(
         os.path.join(built_products_dir, test_bundle_name)):
-      shutil.copytree(self._test_bundle_dir,
-                      os.path.join(built_products_dir, test_bundle_name))
+      staging_util.StageTree(
+          self._test_bundle_dir,
+          os.path.join(built_products_dir, test_bundle_name), mutable=True)
 
   def _SetIosDeploymentTarget(self):
     """Sets the iOS deployment target in dummy project's pbxproj."""
@@ -0,0 +1,233 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The streaming classifier of the failures in xcodebuild output and sim log.
+
+The known failure signatures are declared in the _SIGNATURES table. For each
+log source, the signatures applicable to the test session are combined into one
+compiled regex, so each line is scanned once no matter how many signatures
+there are. The classification is available as soon as the line with a
+signature is fed.
+"""
+
+import logging
+import re
+
+from xctestrunner.shared import ios_constants
+from xctestrunner.simulator_control import simulator_util
+
+
+def enum(**enums):
+  return type('Enum', (), enums)
+
+Classification = enum(
+    # The failure can be fixed by relaunching the test.
+    RETRYABLE='retryable',
+    # The failure can be fixed by running the test on a new simulator.
+    RECREATE_SIM='recreate_sim',
+    # The failure can be fixed by rebooting the real device.
+    REBOOT_DEVICE='reboot_device',
+    # The failure can not be fixed by retrying.
+    FATAL='fatal')
+Source = enum(XCODEBUILD_OUTPUT='xcodebuild_output', SIM_LOG='sim_log')
+
+# The classifications in the order of precedence. When several signatures are
+# matched, the classification of the session is the first one in this list.
+_CLASSIFICATION_PRECEDENCE = (Classification.FATAL,
+                              Classification.REBOOT_DEVICE,
+                              Classification.RECREATE_SIM,
+                              Classification.RETRYABLE)
+_APP_UNDER_TEST_TYPES = (ios_constants.TestType.XCTEST,
+                         ios_constants.TestType.XCUITEST)
+_DEVICE_SDKS = (ios_constants.SDK.IPHONEOS,)
+_SIMULATOR_SDKS = (ios_constants.SDK.IPHONESIMULATOR,)
+
+# The failure signatures. Each item is a tuple of:
+#   name: string, the name of the signature.
+#   source: Source, the log source to match the signature.
+#   pattern: string, the regex pattern of the signature. The '%(app_bundle_id)s'
+#       in the pattern will be replaced with the bundle id of the app under
+#       test.
+#   classification: Classification, the classification of the failure.
+#   test_types: a tuple of ios_constants.TestType which the signature applies
+#       to, or None if it applies to all test types.
+#   sdks: a tuple of ios_constants.SDK which the signature applies to, or None
+#       if it applies to all SDKs.
+_SIGNATURES = (
+    ('background_test_runner_failed', Source.XCODEBUILD_OUTPUT,
+     re.escape('Failed to background test runner'),
+     Classification.RECREATE_SIM, (ios_constants.TestType.XCUITEST,), None),
+    ('app_unknown_to_frontboard', Source.XCODEBUILD_OUTPUT,
+     'Application ".*" is unknown to FrontBoard.',
+     Classification.RECREATE_SIM, None, None),
+    ('request_denied_by_service_delegate', Source.XCODEBUILD_OUTPUT,
+     re.escape('The request was denied by service delegate (SBMainWorkspace) '
+               'for reason'),
+     Classification.RECREATE_SIM, None, None),
+    ('init_sim_service_failed', Source.XCODEBUILD_OUTPUT,
+     re.escape('Failed to initiate service connection to simulator'),
+     Classification.RECREATE_SIM, None, None),
+    ('process_exited_or_crashed', Source.XCODEBUILD_OUTPUT,
+     re.escape('The process did launch, but has since exited or crashed.'),
+     Classification.RETRYABLE, None, None),
+    ('coresimulator_interrupted', Source.XCODEBUILD_OUTPUT,
+     re.escape(ios_constants.CORESIMULATOR_INTERRUPTED_ERROR),
+     Classification.RETRYABLE, None, None),
+    ('test_manager_unreachable', Source.XCODEBUILD_OUTPUT,
+     re.escape('Unable to connect to test manager on'),
+     Classification.REBOOT_DEVICE, None, _DEVICE_SDKS),
+    ('dt_service_hub_lost', Source.XCODEBUILD_OUTPUT,
+     re.escape('Lost connection to DTServiceHub'),
+     Classification.REBOOT_DEVICE, None, _DEVICE_SDKS),
+    ('device_busy', Source.XCODEBUILD_OUTPUT,
+     re.escape('Device is busy (Waiting to reconnect to'),
+     Classification.REBOOT_DEVICE, None, _DEVICE_SDKS),
+    ('destination_not_found', Source.XCODEBUILD_OUTPUT,
+     re.escape('Unable to find a destination matching the provided '
+               'destination specifier'),
+     Classification.FATAL, None, None),
+    ('app_crashed_on_sim', Source.SIM_LOG,
+     simulator_util.GetAppCrashOnSimPattern('%(app_bundle_id)s'),
+     Classification.RETRYABLE, _APP_UNDER_TEST_TYPES, _SIMULATOR_SDKS),
+    ('xctest_crashed_on_sim', Source.SIM_LOG,
+     simulator_util.GetXctestCrashOnSimPattern(),
+     Classification.RETRYABLE, (ios_constants.TestType.LOGIC_TEST,),
+     _SIMULATOR_SDKS),
+)
+
+
+class SignatureMatch(object):
+  """The match of a failure signature."""
+
+  def __init__(self, name, source, classification, line):
+    self.name = name
+    self.source = source
+    self.classification = classification
+    self.line = line
+
+  def __repr__(self):
+    return '<SignatureMatch %s (%s) in %s>' % (
+        self.name, self.classification, self.source)
+
+
+class FailureClassifier(object):
+  """Classifies the failure of a test session line by line."""
+
+  def __init__(self, test_type=None, sdk=None, app_bundle_id='',
+               callback=None):
+    """Initializes the FailureClassifier object.
+
+    Args:
+      test_type: ios_constants.TestType, the type of the test. If it is not
+          given, the signatures of all test types apply.
+      sdk: ios_constants.SDK, the SDK of the test. If it is not given, the
+          signatures of all SDKs apply.
+      app_bundle_id: string, the bundle id of the app under test. If it is not
+          given, the crash of any app matches the app crash signature.
+      callback: function, called with a SignatureMatch object at the moment a
+          signature is matched.
+    """
+    self._callback = callback
+    self._matchers = {}
+    self._signature_infos = {}
+    patterns_by_source = {}
+    for index, signature in enumerate(_SIGNATURES):
+      name, source, pattern, classification, test_types, sdks = signature
+      if test_type and test_types and test_type not in test_types:
+        continue
+      if sdk and sdks and sdk not in sdks:
+        continue
+      group_name = '_s%d' % index
+      self._signature_infos[group_name] = (name, source, classification)
+      pattern = pattern.replace(
+          '%(app_bundle_id)s', re.escape(app_bundle_id or ''))
+      patterns_by_source.setdefault(source, []).append(
+          '(?P<%s>%s)' % (group_name, pattern))
+    for source, patterns in patterns_by_source.items():
+      self._matchers[source] = re.compile('|'.join(patterns))
+    self._matches = []
+
+  @property
+  def matches(self):
+    """The list of SignatureMatch objects in the order of being matched."""
+    return list(self._matches)
+
+  @property
+  def matched_signatures(self):
+    """The set of the names of the matched signatures."""
+    return set(match.name for match in self._matches)
+
+  @property
+  def classification(self):
+    """The classification of the fed lines or None if no signature matched."""
+    classifications = set(match.classification for match in self._matches)
+    for classification in _CLASSIFICATION_PRECEDENCE:
+      if classification in classifications:
+        return classification
+    return None
+
+  def FeedOutputLine(self, line):
+    """Feeds a line of xcodebuild output.
+
+    Args:
+      line: string, the line of the output.
+
+    Returns:
+      a SignatureMatch object if the line matches a signature, otherwise None.
+    """
+    return self._Feed(Source.XCODEBUILD_OUTPUT, line)
+
+  def FeedSimLogLine(self, line):
+    """Feeds a line of simulator's system.log.
+
+    Args:
+      line: string, the line of the log.
+
+    Returns:
+      a SignatureMatch object if the line matches a signature, otherwise None.
+    """
+    return self._Feed(Source.SIM_LOG, line)
+
+  def Reset(self):
+    """Clears the matches, e.g., before relaunching the test."""
+    self._matches = []
+
+  def _Feed(self, source, line):
+    """Matches the line with the combined matcher of the source."""
+    matcher = self._matchers.get(source)
+    if not matcher:
+      return None
+    regex_match = matcher.search(line)
+    if not regex_match:
+      return None
+    for group_name, value in regex_match.groupdict().items():
+      if value is not None and group_name in self._signature_infos:
+        name, source, classification = self._signature_infos[group_name]
+        match = SignatureMatch(name, source, classification, line)
+        self._matches.append(match)
+        if self._callback:
+          self._callback(match)
+        return match
+    return None
+
+
+def LogSignatureMatch(signature_match):
+  """Logs the matched failure signature. Can be the callback of the classifier.
+
+  Args:
+    signature_match: SignatureMatch, the match of the failure signature.
+  """
+  logging.info('Found failure signature %s (%s) in %s: %s',
+               signature_match.name, signature_match.classification,
+               signature_match.source, signature_match.line.strip())
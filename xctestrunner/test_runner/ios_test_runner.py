@@ -23,13 +23,28 @@ import argparse
 import json
 import logging
 import sys
+import time
 
+from xctestrunner.shared import app_deltas_cache
+from xctestrunner.shared import bundle_store
+from xctestrunner.shared import host_semaphore
 from xctestrunner.shared import ios_constants
 from xctestrunner.shared import ios_errors
+from xctestrunner.shared import metrics_util
+from xctestrunner.shared import run_history
+from xctestrunner.shared import staging_util
+from xctestrunner.shared import subprocess_ledger
+from xctestrunner.shared import trace_util
 from xctestrunner.shared import xcode_info_util
+from xctestrunner.simulator_control import simctl_client
 from xctestrunner.simulator_control import simulator_util
+from xctestrunner.test_runner import concurrency_controller
 from xctestrunner.test_runner import runner_exit_codes
+from xctestrunner.test_runner import test_log_index
+from xctestrunner.test_runner import xcodebuild_test_executor
 from xctestrunner.test_runner import xctest_session
+from xctestrunner.test_runner import xctestrun
+from xctestrunner.test_runner import xctestrun_template_cache
 
 _XCTESTRUN_HELP = (
     """The path of the xctestrun file.
@@ -91,6 +106,15 @@ def _AddGeneralArguments(parser):
       help='The directory of runfiles, including the bundles, generated '
            'xctestrun file. If directory is specified, the directory will not '
            'be deleted after test ends.')
+  optional_arguments.add_argument(
+      '--persistent_work_dir',
+      action='store_true',
+      help='Keeps the bundles of the last test run in the work directory and '
+           'syncs the new bundles into them incrementally, so only the added, '
+           'modified and removed files are staged. The change summary is '
+           'written to %s under the work directory. The other files of the '
+           'last test run are deleted. It requires --work_dir.'
+      % xctest_session.BUNDLE_CHANGES_FILE_NAME)
   optional_arguments.add_argument(
       '--output_dir',
       help='The directory where derived data will go, including:\n'
@@ -99,6 +123,119 @@ def _AddGeneralArguments(parser):
            '2) the screenshots of every test stages (XCUITest).\n'
            'If directory is specified, the directory will not be deleted after '
            'test ends.')
+  optional_arguments.add_argument(
+      '--max_concurrent_sim_boots',
+      type=int,
+      help='The max number of simulators being created or booted at the same '
+           'time by all test runner processes in the host. 0 means unlimited. '
+           'By default, it is %d.'
+      % host_semaphore.GetMaxConcurrency(host_semaphore.SIM_BOOT))
+  optional_arguments.add_argument(
+      '--max_concurrent_test_sessions',
+      type=int,
+      help='The max number of test sessions running at the same time by all '
+           'test runner processes in the host. 0 means unlimited. By default, '
+           'it is unlimited.')
+  optional_arguments.add_argument(
+      '--adaptive_concurrency',
+      action='store_true',
+      help='Adjusts the max number of simulator test sessions running at the '
+           'same time in the host according to the simulator boot latency, '
+           'test startup latency and the test sessions which fail to start. '
+           'The learned value is shared by all test runner processes in the '
+           'host. It is ignored if --max_concurrent_test_sessions is given.')
+  optional_arguments.add_argument(
+      '--startup_timeout_sec',
+      type=int,
+      help='The max seconds from launching xcodebuild to the test starts. 0 '
+           'means unlimited. By default, it is %d.'
+      % xcodebuild_test_executor.GetWatchdogBudget(
+          xcodebuild_test_executor.WatchdogPhase.STARTUP))
+  optional_arguments.add_argument(
+      '--test_inactivity_timeout_sec',
+      type=int,
+      help='The max seconds without any xcodebuild output after the test '
+           'starts, e.g., a test case hangs. 0 means unlimited. By default, it '
+           'is unlimited.')
+  optional_arguments.add_argument(
+      '--total_timeout_sec',
+      type=int,
+      help='The max seconds of running xcodebuild test, including the '
+           'relaunches. 0 means unlimited. By default, it is unlimited.')
+  optional_arguments.add_argument(
+      '--app_deltas_cache_size_mb',
+      type=int,
+      help='The max total size of the EmbeddedAppDeltas directories kept for '
+           'the incremental app installs on real devices. The least recently '
+           'used directories are evicted. 0 means the directories are deleted '
+           'after each test. By default, it is %d.'
+      % (app_deltas_cache.GetMaxTotalBytes() // (1024 * 1024)))
+  optional_arguments.add_argument(
+      '--bundle_store_size_mb',
+      type=int,
+      help='The max total size of the extracted .ipa/.zip archives kept for '
+           'the next test runs of the same archives. The least recently used '
+           'ones are evicted. 0 means the archives are extracted for every '
+           'test run. By default, it is %d.'
+      % (bundle_store.GetMaxTotalBytes() // (1024 * 1024)))
+  optional_arguments.add_argument(
+      '--console_mode',
+      choices=ios_constants.SUPPORTED_CONSOLE_MODES,
+      default=ios_constants.ConsoleMode.FULL,
+      help='How much xcodebuild test output is printed to console. "full" '
+           'prints all output. "failures_only" prints the failures and the '
+           'test summary. "summary" prints the test summary only. The complete '
+           'output is always saved in %s under the output directory.'
+      % xcodebuild_test_executor.OUTPUT_FILE_NAME)
+  optional_arguments.add_argument(
+      '--trace',
+      action='store_true',
+      help='Records the time of the test session phases, e.g., bundle '
+           'preparation, build-for-testing, simulator creation and test '
+           'execution. The trace is saved as %s under the output directory in '
+           'Chrome trace event format, which can be loaded by '
+           'chrome://tracing. It requires --output_dir.'
+      % trace_util.TRACE_FILE_NAME)
+  optional_arguments.add_argument(
+      '--metrics_textfile',
+      help='The path of the file to write the metrics of the run in Prometheus '
+           'text format, e.g., for the textfile collector of node_exporter. '
+           'The file is replaced when the run ends.')
+  optional_arguments.add_argument(
+      '--metrics_statsd_address',
+      help='The address of the StatsD server to send the metrics of the run '
+           'to, in format host:port. The metrics are sent as UDP datagrams '
+           'with DogStatsD tags.')
+  optional_arguments.add_argument(
+      '--disable_run_history',
+      action='store_true',
+      help='Does not append the phase durations, exit code and dimensions of '
+           'the test run to the run history database of the user. See sub '
+           'command `stats`.')
+  optional_arguments.add_argument(
+      '--disable_xctestrun_template_cache',
+      action='store_true',
+      help='Builds the dummy project for every test run instead of reusing the '
+           'xctestrun file and XCTRunner app generated by a previous run with '
+           'the same Xcode, sdk, test type, deployment target and signing '
+           'settings.')
+  optional_arguments.add_argument(
+      '--staging_strategy',
+      choices=ios_constants.SUPPORTED_STAGING_STRATEGIES,
+      default=ios_constants.StagingStrategy.AUTO,
+      help='How the app under test and test bundle are staged into the work '
+           'directory. "auto" clones the files on APFS, otherwise hard links '
+           'them, and copies them if neither works. "clone" and "hardlink" '
+           'only try one of them before copying. "symlink" links the test '
+           'bundle directory. "copy" always copies. The bundles which are '
+           'modified during the test are never hard linked or symlinked.')
+  optional_arguments.add_argument(
+      '--enable_xctestrun_synthesis',
+      action='store_true',
+      help='Experimental. Writes the xctestrun file of XCTest and XCUITest on '
+           'simulator directly with the XCTRunner app template of the sdk '
+           'platform, instead of building the dummy project. If the synthesis '
+           'fails, the dummy project is built.')
 
 
 def _AddTestSubParser(subparsers):
@@ -107,7 +244,8 @@ def _AddTestSubParser(subparsers):
     """The function of sub command `test`."""
     with xctest_session.XctestSession(
         sdk=xctest_session.GetSdk(args.id),
-        work_dir=args.work_dir, output_dir=args.output_dir) as session:
+        work_dir=args.work_dir, output_dir=args.output_dir,
+        persistent_work_dir=args.persistent_work_dir) as session:
       session.Prepare(
           app_under_test=args.app_under_test_path,
           test_bundle=args.test_bundle_path,
@@ -126,7 +264,7 @@ def _AddTestSubParser(subparsers):
       '--id',
       required=True,
       help='The device id. The device can be iOS real device or simulator.')
-  test_parser.set_defaults(func=_Test)
+  test_parser.set_defaults(func=_Test, run_history_command='test')
 
 
 def _AddSimulatorTestSubParser(subparsers):
@@ -135,7 +273,8 @@ def _AddSimulatorTestSubParser(subparsers):
     """The function of running test with new simulator."""
     with xctest_session.XctestSession(
         sdk=ios_constants.SDK.IPHONESIMULATOR,
-        work_dir=args.work_dir, output_dir=args.output_dir) as session:
+        work_dir=args.work_dir, output_dir=args.output_dir,
+        persistent_work_dir=args.persistent_work_dir) as session:
       session.Prepare(
           app_under_test=args.app_under_test_path,
           test_bundle=args.test_bundle_path,
@@ -206,7 +345,96 @@ def _AddSimulatorTestSubParser(subparsers):
       help='The name of the new simulator. By default, it will be the value of '
            'concatenating simulator type with os version. '
            'E.g., NEW_IPHONE_6_PLUS_10_2.')
-  test_parser.set_defaults(func=_SimulatorTest)
+  test_parser.set_defaults(func=_SimulatorTest,
+                           run_history_command='simulator_test')
+
+
+def _AddLogSubParser(subparsers):
+  """Adds sub parser for sub command `log`."""
+  def _Log(args):
+    """The function of sub command `log`."""
+    if not args.output_dir:
+      raise ios_errors.IllegalArgumentError(
+          'The output directory of the test is required. Please provide '
+          '--output_dir.')
+    found = False
+    for log_file_path in test_log_index.FindIndexedLogs(args.output_dir):
+      for output in test_log_index.ReadTestLog(
+          log_file_path, test_identifier=args.test_identifier,
+          suite=args.suite):
+        found = True
+        sys.stdout.write(output)
+    sys.stdout.flush()
+    if not found:
+      logging.error('Can not find the output of %s in %s.',
+                    args.test_identifier or args.suite, args.output_dir)
+      return runner_exit_codes.EXITCODE.ERROR
+    return runner_exit_codes.EXITCODE.SUCCEEDED
+
+  log_parser = subparsers.add_parser(
+      'log',
+      help='Print the output of a test case or a test suite from the '
+           'xcodebuild test logs saved in the output directory of a finished '
+           'test.')
+  log_target = log_parser.add_mutually_exclusive_group(required=True)
+  # The name --test is an ambiguous prefix of the general arguments.
+  log_target.add_argument(
+      '--test_identifier',
+      help='The test case in format Test-Class-Name/Test-Method-Name.')
+  log_target.add_argument(
+      '--suite',
+      help='The test suite name, e.g., the test class name.')
+  log_parser.set_defaults(func=_Log)
+
+
+def _AddStatsSubParser(subparsers):
+  """Adds sub parser for sub command `stats`."""
+  def _Stats(args):
+    """The function of sub command `stats`."""
+    since_time = None
+    if args.since_days is not None:
+      since_time = time.time() - args.since_days * 24 * 3600
+    stats = run_history.GetPhaseStats(
+        phase=args.phase, since_time=since_time, sdk=args.sdk,
+        test_type=args.test_type, device_type=args.device_type,
+        os_version=args.os_version, xcode_version=args.xcode_version)
+    if not stats:
+      logging.error('There is no run in the history matching the filters.')
+      return runner_exit_codes.EXITCODE.ERROR
+    sys.stdout.write('%-24s %8s %10s %10s %10s\n' % (
+        'phase', 'samples', 'p50(s)', 'p95(s)', 'p99(s)'))
+    for phase, samples, p50, p95, p99 in stats:
+      sys.stdout.write('%-24s %8d %10.2f %10.2f %10.2f\n' % (
+          phase, samples, p50, p95, p99))
+    return runner_exit_codes.EXITCODE.SUCCEEDED
+
+  stats_parser = subparsers.add_parser(
+      'stats',
+      help='Print the p50/p95/p99 durations of the test run phases in the run '
+           'history of the user. The general argument --test_type filters the '
+           'runs by test type.')
+  stats_parser.add_argument(
+      '--phase',
+      help='Only prints the phase, e.g., create_simulator, xcodebuild_startup '
+           'or %s for the whole run.' % run_history.TOTAL_PHASE)
+  stats_parser.add_argument(
+      '--sdk',
+      help='Filters the runs by sdk. Supported sdks are %s.'
+      % ios_constants.SUPPORTED_SDKS)
+  stats_parser.add_argument(
+      '--device_type',
+      help='Filters the runs by simulator device type, e.g., iPhone 6.')
+  stats_parser.add_argument(
+      '--os_version',
+      help='Filters the runs by simulator os version, e.g., 10.2.')
+  stats_parser.add_argument(
+      '--xcode_version',
+      help='Filters the runs by Xcode version number, e.g., 941.')
+  stats_parser.add_argument(
+      '--since_days',
+      type=float,
+      help='Only counts the runs in the last days.')
+  stats_parser.set_defaults(func=_Stats)
 
 
 def _BuildParser():
@@ -221,6 +449,8 @@ def _BuildParser():
   subparsers = parser.add_subparsers(help='Sub-commands help')
   _AddTestSubParser(subparsers)
   _AddSimulatorTestSubParser(subparsers)
+  _AddLogSubParser(subparsers)
+  _AddStatsSubParser(subparsers)
   return parser
 
 
@@ -241,7 +471,58 @@ def main(argv):
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
   else:
     logging.basicConfig(format='%(asctime)s %(message)s')
-  exit_code = args.func(args)
+  xcodebuild_test_executor.SetConsoleMode(args.console_mode)
+  staging_util.SetStagingStrategy(args.staging_strategy)
+  if args.trace:
+    trace_util.EnableTracing()
+  if args.metrics_textfile or args.metrics_statsd_address:
+    metrics_util.EnableMetrics(
+        textfile_path=args.metrics_textfile,
+        statsd_address=args.metrics_statsd_address)
+  if args.enable_xctestrun_synthesis:
+    xctestrun.SetXctestrunSynthesisEnabled(True)
+  if args.disable_xctestrun_template_cache:
+    xctestrun_template_cache.SetEnabled(False)
+  if args.bundle_store_size_mb is not None:
+    bundle_store.SetMaxTotalBytes(args.bundle_store_size_mb * 1024 * 1024)
+  if args.app_deltas_cache_size_mb is not None:
+    app_deltas_cache.SetMaxTotalBytes(
+        args.app_deltas_cache_size_mb * 1024 * 1024)
+  for phase, budget_sec in (
+      (xcodebuild_test_executor.WatchdogPhase.STARTUP,
+       args.startup_timeout_sec),
+      (xcodebuild_test_executor.WatchdogPhase.INACTIVITY,
+       args.test_inactivity_timeout_sec),
+      (xcodebuild_test_executor.WatchdogPhase.TOTAL, args.total_timeout_sec)):
+    if budget_sec is not None:
+      xcodebuild_test_executor.SetWatchdogBudget(phase, budget_sec)
+  if args.max_concurrent_sim_boots is not None:
+    host_semaphore.SetMaxConcurrency(
+        host_semaphore.SIM_BOOT, args.max_concurrent_sim_boots)
+  if args.max_concurrent_test_sessions is not None:
+    host_semaphore.SetMaxConcurrency(
+        host_semaphore.TEST_SESSION, args.max_concurrent_test_sessions)
+  elif args.adaptive_concurrency:
+    controller = concurrency_controller.AdaptiveConcurrencyController()
+    concurrency_controller.SetActiveController(controller)
+    host_semaphore.SetMaxConcurrency(
+        host_semaphore.TEST_SESSION, controller.limit)
+  recorder = None
+  if (getattr(args, 'run_history_command', None) and
+      not args.disable_run_history):
+    recorder = run_history.RunHistoryRecorder(args.run_history_command)
+    recorder.Start()
+  # The failed runs are recorded as well, so the exit code is the error one
+  # unless the run returns.
+  exit_code = runner_exit_codes.EXITCODE.ERROR
+  try:
+    exit_code = args.func(args)
+  finally:
+    if recorder:
+      recorder.Finish(exit_code)
+    simctl_client.GetSimctlClient().LogMetrics()
+    subprocess_ledger.LogSummary()
+    metrics_util.Flush()
   logging.info('Done.')
   return exit_code
 
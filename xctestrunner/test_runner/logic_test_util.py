@@ -19,6 +19,7 @@ import sys
 
 from xctestrunner.shared import ios_constants
 from xctestrunner.shared import xcode_info_util
+from xctestrunner.simulator_control import simctl_client
 from xctestrunner.test_runner import runner_exit_codes
 
 _SIMCTL_ENV_VAR_PREFIX = 'SIMCTL_CHILD_'
@@ -43,24 +44,58 @@ def RunLogicTestOnSim(
   Raises:
     ios_errors.SimError: The command to launch logic test has error.
   """
+  simctl_args, simctl_env_vars = _GetLogicTestSimctlArgs(
+      sim_id, test_bundle_path, env_vars, args, tests_to_run)
+  return_code = simctl_client.GetSimctlClient().Popen(
+      simctl_args, env=simctl_env_vars, stdout=sys.stdout,
+      stderr=subprocess.STDOUT).wait()
+  if return_code != 0:
+    return runner_exit_codes.EXITCODE.FAILED
+  return runner_exit_codes.EXITCODE.SUCCEEDED
+
+
+def GetLogicTestCommand(
+    sim_id, test_bundle_path, env_vars=None, args=None, tests_to_run=None):
+  """Gets the command to run logic tests on the simulator.
+
+  The command can be supervised by other executors, e.g.,
+  multiplexed_test_executor.TestSession.
+
+  Args:
+    sim_id: string, the id of the simulator.
+    test_bundle_path: string, the path of the logic test bundle.
+    env_vars: dict, the additionl environment variables passing to test's
+        process.
+    args: array, the additional arguments passing to test's process.
+    tests_to_run: array, the format of each item is TestClass[/TestMethod].
+        If it is empty, then runs with All methods.
+
+  Returns:
+    a tuple of two fields:
+      command: array, the command to run logic tests.
+      env: dict, the environment variables of the command.
+  """
+  simctl_args, simctl_env_vars = _GetLogicTestSimctlArgs(
+      sim_id, test_bundle_path, env_vars, args, tests_to_run)
+  return ['xcrun', 'simctl'] + simctl_args, simctl_env_vars
+
+
+def _GetLogicTestSimctlArgs(
+    sim_id, test_bundle_path, env_vars=None, args=None, tests_to_run=None):
+  """Gets the `xcrun simctl` arguments and the environment of logic tests."""
   simctl_env_vars = {}
   if env_vars:
     for key in env_vars:
       simctl_env_vars[_SIMCTL_ENV_VAR_PREFIX + key] = env_vars[key]
   simctl_env_vars['NSUnbufferedIO'] = 'YES'
-  command = [
-      'xcrun', 'simctl', 'spawn', sim_id,
+  simctl_args = [
+      'spawn', sim_id,
       xcode_info_util.GetXctestToolPath(ios_constants.SDK.IPHONESIMULATOR)]
   if args:
-    command += args
+    simctl_args += args
   if not tests_to_run:
     tests_to_run_str = 'All'
   else:
     tests_to_run_str = ','.join(tests_to_run)
-
-  return_code = subprocess.Popen(
-      command + ['-XCTest', tests_to_run_str, test_bundle_path],
-      env=simctl_env_vars, stdout=sys.stdout, stderr=subprocess.STDOUT).wait()
-  if return_code != 0:
-    return runner_exit_codes.EXITCODE.FAILED
-  return runner_exit_codes.EXITCODE.SUCCEEDED
+  return simctl_args + ['-XCTest', tests_to_run_str, test_bundle_path], (
+      simctl_env_vars)
@@ -0,0 +1,386 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The executor to supervise many test sessions in one thread.
+
+XcodebuildTestExecutor blocks a thread for each test process and runs a
+watchdog thread for each of them. MultiplexedTestExecutor runs the commands of
+many test sessions, e.g., one per device, and multiplexes their output pipes
+and phase deadlines with select() in the calling thread. The result of each
+session is a value of type runner_exit_codes.EXITCODE, the same as
+XcodebuildTestExecutor except that the session is not relaunched.
+
+Example:
+  executor = MultiplexedTestExecutor()
+  for device_id in device_ids:
+    executor.AddSession(TestSession(GetCommand(device_id)))
+  for session, line in executor.IterOutputLines():
+    ...
+  exit_codes = [session.exit_code for session in executor.sessions]
+"""
+
+import logging
+import os
+import select
+import subprocess
+import time
+
+from xctestrunner.shared import ios_constants
+from xctestrunner.shared import subprocess_ledger
+from xctestrunner.simulator_control import simctl_client
+from xctestrunner.test_runner import failure_classifier
+from xctestrunner.test_runner import output_capture
+from xctestrunner.test_runner import runner_exit_codes
+from xctestrunner.test_runner import xcodebuild_test_executor
+
+
+_READ_CHUNK_BYTES = 64 * 1024
+# The interval to check the killed processes whose pipes are held open by
+# their orphan child processes.
+_KILLED_PROCESS_POLL_INTERVAL_SEC = 0.2
+
+WatchdogPhase = xcodebuild_test_executor.WatchdogPhase
+
+
+class TestSession(object):
+  """A test command supervised by MultiplexedTestExecutor.
+
+  The methods Launch, fileno, ReadLines, GetDeadline, Kill, poll and Finish are
+  driven by MultiplexedTestExecutor.
+  """
+
+  def __init__(self, command, env=None, sdk=None, test_type=None,
+               succeeded_signal=None, failed_signal=None,
+               output_file_path=None, budgets_sec=None):
+    """Initializes the TestSession object.
+
+    Args:
+      command: array, the test command, e.g., the command of
+          `xcodebuild test-without-building` or
+          logic_test_util.GetLogicTestCommand.
+      env: dict, the environment variables of the command. By default, it is
+          the environment of this process.
+      sdk: ios_constants.SDK, the sdk of the target device to run test.
+      test_type: ios_constants.TestType, the type of the test.
+      succeeded_signal: string, the signal of command succeeded. If neither
+          succeeded_signal nor failed_signal is given, the result of the
+          started test is decided by the return code of the command.
+      failed_signal: string, the signal of command failed.
+      output_file_path: string, the path of the file to save the output.
+      budgets_sec: dict, the budget in seconds of each WatchdogPhase. It
+          overrides the budgets of xcodebuild_test_executor.GetWatchdogBudget.
+    """
+    self._command = command
+    self._env = dict(os.environ) if env is None else dict(env)
+    self._env['NSUnbufferedIO'] = 'YES'
+    self._sdk = sdk
+    self._test_type = test_type
+    self._succeeded_signal = succeeded_signal
+    self._failed_signal = failed_signal
+    self._output_file_path = output_file_path
+    self._budgets_sec = dict(
+        (phase, xcodebuild_test_executor.GetWatchdogBudget(phase))
+        for phase in (WatchdogPhase.STARTUP, WatchdogPhase.INACTIVITY,
+                      WatchdogPhase.TOTAL))
+    if budgets_sec:
+      self._budgets_sec.update(budgets_sec)
+    self._classifier = failure_classifier.FailureClassifier(
+        test_type=test_type, sdk=sdk,
+        callback=failure_classifier.LogSignatureMatch)
+    self._process = None
+    self._output = None
+    self._partial_line = ''
+    self._launch_time = None
+    self._last_output_time = None
+    self._test_started = False
+    # The startup phase also ends when XCTRunner.app starts for XCUITest, the
+    # same as XcodebuildTestExecutor.
+    self._startup_ended = False
+    self._test_succeeded = False
+    self._test_failed = False
+    self._hung_phase = None
+    self._exit_code = None
+
+  @property
+  def command(self):
+    return self._command
+
+  @property
+  def exit_code(self):
+    """The runner_exit_codes.EXITCODE of the session or None if running."""
+    return self._exit_code
+
+  @property
+  def hung_phase(self):
+    """The WatchdogPhase in which the session hung or None."""
+    return self._hung_phase
+
+  @property
+  def finished(self):
+    return self._exit_code is not None
+
+  def Launch(self):
+    """Launches the command."""
+    self._launch_time = time.time()
+    self._last_output_time = self._launch_time
+    if self._output_file_path:
+      self._output = output_capture.OutputCapture(
+          max_buffer_bytes=0, spool_file_path=self._output_file_path)
+    try:
+      if list(self._command[:2]) == ['xcrun', 'simctl']:
+        # The simctl commands, e.g., the logic test, are counted in the simctl
+        # metrics.
+        self._process = simctl_client.GetSimctlClient().Popen(
+            self._command[2:], env=self._env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+      else:
+        self._process = subprocess_ledger.Popen(
+            self._command, env=self._env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+    finally:
+      if self._process is None and self._output:
+        self._output.Close()
+
+  def fileno(self):
+    """The file descriptor of the output pipe."""
+    return self._process.stdout.fileno()
+
+  def poll(self):
+    """The return code of the command or None if it is running."""
+    return self._process.poll()
+
+  def ReadLines(self):
+    """Reads the available output.
+
+    Returns:
+      a list of the complete lines in the read output. At the end of the
+      output, the last line may not have a line break.
+    """
+    data = os.read(self.fileno(), _READ_CHUNK_BYTES)
+    if not data:
+      lines = [self._partial_line] if self._partial_line else []
+      self._partial_line = ''
+      for line in lines:
+        self._HandleLine(line)
+      self.Finish()
+      return lines
+    self._last_output_time = time.time()
+    self._process.AddOutputBytes(len(data))
+    if self._output:
+      self._output.Write(data)
+    data = self._partial_line + data
+    end = data.rfind('\n') + 1
+    self._partial_line = data[end:]
+    if not end:
+      return []
+    lines = [line + '\n' for line in data[:end - 1].split('\n')]
+    for line in lines:
+      self._HandleLine(line)
+    return lines
+
+  def _HandleLine(self, line):
+    """Matches the signals in the output line."""
+    if not self._test_started:
+      self._classifier.FeedOutputLine(line)
+      if ios_constants.TEST_STARTED_SIGNAL in line:
+        self._test_started = True
+        self._EndStartupPhase()
+      if (self._test_type == ios_constants.TestType.XCUITEST and
+          ios_constants.XCTRUNNER_STARTED_SIGNAL in line):
+        self._EndStartupPhase()
+    else:
+      if self._succeeded_signal and self._succeeded_signal in line:
+        self._test_succeeded = True
+      if self._failed_signal and self._failed_signal in line:
+        self._test_failed = True
+
+  def _EndStartupPhase(self):
+    """Ends the startup phase, then the inactivity phase begins."""
+    if not self._startup_ended:
+      self._startup_ended = True
+      self._last_output_time = time.time()
+
+  def GetDeadline(self):
+    """Gets the phase and the time of the nearest deadline or (None, None)."""
+    if self._hung_phase:
+      return None, None
+    deadlines = []
+    if self._budgets_sec[WatchdogPhase.TOTAL]:
+      deadlines.append((self._launch_time +
+                        self._budgets_sec[WatchdogPhase.TOTAL],
+                        WatchdogPhase.TOTAL))
+    if not self._startup_ended:
+      if self._budgets_sec[WatchdogPhase.STARTUP]:
+        deadlines.append((self._launch_time +
+                          self._budgets_sec[WatchdogPhase.STARTUP],
+                          WatchdogPhase.STARTUP))
+    elif self._budgets_sec[WatchdogPhase.INACTIVITY]:
+      deadlines.append((self._last_output_time +
+                        self._budgets_sec[WatchdogPhase.INACTIVITY],
+                        WatchdogPhase.INACTIVITY))
+    if not deadlines:
+      return None, None
+    deadline, phase = min(deadlines)
+    return phase, deadline
+
+  def Kill(self, phase):
+    """Kills the command hung in the phase."""
+    self._hung_phase = phase
+    logging.warning('The command "%s" hung in the %s phase over %ss. Will kill '
+                    'it directly.', ' '.join(self._command), phase,
+                    self._budgets_sec[phase])
+    try:
+      self._process.terminate()
+    except OSError:
+      # The process has exited.
+      pass
+
+  def Terminate(self):
+    """Terminates the launched command which is not supervised any more."""
+    try:
+      self._process.terminate()
+    except OSError:
+      # The process has exited.
+      pass
+    self._process.wait()
+    self._process.stdout.close()
+    if self._output:
+      self._output.Close()
+
+  def Finish(self):
+    """Waits for the process and decides the exit code."""
+    return_code = self._process.wait()
+    if self._output:
+      self._output.Close()
+    if self._test_started:
+      if self._test_succeeded:
+        self._exit_code = runner_exit_codes.EXITCODE.SUCCEEDED
+      elif self._test_failed:
+        self._exit_code = runner_exit_codes.EXITCODE.FAILED
+      elif (not self._succeeded_signal and not self._failed_signal and
+            not self._hung_phase):
+        self._exit_code = (runner_exit_codes.EXITCODE.SUCCEEDED
+                           if return_code == 0 else
+                           runner_exit_codes.EXITCODE.FAILED)
+      else:
+        self._exit_code = runner_exit_codes.EXITCODE.ERROR
+    elif self._sdk == ios_constants.SDK.IPHONEOS and (
+        self._hung_phase or self._classifier.classification ==
+        failure_classifier.Classification.REBOOT_DEVICE):
+      self._exit_code = runner_exit_codes.EXITCODE.NEED_REBOOT_DEVICE
+    elif (self._classifier.classification ==
+          failure_classifier.Classification.RECREATE_SIM):
+      self._exit_code = runner_exit_codes.EXITCODE.NEED_RECREATE_SIM
+    else:
+      self._exit_code = runner_exit_codes.EXITCODE.TEST_NOT_START
+    self._process.stdout.close()
+
+
+class MultiplexedTestExecutor(object):
+  """Runs many test sessions and supervises them in one thread."""
+
+  def __init__(self):
+    self._sessions = []
+
+  @property
+  def sessions(self):
+    """The list of the TestSession objects in the order of being added."""
+    return list(self._sessions)
+
+  def AddSession(self, session):
+    """Adds the test session. It is launched when the execution starts.
+
+    Args:
+      session: TestSession, the test session.
+    """
+    self._sessions.append(session)
+
+  def Execute(self):
+    """Runs all test sessions until they finish.
+
+    Returns:
+      a list of runner_exit_codes.EXITCODE of the sessions in the order of
+      being added.
+    """
+    for _ in self.IterOutputLines():
+      pass
+    return [session.exit_code for session in self._sessions]
+
+  def IterOutputLines(self):
+    """Runs all test sessions and iterates their output lines.
+
+    The sessions are only driven while the iteration goes on. If the iterator
+    is closed, abandoned or raises before all sessions finish, the running
+    sessions are terminated, so no command is left running without
+    supervision.
+
+    Yields:
+      a tuple of the TestSession object and a line of its output.
+    """
+    launched_sessions = []
+    try:
+      for session in self._sessions:
+        if not session.finished:
+          session.Launch()
+          launched_sessions.append(session)
+      running_sessions = list(launched_sessions)
+      while running_sessions:
+        timeout_sec = self._HandleDeadlines(running_sessions)
+        running_sessions = [session for session in running_sessions
+                            if not session.finished]
+        if not running_sessions:
+          break
+        readable_fds, _, _ = select.select(
+            [session.fileno() for session in running_sessions],
+            [], [], timeout_sec)
+        readable_fds = set(readable_fds)
+        for session in running_sessions:
+          if session.fileno() in readable_fds:
+            for line in session.ReadLines():
+              yield session, line
+        running_sessions = [session for session in running_sessions
+                            if not session.finished]
+    finally:
+      for session in launched_sessions:
+        if not session.finished:
+          session.Terminate()
+
+  def _HandleDeadlines(self, running_sessions):
+    """Kills the hung sessions and gets the timeout of the next select.
+
+    Returns:
+      the seconds to the nearest deadline or None if there is no deadline.
+    """
+    now = time.time()
+    timeout_sec = None
+    for session in running_sessions:
+      if session.hung_phase:
+        if session.poll() is not None:
+          # The orphan child processes of the killed command may hold the pipe
+          # open, so the end of the output may never come.
+          session.Finish()
+          continue
+        session_timeout_sec = _KILLED_PROCESS_POLL_INTERVAL_SEC
+      else:
+        phase, deadline = session.GetDeadline()
+        if phase is None:
+          continue
+        if deadline <= now:
+          session.Kill(phase)
+          session_timeout_sec = _KILLED_PROCESS_POLL_INTERVAL_SEC
+        else:
+          session_timeout_sec = deadline - now
+      if timeout_sec is None or session_timeout_sec < timeout_sec:
+        timeout_sec = session_timeout_sec
+    return timeout_sec
@@ -0,0 +1,130 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The bounded-memory capture of a command's output.
+
+Only the last bytes of the output are kept in memory, in a ring buffer of
+chunks. The complete output can be spooled to a file on disk, so a long and
+verbose test session does not grow the memory of the test runner.
+"""
+
+import collections
+import io
+import os
+
+
+_DEFAULT_MAX_BUFFER_BYTES = 8 * 1024 * 1024
+
+
+class OutputCapture(object):
+  """Captures the output in a ring buffer and an optional spool file."""
+
+  def __init__(self, max_buffer_bytes=_DEFAULT_MAX_BUFFER_BYTES,
+               spool_file_path=None):
+    """Initializes the OutputCapture object.
+
+    Args:
+      max_buffer_bytes: int, the max bytes of the output kept in memory. If it
+          is 0, no output is kept in memory.
+      spool_file_path: string, the path of the file to save the complete
+          output. If it is not given, the output is only kept in memory.
+    """
+    self._max_buffer_bytes = max_buffer_bytes
+    self._chunks = collections.deque()
+    self._buffer_bytes = 0
+    self._total_bytes = 0
+    self._spool_file_path = spool_file_path
+    self._spool_file = None
+    if spool_file_path:
+      spool_dir = os.path.dirname(spool_file_path)
+      if spool_dir and not os.path.exists(spool_dir):
+        os.makedirs(spool_dir)
+      self._spool_file = open(spool_file_path, 'wb')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.Close()
+
+  @property
+  def spool_file_path(self):
+    """The path of the file with the complete output or None."""
+    return self._spool_file_path
+
+  @property
+  def total_bytes(self):
+    """The number of the bytes written to the capture."""
+    return self._total_bytes
+
+  @property
+  def dropped_bytes(self):
+    """The number of the bytes dropped from the ring buffer."""
+    return self._total_bytes - self._buffer_bytes
+
+  def Write(self, data):
+    """Writes the data to the capture.
+
+    Args:
+      data: string, the data to write.
+    """
+    if not data:
+      return
+    self._total_bytes += len(data)
+    if self._spool_file:
+      self._spool_file.write(data)
+    if self._max_buffer_bytes <= 0:
+      return
+    if len(data) >= self._max_buffer_bytes:
+      self._chunks.clear()
+      data = data[-self._max_buffer_bytes:]
+      self._buffer_bytes = 0
+    self._chunks.append(data)
+    self._buffer_bytes += len(data)
+    while self._buffer_bytes > self._max_buffer_bytes:
+      overflow_bytes = self._buffer_bytes - self._max_buffer_bytes
+      chunk = self._chunks[0]
+      if len(chunk) <= overflow_bytes:
+        self._chunks.popleft()
+        self._buffer_bytes -= len(chunk)
+      else:
+        self._chunks[0] = chunk[overflow_bytes:]
+        self._buffer_bytes -= overflow_bytes
+
+  def Flush(self):
+    """Flushes the spool file."""
+    if self._spool_file:
+      self._spool_file.flush()
+
+  def Close(self):
+    """Closes the spool file. The capture can still be read after closing."""
+    if self._spool_file:
+      self._spool_file.close()
+      self._spool_file = None
+
+  def GetTail(self):
+    """Gets the last bytes of the output kept in memory."""
+    return ''.join(self._chunks)
+
+  def Open(self):
+    """Opens the captured output for reading.
+
+    Returns:
+      a file-like object. It reads the complete output from the spool file if
+      there is one, otherwise it reads the output kept in memory.
+    """
+    if self._spool_file_path:
+      self.Flush()
+      return open(self._spool_file_path, 'rb')
+    return io.BytesIO(self.GetTail())
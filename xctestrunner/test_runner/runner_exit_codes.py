@@ -26,7 +26,8 @@ EXITCODE = enum(
     TEST_NOT_START=12,
     NEED_REBOOT_DEVICE=13,
     NEED_RECREATE_SIM=14,
-    SIM_ERROR=15)
+    SIM_ERROR=15,
+    CRASHED_ON_SIM=16)
 
 EXITCODE_INFOS = {
     EXITCODE.SUCCEEDED: 'Test succeed',
@@ -36,4 +37,6 @@ EXITCODE_INFOS = {
     EXITCODE.TEST_NOT_START: 'Test has not started',
     EXITCODE.NEED_REBOOT_DEVICE: 'Need reboot the device to recover it',
     EXITCODE.NEED_RECREATE_SIM: 'Need recreate a new simulator to run test',
-    EXITCODE.SIM_ERROR: 'The simulator has error'}
+    EXITCODE.SIM_ERROR: 'The simulator has error',
+    EXITCODE.CRASHED_ON_SIM: ('The app under test or xctest crashed on '
+                              'simulator before the test started')}
@@ -0,0 +1,308 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The incremental parser of the test events in xcodebuild test output.
+
+The parser turns the XCTest log lines into typed events as soon as the lines
+are printed, e.g.,
+  Test Suite 'FooTests' started at 2017-10-18 10:00:00.000
+  Test Case '-[FooTests testBar]' started.
+  /path/FooTests.m:12: error: -[FooTests testBar] : XCTAssertTrue failed
+  Test Case '-[FooTests testBar]' failed (0.123 seconds).
+  Test Suite 'FooTests' failed at 2017-10-18 10:00:00.123.
+The events can be written to a JSON lines file and read back by other tools.
+"""
+
+import json
+import re
+import time
+
+
+def enum(**enums):
+  return type('Enum', (), enums)
+
+EventType = enum(
+    SUITE_STARTED='suite_started',
+    SUITE_FINISHED='suite_finished',
+    CASE_STARTED='case_started',
+    CASE_FINISHED='case_finished',
+    # The error line printed by XCTest or xcodebuild. If it is printed in a
+    # test case, the event has the test case's class and method.
+    ERROR='error')
+TestStatus = enum(PASSED='passed', FAILED='failed', SKIPPED='skipped')
+
+_SUITE_STARTED_PATTERN = re.compile(
+    r"^Test Suite '(?P<suite>.+)' started at")
+_SUITE_FINISHED_PATTERN = re.compile(
+    r"^Test Suite '(?P<suite>.+)' (?P<status>passed|failed) at")
+_CASE_STARTED_PATTERN = re.compile(
+    r"^Test Case '-\[(?P<class>\S+) (?P<method>\S+)\]' started\.")
+_CASE_FINISHED_PATTERN = re.compile(
+    r"^Test Case '-\[(?P<class>\S+) (?P<method>\S+)\]' "
+    r'(?P<status>passed|failed|skipped) \((?P<duration>[0-9.]+) seconds\)')
+_ERROR_PATTERN = re.compile(
+    r'^\s*(?:(?P<file>[^:]+):(?P<line>\d+): )?error: '
+    r'(?:-\[(?P<class>\S+) (?P<method>\S+)\] : )?(?P<message>.*)$')
+
+
+class TestEvent(object):
+  """A test event parsed from xcodebuild test output."""
+
+  def __init__(self, event_type, timestamp=None, suite=None, test_class=None,
+               test_method=None, status=None, duration_sec=None, message=None,
+               file_path=None, line_number=None):
+    """Initializes the TestEvent object.
+
+    Args:
+      event_type: EventType, the type of the event.
+      timestamp: float, the time when the event was parsed. By default, it is
+          now.
+      suite: string, the name of the test suite.
+      test_class: string, the test class name, without the Swift module name.
+      test_method: string, the test method name.
+      status: TestStatus, the status of the finished test suite or test case.
+      duration_sec: float, the duration of the finished test case.
+      message: string, the error message.
+      file_path: string, the source file of the error.
+      line_number: int, the source line of the error.
+    """
+    self.event_type = event_type
+    self.timestamp = time.time() if timestamp is None else timestamp
+    self.suite = suite
+    self.test_class = test_class
+    self.test_method = test_method
+    self.status = status
+    self.duration_sec = duration_sec
+    self.message = message
+    self.file_path = file_path
+    self.line_number = line_number
+
+  @property
+  def test_identifier(self):
+    """The identifier of the test case or None if it is not about a test case.
+
+    The format is Test-Class-Name/Test-Method-Name.
+    """
+    if not self.test_class or not self.test_method:
+      return None
+    return '%s/%s' % (self.test_class, self.test_method)
+
+  def ToDict(self):
+    """Converts the event to a dict without the unset fields."""
+    return dict((key, value) for key, value in self.__dict__.items()
+                if value is not None)
+
+  @classmethod
+  def FromDict(cls, event_dict):
+    """Creates the event from the dict converted by ToDict."""
+    return cls(**event_dict)
+
+  def __repr__(self):
+    return '<TestEvent %s>' % self.ToDict()
+
+
+class TestEventParser(object):
+  """Parses the test events from xcodebuild test output line by line."""
+
+  def __init__(self, callback=None):
+    """Initializes the TestEventParser object.
+
+    Args:
+      callback: function, called with a TestEvent object at the moment the
+          event is parsed.
+    """
+    self._callback = callback
+    self._current_test_class = None
+    self._current_test_method = None
+
+  @property
+  def current_test_identifier(self):
+    """The identifier of the running test case or None.
+
+    The format is Test-Class-Name/Test-Method-Name.
+    """
+    if not self._current_test_class:
+      return None
+    return '%s/%s' % (self._current_test_class, self._current_test_method)
+
+  def Feed(self, line):
+    """Feeds a line of xcodebuild test output.
+
+    Args:
+      line: string, the line of the output.
+
+    Returns:
+      the TestEvent object parsed from the line or None.
+    """
+    event = self._Parse(line.rstrip('\r\n'))
+    if event and self._callback:
+      self._callback(event)
+    return event
+
+  def _Parse(self, line):
+    """Parses the line to a TestEvent object."""
+    if line.startswith('Test Case '):
+      match = _CASE_STARTED_PATTERN.match(line)
+      if match:
+        self._current_test_class = _StripModuleName(match.group('class'))
+        self._current_test_method = match.group('method')
+        return TestEvent(EventType.CASE_STARTED,
+                         test_class=self._current_test_class,
+                         test_method=self._current_test_method)
+      match = _CASE_FINISHED_PATTERN.match(line)
+      if match:
+        self._current_test_class = None
+        self._current_test_method = None
+        return TestEvent(EventType.CASE_FINISHED,
+                         test_class=_StripModuleName(match.group('class')),
+                         test_method=match.group('method'),
+                         status=match.group('status'),
+                         duration_sec=float(match.group('duration')))
+      return None
+    if line.startswith('Test Suite '):
+      match = _SUITE_STARTED_PATTERN.match(line)
+      if match:
+        return TestEvent(EventType.SUITE_STARTED, suite=match.group('suite'))
+      match = _SUITE_FINISHED_PATTERN.match(line)
+      if match:
+        return TestEvent(EventType.SUITE_FINISHED, suite=match.group('suite'),
+                         status=match.group('status'))
+      return None
+    if 'error: ' not in line:
+      return None
+    match = _ERROR_PATTERN.match(line)
+    if not match:
+      return None
+    test_class = self._current_test_class
+    test_method = self._current_test_method
+    if match.group('class'):
+      test_class = _StripModuleName(match.group('class'))
+      test_method = match.group('method')
+    line_number = match.group('line')
+    return TestEvent(EventType.ERROR,
+                     test_class=test_class,
+                     test_method=test_method,
+                     message=match.group('message'),
+                     file_path=match.group('file'),
+                     line_number=int(line_number) if line_number else None)
+
+
+class TestProgressTracker(object):
+  """Tracks the progress of the test cases from the test events.
+
+  A test case is interrupted if it started but did not finish, e.g., the app
+  crashed or the test hung in it.
+  """
+
+  def __init__(self):
+    self._finished_test_identifiers = []
+    self._failed_test_identifiers = []
+    self._interrupted_test_identifiers = []
+    self._running_test_identifier = None
+
+  @property
+  def finished_test_identifiers(self):
+    """The list of the finished test cases in the order of finishing."""
+    return list(self._finished_test_identifiers)
+
+  @property
+  def failed_test_identifiers(self):
+    """The list of the failed test cases, including the interrupted ones."""
+    return list(self._failed_test_identifiers)
+
+  @property
+  def interrupted_test_identifiers(self):
+    """The list of the interrupted test cases."""
+    return list(self._interrupted_test_identifiers)
+
+  @property
+  def running_test_identifier(self):
+    """The test case which started but has not finished or None."""
+    return self._running_test_identifier
+
+  def HandleEvent(self, event):
+    """Handles the test event. It can be used as the parser's callback."""
+    if event.event_type == EventType.CASE_STARTED:
+      if self._running_test_identifier:
+        # The previous test case was interrupted and xcodebuild relaunched the
+        # test after it.
+        self.MarkRunningTestInterrupted()
+      self._running_test_identifier = event.test_identifier
+    elif event.event_type == EventType.CASE_FINISHED:
+      self._running_test_identifier = None
+      self._finished_test_identifiers.append(event.test_identifier)
+      if event.status == TestStatus.FAILED:
+        self._failed_test_identifiers.append(event.test_identifier)
+
+  def MarkRunningTestInterrupted(self):
+    """Marks the running test case as interrupted and failed.
+
+    Returns:
+      the identifier of the interrupted test case or None if no test case is
+      running.
+    """
+    test_identifier = self._running_test_identifier
+    if test_identifier:
+      self._running_test_identifier = None
+      self._finished_test_identifiers.append(test_identifier)
+      self._failed_test_identifiers.append(test_identifier)
+      self._interrupted_test_identifiers.append(test_identifier)
+    return test_identifier
+
+
+class TestEventWriter(object):
+  """Writes the test events to a JSON lines file."""
+
+  def __init__(self, file_path):
+    """Initializes the TestEventWriter object.
+
+    Args:
+      file_path: string, the path of the JSON lines file. The existing file will
+          be overwritten.
+    """
+    self._file = open(file_path, 'w')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.Close()
+
+  def Write(self, event):
+    """Writes the event as a line. It can be used as the parser's callback."""
+    self._file.write(json.dumps(event.ToDict(), sort_keys=True) + '\n')
+    self._file.flush()
+
+  def Close(self):
+    self._file.close()
+
+
+def ReadTestEvents(file_path):
+  """Reads the test events from the JSON lines file.
+
+  Args:
+    file_path: string, the path of the file written by TestEventWriter.
+
+  Yields:
+    TestEvent objects in the order of being parsed.
+  """
+  with open(file_path) as events_file:
+    for line in events_file:
+      if line.strip():
+        yield TestEvent.FromDict(json.loads(line))
+
+
+def _StripModuleName(test_class):
+  """Strips the Swift module name in the test class name."""
+  return test_class.rsplit('.', 1)[-1]
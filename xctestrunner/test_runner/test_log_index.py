@@ -0,0 +1,138 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The index of the byte ranges of each test in the xcodebuild test log.
+
+The index is built from the test events while the log is written and saved as
+a JSON file next to the log:
+  {
+    "suites": {"FooTests": [[start, end], ...]},
+    "tests": {"FooTests/testBar": [[start, end], ...]}
+  }
+The range of a test case starts at its "Test Case ... started." line and ends
+after its "Test Case ... passed/failed" line. A test may have several ranges if
+it runs several times. The output of a test can be read with one seek.
+"""
+
+import glob
+import json
+import os
+
+from xctestrunner.test_runner import test_event_parser
+
+
+_INDEX_FILE_SUFFIX = '.index.json'
+
+
+class TestLogIndexBuilder(object):
+  """Builds the index of the byte ranges of each test in the log."""
+
+  def __init__(self):
+    self._suites = {}
+    self._tests = {}
+    self._open_suites = {}
+    self._open_test = None
+
+  def HandleEvent(self, event, line_start_offset, line_end_offset):
+    """Handles the test event parsed from a line of the log.
+
+    Args:
+      event: test_event_parser.TestEvent, the event parsed from the line.
+      line_start_offset: int, the byte offset of the line in the log.
+      line_end_offset: int, the byte offset after the line in the log.
+    """
+    event_type = event.event_type
+    if event_type == test_event_parser.EventType.CASE_STARTED:
+      self._CloseTest(line_start_offset)
+      self._open_test = (event.test_identifier, line_start_offset)
+    elif event_type == test_event_parser.EventType.CASE_FINISHED:
+      self._CloseTest(line_end_offset)
+    elif event_type == test_event_parser.EventType.SUITE_STARTED:
+      self._open_suites[event.suite] = line_start_offset
+    elif event_type == test_event_parser.EventType.SUITE_FINISHED:
+      start_offset = self._open_suites.pop(event.suite, None)
+      if start_offset is not None:
+        self._suites.setdefault(event.suite, []).append(
+            [start_offset, line_end_offset])
+
+  def Write(self, index_file_path, log_end_offset):
+    """Writes the index to the file.
+
+    Args:
+      index_file_path: string, the path of the index file.
+      log_end_offset: int, the size of the log. The unfinished test, e.g., the
+          crashed one, ends at the end of the log.
+    """
+    self._CloseTest(log_end_offset)
+    suites = dict(self._suites)
+    for suite, start_offset in self._open_suites.items():
+      suites.setdefault(suite, []).append([start_offset, log_end_offset])
+    temp_file_path = index_file_path + '.tmp'
+    with open(temp_file_path, 'w') as index_file:
+      json.dump({'suites': suites, 'tests': self._tests}, index_file)
+    os.rename(temp_file_path, index_file_path)
+
+  def _CloseTest(self, end_offset):
+    """Closes the range of the running test."""
+    if self._open_test:
+      test_identifier, start_offset = self._open_test
+      self._tests.setdefault(test_identifier, []).append(
+          [start_offset, end_offset])
+      self._open_test = None
+
+
+def GetIndexFilePath(log_file_path):
+  """Gets the path of the index file of the log."""
+  return log_file_path + _INDEX_FILE_SUFFIX
+
+
+def ReadTestLog(log_file_path, test_identifier=None, suite=None):
+  """Reads the output of a test case or a test suite from the log.
+
+  Args:
+    log_file_path: string, the path of the log with an index file.
+    test_identifier: string, the test case in format
+        Test-Class-Name/Test-Method-Name.
+    suite: string, the name of the test suite. It is used if test_identifier is
+        not given.
+
+  Returns:
+    a list of string, the output of each run of the test in the log.
+  """
+  with open(GetIndexFilePath(log_file_path)) as index_file:
+    index = json.load(index_file)
+  if test_identifier:
+    ranges = index['tests'].get(test_identifier, [])
+  else:
+    ranges = index['suites'].get(suite, [])
+  outputs = []
+  with open(log_file_path, 'rb') as log_file:
+    for start_offset, end_offset in ranges:
+      log_file.seek(start_offset)
+      outputs.append(log_file.read(end_offset - start_offset))
+  return outputs
+
+
+def FindIndexedLogs(output_dir):
+  """Finds the logs with index files in the output directory.
+
+  Args:
+    output_dir: string, the directory of the logs.
+
+  Returns:
+    a sorted list of the paths of the logs.
+  """
+  return sorted(
+      index_file_path[:-len(_INDEX_FILE_SUFFIX)] for index_file_path in
+      glob.glob(os.path.join(output_dir, '*' + _INDEX_FILE_SUFFIX)))
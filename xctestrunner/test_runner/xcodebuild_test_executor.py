@@ -14,81 +14,344 @@
 
 """Helper class for running test by xcodebuild tool."""
 
-import io
 import logging
 import os
 import random
 import re
-import shutil
+import select
 import subprocess
 import sys
 import threading
 import time
 
+from xctestrunner.shared import app_deltas_cache
+from xctestrunner.shared import host_semaphore
 from xctestrunner.shared import ios_constants
 from xctestrunner.shared import ios_errors
+from xctestrunner.shared import metrics_util
+from xctestrunner.shared import subprocess_ledger
+from xctestrunner.shared import trace_util
 from xctestrunner.shared import xcode_info_util
 from xctestrunner.simulator_control import simulator_util
+from xctestrunner.test_runner import concurrency_controller
+from xctestrunner.test_runner import failure_classifier
+from xctestrunner.test_runner import output_capture
 from xctestrunner.test_runner import runner_exit_codes
+from xctestrunner.test_runner import test_event_parser
+from xctestrunner.test_runner import test_log_index
 
 
+# The name of the file in the derived data directory to save the complete
+# xcodebuild test output.
+OUTPUT_FILE_NAME = 'xcodebuild_test.log'
+# The name of the file in the derived data directory to save the test events.
+TEST_EVENTS_FILE_NAME = 'test_events.jsonl'
+
 _XCODEBUILD_TEST_STARTUP_TIMEOUT_SEC = 150
 _SIM_TEST_MAX_ATTEMPTS = 3
-_TAIL_SIM_LOG_LINE = 200
-_BACKGROUND_TEST_RUNNER_ERROR = 'Failed to background test runner'
-_PROCESS_EXISTED_OR_CRASHED_ERROR = ('The process did launch, but has since '
-                                     'exited or crashed.')
-_REQUEST_DENIED_ERROR = ('The request was denied by service delegate '
-                         '(SBMainWorkspace) for reason')
-_APP_UNKNOWN_TO_FRONTEND_PATTERN = re.compile(
-    'Application ".*" is unknown to FrontBoard.')
-_INIT_SIM_SERVICE_ERROR = 'Failed to initiate service connection to simulator'
+_SIM_LOG_POLL_INTERVAL_SEC = 0.5
+_OUTPUT_READ_CHUNK_BYTES = 64 * 1024
+_CONSOLE_FLUSH_INTERVAL_SEC = 0.2
+_CONSOLE_FLUSH_BYTES = 64 * 1024
+# Gets the bundle id of the crashed app from the crash log in system.log.
+_CRASHED_APP_BUNDLE_ID_PATTERN = re.compile(r'UIKitApplication:([^\[\)]+)')
+_XCTEST_BUNDLE = 'xctest'
+# The patterns of the output lines printed to console in each console mode.
+# The lines of the summary are also printed in the failures_only mode.
+_CONSOLE_SUMMARY_PATTERN = re.compile(
+    r"^(Test Suite '.+' (started|passed|failed)|\s*Executed \d+ tests?|"
+    r'\*\* .+ \*\*)')
+_CONSOLE_FAILURE_PATTERN = re.compile(
+    r'(error:|\bfailed\b|\bcrash|Restarting after unexpected exit)',
+    re.IGNORECASE)
+
+WatchdogPhase = ios_constants.enum(
+    STARTUP='startup', INACTIVITY='inactivity', TOTAL='total')
+
+_console_mode = ios_constants.ConsoleMode.FULL
+# The budgets of the phase watchdog in seconds. See PhaseWatchdogThread.
+_watchdog_budgets_sec = {
+    WatchdogPhase.STARTUP: _XCODEBUILD_TEST_STARTUP_TIMEOUT_SEC,
+    WatchdogPhase.INACTIVITY: 0,
+    WatchdogPhase.TOTAL: 0,
+}
+
+
+class PhaseWatchdogThread(threading.Thread):
+  """The thread class that kills the xcodebuild process hung in a phase.
+
+  The watchdog guards three budgets:
+    startup: from the launch of the process to the test starts.
+    inactivity: the longest time without any output after the test starts.
+    total: from the given start time to the process ends.
+  The thread sleeps on a condition until the nearest deadline instead of
+  polling. If a budget expires, the thread kills the given xcodebuild process
+  and records the phase. Budgets of None or 0 are not guarded.
+
+  The thread will stop gracefully when it is called Terminate().
+  """
+
+  def __init__(self, xcodebuild_test_popen,
+               startup_timeout_sec=_XCODEBUILD_TEST_STARTUP_TIMEOUT_SEC,
+               inactivity_timeout_sec=None, total_timeout_sec=None,
+               start_time=None):
+    """Initializes the PhaseWatchdogThread object.
+
+    Args:
+      xcodebuild_test_popen: subprocess.Popen, the xcodebuild process.
+      startup_timeout_sec: float, the budget of the startup phase.
+      inactivity_timeout_sec: float, the budget of no output after the test
+          starts.
+      total_timeout_sec: float, the budget of the total run time.
+      start_time: float, the start time of the total run time. By default, it
+          is now.
+    """
+    super(PhaseWatchdogThread, self).__init__()
+    self.daemon = True
+    self._xcodebuild_test_popen = xcodebuild_test_popen
+    self._startup_timeout_sec = startup_timeout_sec
+    self._inactivity_timeout_sec = inactivity_timeout_sec
+    self._total_timeout_sec = total_timeout_sec
+    now = time.time()
+    self._launch_time = now
+    self._start_time = now if start_time is None else start_time
+    self._last_output_time = now
+    self._test_started = False
+    self._terminate = False
+    self._expired_phase = None
+    self._condition = threading.Condition()
+
+  def run(self):
+    with self._condition:
+      while not self._terminate:
+        phase, deadline = self._GetNearestDeadline()
+        if phase is None:
+          self._condition.wait()
+          continue
+        now = time.time()
+        if now < deadline:
+          self._condition.wait(deadline - now)
+          continue
+        self._expired_phase = phase
+        break
+    if self._expired_phase:
+      logging.warning(
+          'The xcodebuild command hung in the %s phase over %ss. Will kill the '
+          'command directly.', self._expired_phase, self.expired_budget_sec)
+      try:
+        self._xcodebuild_test_popen.terminate()
+      except OSError:
+        # The process has exited.
+        pass
+
+  def NotifyOutput(self):
+    """Notifies the process printed output. It is cheap to call per line."""
+    # The inactivity deadline is only moved later, so the waiting thread does
+    # not need to be woken up. It will re-check the deadline when it wakes.
+    self._last_output_time = time.time()
+
+  def NotifyTestStarted(self):
+    """Notifies the test has started, which ends the startup phase."""
+    with self._condition:
+      if not self._test_started:
+        self._test_started = True
+        self._last_output_time = time.time()
+        self._condition.notify()
+
+  def Terminate(self):
+    """Terminates this thread."""
+    with self._condition:
+      self._terminate = True
+      self._condition.notify()
 
+  @property
+  def expired_phase(self):
+    """The WatchdogPhase whose budget expired or None."""
+    return self._expired_phase
 
-class CheckXcodebuildStuckThread(threading.Thread):
-  """The thread class that checking if xcodebuild process stucks.
+  @property
+  def expired_budget_sec(self):
+    """The budget in seconds of the expired phase or None."""
+    return {
+        WatchdogPhase.STARTUP: self._startup_timeout_sec,
+        WatchdogPhase.INACTIVITY: self._inactivity_timeout_sec,
+        WatchdogPhase.TOTAL: self._total_timeout_sec,
+    }.get(self._expired_phase)
+
+  def _GetNearestDeadline(self):
+    """Gets the phase and the time of the nearest deadline.
+
+    Returns:
+      a tuple of the WatchdogPhase and the deadline, or (None, None) if no
+      budget is guarded.
+    """
+    deadlines = []
+    if self._total_timeout_sec:
+      deadlines.append(
+          (self._start_time + self._total_timeout_sec, WatchdogPhase.TOTAL))
+    if not self._test_started:
+      if self._startup_timeout_sec:
+        deadlines.append((self._launch_time + self._startup_timeout_sec,
+                          WatchdogPhase.STARTUP))
+    elif self._inactivity_timeout_sec:
+      deadlines.append((self._last_output_time + self._inactivity_timeout_sec,
+                        WatchdogPhase.INACTIVITY))
+    if not deadlines:
+      return None, None
+    deadline, phase = min(deadlines)
+    return phase, deadline
+
+
+class SimLogCrashWatcherThread(threading.Thread):
+  """The thread class that watches the crash in the simulator's system.log.
+
+  The thread follows the log from the given byte offset and feeds the new lines
+  to the failure classifier. Each byte of the log is read only once. If a crash
+  signature is matched before the thread is called Terminate(), it will kill the
+  given xcodebuild process directly instead of waiting for xcodebuild's own
+  timeout.
 
   The thread will stop gracefully when it is called Terminate() or the given
-  process is terminated or reaching the given timeout. If reaching the given
-  timeout, this thread will also kill the given xcodebuild process.
+  process is terminated. The lines written before that are still fed.
   """
 
-  def __init__(self, xcodebuild_test_popen,
-               timeout_sec=_XCODEBUILD_TEST_STARTUP_TIMEOUT_SEC):
-    super(CheckXcodebuildStuckThread, self).__init__()
+  def __init__(self, xcodebuild_test_popen, sim_log_path, start_offset,
+               classifier, poll_interval_sec=_SIM_LOG_POLL_INTERVAL_SEC):
+    """Initializes the SimLogCrashWatcherThread object.
+
+    Args:
+      xcodebuild_test_popen: subprocess.Popen, the xcodebuild process.
+      sim_log_path: string, the path of the simulator's system.log.
+      start_offset: int, the byte offset of the log to start watching. It
+          should be recorded before the xcodebuild process is launched.
+      classifier: failure_classifier.FailureClassifier, the classifier to feed
+          the log lines.
+      poll_interval_sec: float, the interval of checking the new log lines.
+    """
+    super(SimLogCrashWatcherThread, self).__init__()
+    self.daemon = True
     self._xcodebuild_test_popen = xcodebuild_test_popen
-    self._terminate = False
-    self._is_xcodebuild_stuck = False
-    self._timeout_sec = timeout_sec
+    self._sim_log_path = sim_log_path
+    self._offset = start_offset
+    self._partial_line = ''
+    self._classifier = classifier
+    self._poll_interval_sec = poll_interval_sec
+    self._terminate_event = threading.Event()
+    self._crash_match = None
+    self._is_xcodebuild_aborted = False
 
   def run(self):
-    start_time = time.time()
-    while (not self._terminate and
-           start_time + self._timeout_sec >= time.time() and
-           self._xcodebuild_test_popen.poll() is None):
-      time.sleep(2)
-    if not self._terminate and start_time + self._timeout_sec < time.time():
-      logging.warning(
-          'The xcodebuild command got stuck and has not started test in %d. '
-          'Will kill the command directly.', self._timeout_sec)
-      self._is_xcodebuild_stuck = True
-      self._xcodebuild_test_popen.terminate()
+    while True:
+      stopping = (self._terminate_event.is_set() or
+                  self._xcodebuild_test_popen.poll() is not None)
+      crash_match = self._ReadNewLines()
+      if crash_match and not self._crash_match:
+        self._crash_match = crash_match
+        if not stopping:
+          logging.warning(
+              'Found crash on simulator before the test started. Will kill the '
+              'xcodebuild command directly: %s', crash_match.line.strip())
+          self._is_xcodebuild_aborted = True
+          self._xcodebuild_test_popen.terminate()
+          return
+      if stopping:
+        return
+      self._terminate_event.wait(self._poll_interval_sec)
 
   def Terminate(self):
     """Terminates this thread."""
-    self._terminate = True
+    self._terminate_event.set()
 
   @property
-  def is_xcodebuild_stuck(self):
-    """If the xcodebuild test command is stuck in timeout."""
-    return self._is_xcodebuild_stuck
+  def crash_match(self):
+    """The SignatureMatch of the first crash or None if there is no crash."""
+    return self._crash_match
+
+  @property
+  def is_xcodebuild_aborted(self):
+    """If the xcodebuild test command is killed for the crash."""
+    return self._is_xcodebuild_aborted
+
+  def _ReadNewLines(self):
+    """Feeds the lines appended since the last read to the classifier.
+
+    Returns:
+      the first SignatureMatch in the new lines or None.
+    """
+    try:
+      log_size = os.path.getsize(self._sim_log_path)
+    except OSError:
+      # The log does not exist until the simulator is booted.
+      return None
+    if log_size < self._offset:
+      # The log was truncated or rotated.
+      self._offset = 0
+      self._partial_line = ''
+    if log_size == self._offset:
+      return None
+    with open(self._sim_log_path, 'rb') as sim_log:
+      sim_log.seek(self._offset)
+      data = sim_log.read(log_size - self._offset)
+    self._offset += len(data)
+    lines = (self._partial_line + data).split('\n')
+    self._partial_line = lines.pop()
+    first_match = None
+    for line in lines:
+      match = self._classifier.FeedSimLogLine(line)
+      if match and not first_match:
+        first_match = match
+    return first_match
+
+
+class _ConsolePassthrough(object):
+  """Prints the output lines to console with buffered writes.
+
+  The lines are filtered by the console mode. The printed lines are flushed
+  when the buffered bytes reach the threshold or the last flush is older than
+  the interval, instead of flushing for every line.
+  """
+
+  def __init__(self, console_mode):
+    self._console_mode = console_mode
+    self._pending_lines = []
+    self._pending_bytes = 0
+    self._last_flush_time = time.time()
+
+  def Write(self, line):
+    """Writes the line to console if the console mode allows it."""
+    if not self._ShouldPrint(line):
+      return
+    self._pending_lines.append(line)
+    self._pending_bytes += len(line)
+    if (self._pending_bytes >= _CONSOLE_FLUSH_BYTES or
+        time.time() - self._last_flush_time >= _CONSOLE_FLUSH_INTERVAL_SEC):
+      self.Flush()
+
+  def Flush(self):
+    """Flushes the pending lines to console."""
+    self._last_flush_time = time.time()
+    if not self._pending_lines:
+      return
+    sys.stdout.write(''.join(self._pending_lines))
+    sys.stdout.flush()
+    self._pending_lines = []
+    self._pending_bytes = 0
+
+  def _ShouldPrint(self, line):
+    if self._console_mode == ios_constants.ConsoleMode.FULL:
+      return True
+    if _CONSOLE_SUMMARY_PATTERN.search(line):
+      return True
+    return (self._console_mode == ios_constants.ConsoleMode.FAILURES_ONLY and
+            bool(_CONSOLE_FAILURE_PATTERN.search(line)))
 
 
 class XcodebuildTestExecutor(object):
   """A class to execute testing command by xcodebuild tool."""
 
   def __init__(self, command, sdk=None, test_type=None, device_id=None,
-               succeeded_signal=None, failed_signal=None):
+               succeeded_signal=None, failed_signal=None, app_bundle_id=None,
+               test_event_callback=None):
     """Initializes the XcodebuildTestExecutor object.
 
     The optional argument sdk, test_type and device_id can provide more
@@ -101,6 +364,10 @@ class XcodebuildTestExecutor(object):
       device_id: string, the id of the device to run test.
       succeeded_signal: string, the signal of command succeeded.
       failed_signal: string, the signal of command failed.
+      app_bundle_id: string, the bundle id of the app under test. It is used to
+          recognize the crash of the app in the simulator's system.log.
+      test_event_callback: function, called with a test_event_parser.TestEvent
+          object at the moment the event is parsed from the output.
     """
     self._command = command
     self._sdk = sdk
@@ -108,19 +375,93 @@ class XcodebuildTestExecutor(object):
     self._device_id = device_id
     self._succeeded_signal = succeeded_signal
     self._failed_signal = failed_signal
+    self._app_bundle_id = app_bundle_id
+    self._test_event_callback = test_event_callback
+    self._hung_phase = None
+    self._hung_test_identifier = None
+    self._crash_match = None
+    self._attempts = 0
 
-  def Execute(self, return_output=True):
+  @property
+  def hung_phase(self):
+    """The WatchdogPhase in which the last execution hung or None."""
+    return self._hung_phase
+
+  @property
+  def hung_test_identifier(self):
+    """The test running when the last execution hung or None.
+
+    The format is Test-Class-Name/Test-Method-Name.
+    """
+    return self._hung_test_identifier
+
+  @property
+  def crash_match(self):
+    """The failure_classifier.SignatureMatch of the crash on simulator or None.
+
+    It is the crash which stopped the last attempt of the last execution before
+    the test started.
+    """
+    return self._crash_match
+
+  @property
+  def crashed_bundle(self):
+    """The bundle id of the crashed app, 'xctest' or None if no crash."""
+    if not self._crash_match:
+      return None
+    return _GetCrashedBundle(self._crash_match)
+
+  def Execute(self, return_output=True, output_file_path=None,
+              test_events_file_path=None):
     """Executes the xcodebuild test command.
 
+    Only the last bytes of the output are kept in memory. To get the complete
+    output, provide output_file_path.
+
     Args:
       return_output: bool, whether save output in the execution result.
+      output_file_path: string, the path of the file to save the complete
+          output of the last attempt. The byte ranges of each test in the file
+          are indexed. See module test_log_index.
+      test_events_file_path: string, the path of the JSON lines file to save
+          the test events. See module test_event_parser.
 
     Returns:
       a tuple of two fields:
         exit_code: A value of type runner_exit_codes.EXITCODE.
-        output: the output of xcodebuild test command or None if return_output
-            is False.
+        output: an output_capture.OutputCapture object of xcodebuild test
+            command or None if return_output is False. Use its Open() method to
+            read the output.
     """
+    test_events_writer = None
+    if test_events_file_path:
+      test_events_writer = test_event_parser.TestEventWriter(
+          test_events_file_path)
+    try:
+      exit_code, output = self._Execute(
+          return_output, output_file_path, test_events_writer)
+    finally:
+      if test_events_writer:
+        test_events_writer.Close()
+    controller = concurrency_controller.GetActiveController()
+    if controller and self._sdk == ios_constants.SDK.IPHONESIMULATOR:
+      controller.RecordOutcome(exit_code)
+    metrics_util.IncrementCounter(
+        'test_executions_total', sdk=self._sdk, test_type=self._test_type,
+        exit_code=exit_code)
+    metrics_util.ObserveHistogram(
+        'test_execution_attempts', self._attempts, sdk=self._sdk,
+        test_type=self._test_type)
+    return exit_code, output
+
+  def _Execute(self, return_output, output_file_path, test_events_writer):
+    """Executes the xcodebuild test command with retries."""
+    def _HandleTestEvent(event):
+      if test_events_writer:
+        test_events_writer.Write(event)
+      if self._test_event_callback:
+        self._test_event_callback(event)
+
     run_env = dict(os.environ)
     run_env['NSUnbufferedIO'] = 'YES'
     max_attempts = 1
@@ -134,164 +475,398 @@ class XcodebuildTestExecutor(object):
     test_started = False
     test_succeeded = False
     test_failed = False
+    output = None
+    total_start_time = None
+    self._hung_phase = None
+    self._hung_test_identifier = None
+    self._crash_match = None
+    self._attempts = 0
 
     for i in range(max_attempts):
-      process = subprocess.Popen(
-          self._command, env=run_env, stdout=subprocess.PIPE,
-          stderr=subprocess.STDOUT)
-      check_xcodebuild_stuck = CheckXcodebuildStuckThread(process)
-      check_xcodebuild_stuck.start()
-      output = io.BytesIO()
-      for stdout_line in iter(process.stdout.readline, ''):
-        if not test_started:
-          # Terminates the CheckXcodebuildStuckThread when test has started
-          # or XCTRunner.app has started.
-          # But XCTRunner.app start does not mean test start.
-          if ios_constants.TEST_STARTED_SIGNAL in stdout_line:
-            test_started = True
-            check_xcodebuild_stuck.Terminate()
-          if (self._test_type == ios_constants.TestType.XCUITEST and
-              ios_constants.XCTRUNNER_STARTED_SIGNAL in stdout_line):
-            check_xcodebuild_stuck.Terminate()
-        else:
-          if self._succeeded_signal and self._succeeded_signal in stdout_line:
-            test_succeeded = True
-          if self._failed_signal and self._failed_signal in stdout_line:
-            test_failed = True
-
-        sys.stdout.write(stdout_line)
-        sys.stdout.flush()
-        # If return_output is false, the output is only used for checking error
-        # cause and deleting cached files (_DeleteTestCacheFileDirs method).
-        if return_output or not test_started:
-          output.write(stdout_line)
-
+      self._attempts = i + 1
+      # The simulator is booted by xcodebuild before the test starts. Limits
+      # the concurrent simulator boots in the host until the test starts.
+      sim_boot_semaphore = None
+      if self._sdk == ios_constants.SDK.IPHONESIMULATOR:
+        sim_boot_semaphore = host_semaphore.HostSemaphore(
+            host_semaphore.SIM_BOOT)
+        with trace_util.Span('wait_sim_boot_slot'):
+          sim_boot_semaphore.Acquire()
+      output = None
+      log_index_builder = None
+      test_cache_file_dir_collector = None
+      attempt_span = None
+      process = None
+      watchdog = None
+      sim_log_crash_watcher = None
+      output_read = False
       try:
+        attempt_start_time = time.time()
+        if total_start_time is None:
+          total_start_time = attempt_start_time
+        classifier = failure_classifier.FailureClassifier(
+            test_type=self._test_type, sdk=self._sdk,
+            app_bundle_id=self._app_bundle_id,
+            callback=failure_classifier.LogSignatureMatch)
+        # Only the log lines written by this attempt are watched.
+        sim_log_start_offset = _GetFileSize(sim_log_path) if sim_log_path else 0
+        attempt_span = trace_util.StartSpan('xcodebuild_test', attempt=i)
+        # The startup phase ends when the test starts, then the test execution
+        # phase begins.
+        phase_span = trace_util.StartSpan('xcodebuild_startup')
+        process = subprocess_ledger.Popen(
+            self._command, env=run_env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        watchdog = PhaseWatchdogThread(
+            process,
+            startup_timeout_sec=_watchdog_budgets_sec[WatchdogPhase.STARTUP],
+            inactivity_timeout_sec=_watchdog_budgets_sec[
+                WatchdogPhase.INACTIVITY],
+            total_timeout_sec=_watchdog_budgets_sec[WatchdogPhase.TOTAL],
+            start_time=total_start_time)
+        watchdog.start()
+        if sim_log_path:
+          sim_log_crash_watcher = SimLogCrashWatcherThread(
+              process, sim_log_path, sim_log_start_offset, classifier)
+          sim_log_crash_watcher.start()
+        if return_output:
+          output = output_capture.OutputCapture(
+              spool_file_path=output_file_path)
+        elif output_file_path:
+          output = output_capture.OutputCapture(
+              max_buffer_bytes=0, spool_file_path=output_file_path)
+        console = _ConsolePassthrough(_console_mode)
+        event_parser = test_event_parser.TestEventParser(
+            callback=_HandleTestEvent)
+        test_cache_file_dir_collector = _TestCacheFileDirCollector(
+            self._sdk, self._test_type)
+        # Indexes the byte ranges of each test in the saved output.
+        if output_file_path:
+          log_index_builder = test_log_index.TestLogIndexBuilder()
+
+        def _OnOutputIdle():
+          console.Flush()
+          # The orphan child processes of the killed xcodebuild may still hold
+          # the pipe open.
+          killed = watchdog.expired_phase is not None or (
+              sim_log_crash_watcher is not None and
+              sim_log_crash_watcher.is_xcodebuild_aborted)
+          return killed and process.poll() is not None
+
+        output_bytes = 0
+        for stdout_line in _IterOutputLines(process.stdout, _OnOutputIdle):
+          watchdog.NotifyOutput()
+          output_bytes += len(stdout_line)
+          if not test_started:
+            # The failure signatures only matter when the test does not start.
+            classifier.FeedOutputLine(stdout_line)
+            # Ends the startup phase of the watchdog when test has started or
+            # XCTRunner.app has started.
+            # But XCTRunner.app start does not mean test start.
+            if ios_constants.TEST_STARTED_SIGNAL in stdout_line:
+              test_started = True
+              watchdog.NotifyTestStarted()
+              phase_span.End()
+              phase_span = trace_util.StartSpan('test_execution')
+              if sim_log_crash_watcher:
+                sim_log_crash_watcher.Terminate()
+              if sim_boot_semaphore:
+                sim_boot_semaphore.Release()
+                controller = concurrency_controller.GetActiveController()
+                if controller:
+                  controller.RecordTestStartup(time.time() - attempt_start_time)
+              metrics_util.ObserveHistogram(
+                  'test_startup_seconds', time.time() - attempt_start_time,
+                  sdk=self._sdk, test_type=self._test_type)
+            if (self._test_type == ios_constants.TestType.XCUITEST and
+                ios_constants.XCTRUNNER_STARTED_SIGNAL in stdout_line):
+              watchdog.NotifyTestStarted()
+              if sim_boot_semaphore:
+                sim_boot_semaphore.Release()
+          else:
+            if self._succeeded_signal and self._succeeded_signal in stdout_line:
+              test_succeeded = True
+            if self._failed_signal and self._failed_signal in stdout_line:
+              test_failed = True
+
+          event = event_parser.Feed(stdout_line)
+          test_cache_file_dir_collector.Feed(stdout_line)
+          console.Write(stdout_line)
+          if output:
+            line_start_offset = output.total_bytes
+            output.Write(stdout_line)
+            if event and log_index_builder:
+              log_index_builder.HandleEvent(event, line_start_offset,
+                                            output.total_bytes)
+        output_read = True
+
+        console.Flush()
+        watchdog.Terminate()
+        phase_span.End()
+        process.AddOutputBytes(output_bytes)
+        if output_file_path and _console_mode != ios_constants.ConsoleMode.FULL:
+          logging.info('The complete output of xcodebuild is saved in %s.',
+                       output_file_path)
+
+        if sim_log_crash_watcher:
+          # Waits for the watcher to feed the rest of the log lines.
+          sim_log_crash_watcher.Terminate()
+          sim_log_crash_watcher.join()
+        if watchdog.expired_phase:
+          self._hung_phase = watchdog.expired_phase
+          self._hung_test_identifier = event_parser.current_test_identifier
         if test_started:
+          if self._hung_phase:
+            error_message = ('xcodebuild command hung in the %s phase over '
+                             '%ss' % (self._hung_phase,
+                                      watchdog.expired_budget_sec))
+            if self._hung_test_identifier:
+              error_message += ' when running %s' % self._hung_test_identifier
+            logging.error(error_message)
+            if output:
+              output.Write(error_message + '\n')
           if test_succeeded:
             exit_code = runner_exit_codes.EXITCODE.SUCCEEDED
           elif test_failed:
             exit_code = runner_exit_codes.EXITCODE.FAILED
           else:
             exit_code = runner_exit_codes.EXITCODE.ERROR
-          return exit_code, output.getvalue() if return_output else None
+          return exit_code, output if return_output else None
+
+        if self._hung_phase:
+          return self._GetResultForXcodebuildStuck(
+              output, return_output, watchdog.expired_budget_sec)
 
-        check_xcodebuild_stuck.Terminate()
-        if check_xcodebuild_stuck.is_xcodebuild_stuck:
-          return self._GetResultForXcodebuildStuck(output, return_output)
+        self._crash_match = None
+        if sim_log_crash_watcher and sim_log_crash_watcher.crash_match:
+          self._crash_match = sim_log_crash_watcher.crash_match
+          self._ReportCrashOnSim(
+              output, sim_log_crash_watcher.is_xcodebuild_aborted)
 
         if self._sdk == ios_constants.SDK.IPHONESIMULATOR:
-          output_str = output.getvalue()
-          if self._NeedRecreateSim(output_str):
+          classification = classifier.classification
+          if classification == failure_classifier.Classification.RECREATE_SIM:
             return (runner_exit_codes.EXITCODE.NEED_RECREATE_SIM,
-                    output_str if return_output else None)
-
+                    output if return_output else None)
           # The following error can be fixed by relaunching the test again.
-          try:
-            if sim_log_path and os.path.exists(sim_log_path):
-              tail_sim_log = _ReadFileTailInShell(
-                  sim_log_path, _TAIL_SIM_LOG_LINE)
-              if (self._test_type == ios_constants.TestType.LOGIC_TEST and
-                  simulator_util.IsXctestFailedToLaunchOnSim(tail_sim_log) or
-                  self._test_type != ios_constants.TestType.LOGIC_TEST and
-                  simulator_util.IsAppFailedToLaunchOnSim(tail_sim_log)):
-                raise ios_errors.SimError('')
-            if _PROCESS_EXISTED_OR_CRASHED_ERROR in output_str:
-              raise ios_errors.SimError('')
-            if ios_constants.CORESIMULATOR_INTERRUPTED_ERROR in output_str:
+          if (classification == failure_classifier.Classification.RETRYABLE and
+              i < max_attempts - 1):
+            if 'coresimulator_interrupted' in classifier.matched_signatures:
               # Sleep random[0,2] seconds to avoid race condition. It is known
               # issue that CoreSimulatorService connection will interrupte if
               # two simulators booting at the same time.
               time.sleep(random.uniform(0, 2))
-              raise ios_errors.SimError('')
-          except ios_errors.SimError:
-            if i < max_attempts - 1:
-              logging.warning(
-                  'Failed to launch test on simulator. Will relaunch again.')
-              # Triggers the retry.
-              continue
-            else:
-              return (runner_exit_codes.EXITCODE.TEST_NOT_START,
-                      output_str if return_output else None)
-
+            logging.warning(
+                'Failed to launch test on simulator. Will relaunch again.')
+            metrics_util.IncrementCounter(
+                'test_launch_retries_total', sdk=self._sdk,
+                test_type=self._test_type)
+            # Triggers the retry.
+            continue
+
+        if (self._sdk == ios_constants.SDK.IPHONEOS and
+            classifier.classification ==
+            failure_classifier.Classification.REBOOT_DEVICE):
+          return (runner_exit_codes.EXITCODE.NEED_REBOOT_DEVICE,
+                  output if return_output else None)
+        if self._crash_match:
+          return (runner_exit_codes.EXITCODE.CRASHED_ON_SIM,
+                  output if return_output else None)
         return (runner_exit_codes.EXITCODE.TEST_NOT_START,
-                output_str if return_output else None)
+                output if return_output else None)
       finally:
-        _DeleteTestCacheFileDirs(output.getvalue(), self._sdk, self._test_type)
+        if watchdog:
+          watchdog.Terminate()
+          watchdog.join()
+        if sim_log_crash_watcher:
+          sim_log_crash_watcher.Terminate()
+        if process and not output_read and process.poll() is None:
+          # The output is not read any more, e.g., writing the output failed,
+          # so the process would be left running without supervision.
+          logging.warning('Killing the xcodebuild command whose output is not '
+                          'read any more.')
+          try:
+            process.kill()
+          except OSError:
+            # The process has exited.
+            pass
+          process.wait()
+        if sim_boot_semaphore:
+          sim_boot_semaphore.Release()
+        if attempt_span:
+          attempt_span.End()
+        if output:
+          output.Close()
+        if log_index_builder:
+          log_index_builder.Write(
+              test_log_index.GetIndexFilePath(output_file_path),
+              output.total_bytes)
+        if test_cache_file_dir_collector:
+          test_cache_file_dir_collector.ReleaseTestCacheFileDirs()
+
+  def _ReportCrashOnSim(self, output, is_xcodebuild_aborted):
+    """Reports the crash on simulator in the logs and the output."""
+    error_message = '%s crashed on simulator before the test started' % (
+        _GetCrashedBundle(self._crash_match))
+    if is_xcodebuild_aborted:
+      error_message += ', so the xcodebuild command was killed'
+    error_message += ' (signature %s): %s' % (self._crash_match.name,
+                                              self._crash_match.line.strip())
+    logging.error(error_message)
+    if output:
+      output.Write(error_message + '\n')
+    metrics_util.IncrementCounter(
+        'test_crashes_on_sim_total', signature=self._crash_match.name,
+        aborted=str(is_xcodebuild_aborted).lower(), test_type=self._test_type)
 
-  def _GetResultForXcodebuildStuck(self, output, return_output):
+  def _GetResultForXcodebuildStuck(self, output, return_output, timeout_sec):
     """Gets the execution result for the xcodebuild stuck case."""
     error_message = ('xcodebuild command can not launch test on '
-                     'device/simulator in %ss.'
-                     % _XCODEBUILD_TEST_STARTUP_TIMEOUT_SEC)
+                     'device/simulator in %ss.' % timeout_sec)
     logging.error(error_message)
-    output.write(error_message)
-    output_str = output.getvalue()
+    if output:
+      output.Write(error_message)
     if self._sdk == ios_constants.SDK.IPHONEOS:
       return (runner_exit_codes.EXITCODE.NEED_REBOOT_DEVICE,
-              output_str if return_output else None)
+              output if return_output else None)
     return (runner_exit_codes.EXITCODE.TEST_NOT_START,
-            output_str if return_output else None)
+            output if return_output else None)
 
-  def _NeedRecreateSim(self, output_str):
-    """Checks if need recreate a new simulator."""
-    if (self._test_type == ios_constants.TestType.XCUITEST and
-        _BACKGROUND_TEST_RUNNER_ERROR in output_str):
-      return True
-    if re.search(_APP_UNKNOWN_TO_FRONTEND_PATTERN, output_str):
-      return True
-    if _REQUEST_DENIED_ERROR in output_str:
-      return True
-    if _INIT_SIM_SERVICE_ERROR in output_str:
-      return True
-    return False
 
+def SetWatchdogBudget(phase, budget_sec):
+  """Sets the budget of the phase watchdog in this process.
+
+  Args:
+    phase: WatchdogPhase, the phase of the budget.
+    budget_sec: float, the budget in seconds. 0 means unlimited.
+  """
+  _watchdog_budgets_sec[phase] = budget_sec
 
-def _DeleteTestCacheFileDirs(xcodebuild_test_output, sdk, test_type):
-  """Deletes the cache files of the test session according to arguments."""
-  if sdk == ios_constants.SDK.IPHONEOS:
-    max_cache_dir_num = 1
-    if test_type == ios_constants.TestType.XCUITEST:
-      # Because XCUITest will install two apps (app under test and
-      # XCTRunner.app) on the device.
-      max_cache_dir_num = 2
-    test_cache_file_dirs = _FetchTestCacheFileDirs(xcodebuild_test_output,
-                                                   max_cache_dir_num)
-    for cache_dir in test_cache_file_dirs:
-      if os.path.exists(cache_dir):
-        logging.info('Removing cache files directory: %s', cache_dir)
-        shutil.rmtree(cache_dir)
 
+def GetWatchdogBudget(phase):
+  """Gets the budget in seconds of the phase watchdog. 0 means unlimited."""
+  return _watchdog_budgets_sec[phase]
 
-def _FetchTestCacheFileDirs(xcodebuild_test_output, max_dir_num=1):
-  """Fetches the cache file directories of this test session.
 
-  When using `xcodebuild` to run test on iOS real device, it will generate some
-  cache files under
-  DARWIN_USER_CACHE_DIR/com.apple.DeveloperTools/All/Xcode/EmbeddedAppDeltas.
+def SetConsoleMode(console_mode):
+  """Sets the mode of printing xcodebuild output to console in this process.
 
   Args:
-    xcodebuild_test_output: string, the `xcodebuild test` output of this test
-        session.
-    max_dir_num: int, the max number of test cache files potentially.
+    console_mode: ios_constants.ConsoleMode, the console mode.
 
-  Returns:
-    an array of this test's EmbeddedAppDeltas directories.
+  Raises:
+    ios_errors.IllegalArgumentError: when the console mode is not supported.
   """
-  xcode_cache_dir = xcode_info_util.GetXcodeEmbeddedAppDeltasDir()
-  pattern = re.compile('(%s/[a-z0-9]+)/' % re.escape(xcode_cache_dir))
-  start_pos = 0
-  cache_file_dirs = set()
-  while (start_pos < len(xcodebuild_test_output) and
-         len(cache_file_dirs) < max_dir_num):
-    match = pattern.search(xcodebuild_test_output, start_pos)
-    if not match:
+  if console_mode not in ios_constants.SUPPORTED_CONSOLE_MODES:
+    raise ios_errors.IllegalArgumentError(
+        'The console mode %s is not supported. Supported console modes are %s.'
+        % (console_mode, ios_constants.SUPPORTED_CONSOLE_MODES))
+  global _console_mode
+  _console_mode = console_mode
+
+
+def _IterOutputLines(pipe, idle_callback):
+  """Iterates the lines of the pipe by reading large chunks.
+
+  Args:
+    pipe: file, the pipe to read.
+    idle_callback: function, called when no data arrives in the console flush
+        interval. If it returns True, the iteration stops even though the pipe
+        is not closed.
+
+  Yields:
+    string, a line of the output with its line break. The last line may not
+    have a line break.
+  """
+  fd = pipe.fileno()
+  partial_line = ''
+  while True:
+    readable_fds, _, _ = select.select(
+        [fd], [], [], _CONSOLE_FLUSH_INTERVAL_SEC)
+    if not readable_fds:
+      if idle_callback():
+        break
+      continue
+    data = os.read(fd, _OUTPUT_READ_CHUNK_BYTES)
+    if not data:
       break
-    cache_file_dirs.add(match.group(1))
-    start_pos = match.end(1)
-  return cache_file_dirs
+    data = partial_line + data
+    end = data.rfind('\n') + 1
+    partial_line = data[end:]
+    if not end:
+      continue
+    for line in data[:end - 1].split('\n'):
+      yield line + '\n'
+  if partial_line:
+    yield partial_line
+
 
+def _GetCrashedBundle(crash_match):
+  """Gets the bundle id of the crashed app or 'xctest' from the crash match."""
+  match = _CRASHED_APP_BUNDLE_ID_PATTERN.search(crash_match.line)
+  if match:
+    return match.group(1)
+  return _XCTEST_BUNDLE
 
-def _ReadFileTailInShell(file_path, line):
-  """Tails the file in the last several lines."""
-  return subprocess.check_output(['tail', '-%d' % line, file_path])
+
+class _TestCacheFileDirCollector(object):
+  """Collects the cache file directories of the test session line by line.
+
+  When using `xcodebuild` to run test on iOS real device, it will generate some
+  cache files under
+  DARWIN_USER_CACHE_DIR/com.apple.DeveloperTools/All/Xcode/EmbeddedAppDeltas.
+  The directories are found in the `xcodebuild test` output and are kept by
+  app_deltas_cache for the incremental installs of the next tests.
+  """
+
+  def __init__(self, sdk, test_type):
+    self._pattern = None
+    self._max_dir_num = 0
+    self._cache_file_dirs = set()
+    if sdk == ios_constants.SDK.IPHONEOS:
+      self._max_dir_num = 1
+      if test_type == ios_constants.TestType.XCUITEST:
+        # Because XCUITest will install two apps (app under test and
+        # XCTRunner.app) on the device.
+        self._max_dir_num = 2
+      xcode_cache_dir = xcode_info_util.GetXcodeEmbeddedAppDeltasDir()
+      self._pattern = re.compile('(%s/[a-z0-9]+)/' % re.escape(xcode_cache_dir))
+
+  @property
+  def cache_file_dirs(self):
+    """The set of this test's EmbeddedAppDeltas directories."""
+    return set(self._cache_file_dirs)
+
+  def Feed(self, line):
+    """Feeds a line of the `xcodebuild test` output."""
+    if not self._pattern or len(self._cache_file_dirs) >= self._max_dir_num:
+      return
+    for match in self._pattern.finditer(line):
+      self._cache_file_dirs.add(match.group(1))
+      if len(self._cache_file_dirs) >= self._max_dir_num:
+        return
+
+  def ReleaseTestCacheFileDirs(self):
+    """Releases the collected cache file directories to the LRU cache.
+
+    The cache is evicted in the calling thread, because the test runner may
+    exit right after the test and kill a background eviction halfway. The
+    errors of the cache are logged instead of being raised, so they never mask
+    the test result.
+    """
+    if not self._cache_file_dirs:
+      return
+    try:
+      app_deltas_cache.EmbeddedAppDeltasCache().Release(
+          list(self._cache_file_dirs), background=False)
+    except (IOError, OSError) as e:
+      logging.warning('Failed to release the EmbeddedAppDeltas directories '
+                      '%s: %s', sorted(self._cache_file_dirs), e)
+
+
+def _GetFileSize(file_path):
+  """Gets the size of the file or 0 if the file does not exist."""
+  try:
+    return os.path.getsize(file_path)
+  except OSError:
+    return 0
@@ -14,15 +14,23 @@
 
 """The module to run XCTEST based tests."""
 
+import json
 import logging
+from multiprocessing import pool as multiprocessing_pool
 import os
 import shutil
-import subprocess
 import tempfile
+import time
 
+from xctestrunner.shared import bundle_sync
 from xctestrunner.shared import bundle_util
+from xctestrunner.shared import host_semaphore
 from xctestrunner.shared import ios_constants
 from xctestrunner.shared import ios_errors
+from xctestrunner.shared import metrics_util
+from xctestrunner.shared import staging_util
+from xctestrunner.shared import subprocess_ledger
+from xctestrunner.shared import trace_util
 from xctestrunner.shared import xcode_info_util
 from xctestrunner.test_runner import dummy_project
 from xctestrunner.test_runner import logic_test_util
@@ -31,10 +39,19 @@ from xctestrunner.test_runner import test_summaries_util
 from xctestrunner.test_runner import xctestrun
 
 
+# The file of the change summary of the bundles synced into the persistent work
+# directory, e.g., for caching the app installs.
+BUNDLE_CHANGES_FILE_NAME = 'bundle_changes.json'
+_SYNCED_BUNDLES_DIR_NAME = 'synced_bundles'
+_APP_UNDER_TEST_ROLE = 'app_under_test'
+_TEST_BUNDLE_ROLE = 'test_bundle'
+
+
 class XctestSession(object):
   """The class that runs XCTEST based tests."""
 
-  def __init__(self, sdk, work_dir=None, output_dir=None):
+  def __init__(self, sdk, work_dir=None, output_dir=None,
+               persistent_work_dir=False):
     """Initializes the XctestSession object.
 
     If work_dir is not provdied, will create a temp direcotry to be work_dir and
@@ -49,14 +66,21 @@ class XctestSession(object):
           communication log between host machine and device;
           2) the screenshots of every test stages (XCUITest). If directory is
           specified, the directory will not be deleted after test ends.'
+      persistent_work_dir: bool, whether work_dir keeps the bundles of the
+          last test run. The bundles are synced into the kept ones
+          incrementally and the change summary is written to
+          BUNDLE_CHANGES_FILE_NAME under work_dir. The other files of the last
+          test run are deleted. It requires work_dir.
     """
     self._sdk = sdk
     self._work_dir = work_dir
     self._delete_work_dir = True
+    self._persistent_work_dir = persistent_work_dir
     self._output_dir = output_dir
     self._delete_output_dir = True
     self._xctestrun_obj = None
     self._dummy_project_obj = None
+    self._test_type = None
     self._prepared = False
     # The following fields are only for Logic Test.
     self._logic_test_bundle = None
@@ -96,16 +120,23 @@ class XctestSession(object):
     Raises:
       ios_errors.IllegalArgumentError:
           1) the app under test/test bundle does not exist;
-          2) the app under test/test bundle's extension is invaild.
+          2) the app under test/test bundle's extension is invaild;
+          3) the persistent work directory is used without work_dir or it
+             contains the app under test/test bundle.
     """
     if not signing_options:
       signing_options = {}
 
+    if self._persistent_work_dir:
+      _CheckPersistentWorkDir(self._work_dir, [app_under_test, test_bundle])
+
     if self._work_dir:
       if not os.path.exists(self._work_dir):
         os.mkdir(self._work_dir)
       self._work_dir = os.path.abspath(self._work_dir)
       self._delete_work_dir = False
+      if self._persistent_work_dir:
+        _CleanPersistentWorkDir(self._work_dir)
     else:
       self._work_dir = tempfile.mkdtemp()
       self._delete_work_dir = True
@@ -130,8 +161,16 @@ class XctestSession(object):
       if not test_bundle:
         raise ios_errors.IllegalArgumentError(
             'Without providing xctestrun file, test bundle is required.')
-      app_under_test_dir, test_bundle_dir = _PrepareBundles(
-          self._work_dir, app_under_test, test_bundle)
+      synced_bundles_dir = None
+      if self._persistent_work_dir:
+        synced_bundles_dir = os.path.join(self._work_dir,
+                                          _SYNCED_BUNDLES_DIR_NAME)
+      with trace_util.Span('prepare_bundles'):
+        app_under_test_dir, test_bundle_dir = _PrepareBundles(
+            self._work_dir, app_under_test, test_bundle,
+            mutable_app_under_test=(
+                self._sdk == ios_constants.SDK.IPHONEOS),
+            synced_bundles_dir=synced_bundles_dir)
       test_type = _FinalizeTestType(
           test_bundle_dir, self._sdk, app_under_test_dir=app_under_test_dir,
           original_test_type=test_type)
@@ -163,6 +202,7 @@ class XctestSession(object):
         raise ios_errors.IllegalArgumentError(
             'The test type %s is not supported. Supported test types are %s'
             % (test_type, ios_constants.SUPPORTED_TEST_TYPES))
+    self._test_type = test_type
     self._prepared = True
 
   def SetLaunchOptions(self, launch_options):
@@ -183,6 +223,7 @@ class XctestSession(object):
       self._xctestrun_obj.SetTestArgs(launch_options.get('args'))
       self._xctestrun_obj.SetTestsToRun(launch_options.get('tests_to_run'))
       self._xctestrun_obj.SetSkipTests(launch_options.get('skip_tests'))
+      self._xctestrun_obj.SetMaxResumes(launch_options.get('max_resumes'))
       self._xctestrun_obj.SetAppUnderTestEnvVars(
           launch_options.get('app_under_test_env_vars'))
       self._xctestrun_obj.SetAppUnderTestArgs(
@@ -222,17 +263,33 @@ class XctestSession(object):
           'The session has not been prepared. Please call '
           'XctestSession.Prepare first.')
 
+    with host_semaphore.HostSemaphore(host_semaphore.TEST_SESSION):
+      start_time = time.time()
+      with trace_util.Span('run_test', device_id=device_id, sdk=self._sdk,
+                           test_type=self._test_type):
+        exit_code = self._RunTest(device_id)
+    metrics_util.IncrementCounter(
+        'test_sessions_total', sdk=self._sdk, test_type=self._test_type,
+        exit_code=exit_code)
+    metrics_util.ObserveHistogram(
+        'test_session_seconds', time.time() - start_time, sdk=self._sdk,
+        test_type=self._test_type)
+    return exit_code
+
+  def _RunTest(self, device_id):
+    """Runs test on the target device in the acquired test session slot."""
     if self._xctestrun_obj:
       exit_code = self._xctestrun_obj.Run(
           device_id, self._sdk, self._output_dir)
       for test_summaries_path in test_summaries_util.GetTestSummariesPaths(
           self._output_dir):
         try:
-          test_summaries_util.ParseTestSummaries(
-              test_summaries_path,
-              os.path.join(self._output_dir, 'Logs/Test/Attachments'),
-              True if self._disable_uitest_auto_screenshots else
-              exit_code == runner_exit_codes.EXITCODE.SUCCEEDED)
+          with trace_util.Span('parse_test_summaries'):
+            test_summaries_util.ParseTestSummaries(
+                test_summaries_path,
+                os.path.join(self._output_dir, 'Logs/Test/Attachments'),
+                True if self._disable_uitest_auto_screenshots else
+                exit_code == runner_exit_codes.EXITCODE.SUCCEEDED)
         except ios_errors.PlistError as e:
           logging.warning('Failed to parse test summaries %s: %s',
                           test_summaries_path, e.message)
@@ -248,10 +305,21 @@ class XctestSession(object):
       raise ios_errors.XcodebuildTestError('Unexpected runtime error.')
 
   def Close(self):
-    """Deletes the temp directories."""
-    if (self._delete_work_dir and self._work_dir and
-        os.path.exists(self._work_dir)):
-      shutil.rmtree(self._work_dir)
+    """Deletes the temp directories.
+
+    If tracing is enabled and the output directory is kept, the trace of the
+    session is saved in it as trace_util.TRACE_FILE_NAME.
+    """
+    with trace_util.Span('teardown'):
+      if (self._delete_work_dir and self._work_dir and
+          os.path.exists(self._work_dir)):
+        shutil.rmtree(self._work_dir)
+    if not self._delete_output_dir and self._output_dir:
+      trace_file_path = os.path.join(self._output_dir,
+                                     trace_util.TRACE_FILE_NAME)
+      if trace_util.WriteChromeTrace(trace_file_path):
+        logging.info('The trace of the test session is saved in %s.',
+                     trace_file_path)
     if (self._delete_output_dir and self._output_dir and
         os.path.exists(self._output_dir)):
       shutil.rmtree(self._output_dir)
@@ -265,12 +333,20 @@ def GetSdk(device_id):
     return ios_constants.SDK.IPHONEOS
 
 
-def _PrepareBundles(working_dir, app_under_test_path, test_bundle_path):
+def _PrepareBundles(working_dir, app_under_test_path, test_bundle_path,
+                    mutable_app_under_test=False, synced_bundles_dir=None):
   """Prepares the bundles in work directory.
 
   If the original bundle is .ipa, the .ipa file will be unzipped under
   working_dir. If the original bundle is .app/.xctest and the bundle file is not
-  in working_dir, the bundle file will be copied to working_dir.
+  in working_dir, the bundle file will be staged to working_dir. See
+  staging_util for the staging strategies. The app under test and the test
+  bundle are prepared concurrently.
+
+  If synced_bundles_dir is provided, the bundles are synced into the copies
+  kept there by the last test run and staged to working_dir from the copies.
+  The change summary of the sync is written to BUNDLE_CHANGES_FILE_NAME under
+  working_dir.
 
   Args:
     working_dir: string, the working directory.
@@ -278,6 +354,11 @@ def _PrepareBundles(working_dir, app_under_test_path, test_bundle_path):
         It can be .ipa or .app. It can be None.
     test_bundle_path: string, the path of the test bundle to be tested. It can
         be .ipa or .xctest.
+    mutable_app_under_test: bool, whether the files of the app under test may
+        be modified in place, e.g., signed by the dummy project build on
+        iphoneos.
+    synced_bundles_dir: string, the directory which keeps the synced copies of
+        the bundles between the test runs.
 
   Returns:
     a tuple with two items:
@@ -289,7 +370,6 @@ def _PrepareBundles(working_dir, app_under_test_path, test_bundle_path):
       exist or its extension is invaild.
   """
   working_dir = os.path.abspath(working_dir)
-  app_under_test_dir = None
   if app_under_test_path:
     if not os.path.exists(app_under_test_path):
       raise ios_errors.IllegalArgumentError(
@@ -299,16 +379,6 @@ def _PrepareBundles(working_dir, app_under_test_path, test_bundle_path):
       raise ios_errors.IllegalArgumentError(
           'The app under test %s should be with .app or .ipa extension.'
           % app_under_test_path)
-    if app_under_test_path.endswith('.ipa'):
-      app_under_test_dir = bundle_util.ExtractApp(
-          app_under_test_path, working_dir)
-    elif not os.path.abspath(app_under_test_path).startswith(working_dir):
-      # Only copies the app under test if it is not in working directory.
-      app_under_test_dir = os.path.join(
-          working_dir, os.path.basename(app_under_test_path))
-      shutil.copytree(app_under_test_path, app_under_test_dir)
-    else:
-      app_under_test_dir = app_under_test_path
 
   if not os.path.exists(test_bundle_path):
     raise ios_errors.IllegalArgumentError(
@@ -319,18 +389,163 @@ def _PrepareBundles(working_dir, app_under_test_path, test_bundle_path):
     raise ios_errors.IllegalArgumentError(
         'The test bundle %s should be with .xctest, .ipa or .zip extension.'
         % test_bundle_path)
-  if test_bundle_path.endswith('.ipa') or test_bundle_path.endswith('.zip'):
-    test_bundle_dir = bundle_util.ExtractTestBundle(
-        test_bundle_path, working_dir)
-  elif not os.path.abspath(test_bundle_path).startswith(working_dir):
-    # Only copies the test bundle if it is not in working directory.
-    test_bundle_dir = os.path.join(working_dir,
-                                   os.path.basename(test_bundle_path))
-    shutil.copytree(test_bundle_path, test_bundle_dir)
+
+  app_under_test_dir = None
+  app_under_test_changes = None
+  if not app_under_test_path:
+    test_bundle_dir, test_bundle_changes = _PrepareTestBundle(
+        working_dir, test_bundle_path, synced_bundles_dir)
   else:
+    # Prepares the app under test and the test bundle concurrently. Most of the
+    # time is spent in decompression and file system calls, which release the
+    # GIL.
+    worker_pool = multiprocessing_pool.ThreadPool(1)
+    try:
+      app_under_test_result = worker_pool.apply_async(
+          _PrepareAppUnderTest,
+          (working_dir, app_under_test_path, mutable_app_under_test,
+           synced_bundles_dir))
+      test_bundle_dir, test_bundle_changes = _PrepareTestBundle(
+          working_dir, test_bundle_path, synced_bundles_dir)
+      app_under_test_dir, app_under_test_changes = app_under_test_result.get()
+    finally:
+      worker_pool.close()
+      worker_pool.join()
+  if synced_bundles_dir:
+    bundle_changes = {_TEST_BUNDLE_ROLE: test_bundle_changes}
+    if app_under_test_changes:
+      bundle_changes[_APP_UNDER_TEST_ROLE] = app_under_test_changes
+    with open(os.path.join(working_dir, BUNDLE_CHANGES_FILE_NAME),
+              'w') as bundle_changes_file:
+      json.dump(bundle_changes, bundle_changes_file, indent=2, sort_keys=True)
+  return app_under_test_dir, test_bundle_dir
+
+
+def _PrepareAppUnderTest(working_dir, app_under_test_path, mutable,
+                         synced_bundles_dir=None):
+  """Prepares the app under test in work directory.
+
+  Args:
+    working_dir: string, the absolute path of the working directory.
+    app_under_test_path: string, the path of the .ipa or .app.
+    mutable: bool, whether the files of the app under test may be modified in
+        place.
+    synced_bundles_dir: string, the directory which keeps the synced copies of
+        the bundles between the test runs.
+
+  Returns:
+    a tuple with two items:
+      a path of app under test directory (.app) under work directory.
+      a dict of the change summary of the sync, or None if it is not synced.
+  """
+  if synced_bundles_dir:
+    app_under_test_dir = app_under_test_path
+    if app_under_test_path.endswith('.ipa'):
+      app_under_test_dir = bundle_util.ExtractApp(
+          app_under_test_path, working_dir)
+    return _SyncBundle(working_dir, app_under_test_dir,
+                       os.path.join(synced_bundles_dir, _APP_UNDER_TEST_ROLE),
+                       mutable=mutable)
+  if app_under_test_path.endswith('.ipa'):
+    return bundle_util.ExtractApp(
+        app_under_test_path, working_dir, mutable=mutable), None
+  if not os.path.abspath(app_under_test_path).startswith(working_dir):
+    # Only stages the app under test if it is not in working directory.
+    app_under_test_dir = os.path.join(
+        working_dir, os.path.basename(app_under_test_path))
+    staging_util.StageTree(app_under_test_path, app_under_test_dir,
+                           mutable=mutable)
+    return app_under_test_dir, None
+  return app_under_test_path, None
+
+
+def _PrepareTestBundle(working_dir, test_bundle_path, synced_bundles_dir=None):
+  """Prepares the test bundle in work directory.
+
+  Args:
+    working_dir: string, the absolute path of the working directory.
+    test_bundle_path: string, the path of the .ipa, .zip or .xctest.
+    synced_bundles_dir: string, the directory which keeps the synced copies of
+        the bundles between the test runs.
+
+  Returns:
+    a tuple with two items:
+      a path of test bundle directory (.xctest) under work directory.
+      a dict of the change summary of the sync, or None if it is not synced.
+  """
+  is_archive = (test_bundle_path.endswith('.ipa') or
+                test_bundle_path.endswith('.zip'))
+  if synced_bundles_dir:
     test_bundle_dir = test_bundle_path
+    if is_archive:
+      test_bundle_dir = bundle_util.ExtractTestBundle(
+          test_bundle_path, working_dir)
+    return _SyncBundle(working_dir, test_bundle_dir,
+                       os.path.join(synced_bundles_dir, _TEST_BUNDLE_ROLE))
+  if is_archive:
+    return bundle_util.ExtractTestBundle(test_bundle_path, working_dir), None
+  if not os.path.abspath(test_bundle_path).startswith(working_dir):
+    # Only stages the test bundle if it is not in working directory.
+    test_bundle_dir = os.path.join(working_dir,
+                                   os.path.basename(test_bundle_path))
+    # The symlinked test bundle is copied into the runner's PlugIns later.
+    staging_util.StageTree(test_bundle_path, test_bundle_dir,
+                           allow_symlink=True)
+    return test_bundle_dir, None
+  return test_bundle_path, None
 
-  return app_under_test_dir, test_bundle_dir
+
+def _SyncBundle(working_dir, bundle_dir, synced_bundle_dir, mutable=False):
+  """Syncs the bundle into its kept copy and stages the copy to work directory.
+
+  Args:
+    working_dir: string, the absolute path of the working directory.
+    bundle_dir: string, the path of the bundle, e.g., the .app or the .xctest.
+    synced_bundle_dir: string, the directory of the kept copy of the bundle.
+    mutable: bool, whether the files of the staged bundle may be modified in
+        place.
+
+  Returns:
+    a tuple with two items:
+      a path of the staged bundle directory under work directory.
+      a dict of the change summary of the sync. See bundle_sync.SyncTree.
+  """
+  bundle_name = os.path.basename(bundle_dir)
+  changes = bundle_sync.SyncTree(bundle_dir, synced_bundle_dir)
+  changes['bundle_name'] = bundle_name
+  logging.info('Synced %s: %d added, %d modified, %d removed and %d unchanged '
+               'files, copied %d bytes.', bundle_name, len(changes['added']),
+               len(changes['modified']), len(changes['removed']),
+               changes['unchanged_count'], changes['copied_bytes'])
+  staged_bundle_dir = os.path.join(working_dir, bundle_name)
+  staging_util.StageTree(synced_bundle_dir, staged_bundle_dir, mutable=mutable)
+  return staged_bundle_dir, changes
+
+
+def _CheckPersistentWorkDir(work_dir, bundle_paths):
+  """Checks the work directory can keep the bundles between the test runs."""
+  if not work_dir:
+    raise ios_errors.IllegalArgumentError(
+        'The persistent work directory requires work_dir.')
+  work_dir = os.path.abspath(work_dir)
+  for bundle_path in bundle_paths:
+    if bundle_path and os.path.abspath(bundle_path).startswith(
+        work_dir + os.sep):
+      raise ios_errors.IllegalArgumentError(
+          'The bundle %s should not be in the persistent work directory %s, '
+          'which is cleaned before the test run.' % (bundle_path, work_dir))
+
+
+def _CleanPersistentWorkDir(work_dir):
+  """Deletes the files of the last test run except the synced bundles."""
+  for name in os.listdir(work_dir):
+    if name == _SYNCED_BUNDLES_DIR_NAME:
+      continue
+    path = os.path.join(work_dir, name)
+    if os.path.isdir(path) and not os.path.islink(path):
+      shutil.rmtree(path)
+    else:
+      os.remove(path)
 
 
 def _FinalizeTestType(
@@ -389,7 +604,7 @@ def _DetectTestType(test_bundle_dir):
   """Detects if the test bundle is XCUITest or XCTest."""
   test_bundle_exec_path = os.path.join(
       test_bundle_dir, os.path.basename(test_bundle_dir).split('.')[0])
-  output = subprocess.check_output(['nm', test_bundle_exec_path])
+  output = subprocess_ledger.CheckOutput(['nm', test_bundle_exec_path])
   if 'XCUIApplication' in output:
     return ios_constants.TestType.XCUITEST
   else:
@@ -15,6 +15,7 @@
 """Helper class for xctestrun file generated by prebuilt bundles."""
 
 import glob
+import hashlib
 import logging
 import os
 import shutil
@@ -23,15 +24,33 @@ import tempfile
 from xctestrunner.shared import bundle_util
 from xctestrunner.shared import ios_constants
 from xctestrunner.shared import ios_errors
+from xctestrunner.shared import metrics_util
 from xctestrunner.shared import plist_util
+from xctestrunner.shared import staging_util
+from xctestrunner.shared import trace_util
 from xctestrunner.shared import xcode_info_util
 from xctestrunner.test_runner import dummy_project
+from xctestrunner.test_runner import runner_exit_codes
+from xctestrunner.test_runner import test_event_parser
 from xctestrunner.test_runner import xcodebuild_test_executor
+from xctestrunner.test_runner import xctestrun_template_cache
 
 
 TESTROOT_RELATIVE_PATH = '__TESTROOT__'
 _SIGNAL_TEST_WITHOUT_BUILDING_SUCCEEDED = '** TEST EXECUTE SUCCEEDED **'
 _SIGNAL_TEST_WITHOUT_BUILDING_FAILED = '** TEST EXECUTE FAILED **'
+# The paths relative to the sdk platform path.
+_XCTRUNNER_TEMPLATE_RELATIVE_PATH = (
+    'Developer/Library/Xcode/Agents/XCTRunner.app')
+_XCTEST_BUNDLE_INJECT_RELATIVE_PATHS = (
+    'Developer/usr/lib/libXCTestBundleInject.dylib',
+    'Developer/Library/PrivateFrameworks/IDEBundleInjection.framework/'
+    'IDEBundleInjection')
+_FRAMEWORKS_RELATIVE_PATHS = ('Developer/Library/Frameworks',
+                              'Developer/Library/PrivateFrameworks')
+_LIBRARIES_RELATIVE_PATHS = ('Developer/usr/lib',)
+
+_xctestrun_synthesis_enabled = False
 
 
 class XctestRun(object):
@@ -57,6 +76,7 @@ class XctestRun(object):
     self._root_key = self._xctestrun_file_plist_obj.GetPlistField(
         None).keys()[0]
     self._test_type = test_type
+    self._max_resumes = 0
 
   def SetTestEnvVars(self, env_vars):
     """Sets the additional environment variables of test's process.
@@ -139,9 +159,25 @@ class XctestRun(object):
       return
     self.SetXctestrunField('SkipTestIdentifiers', skip_tests)
 
+  def SetMaxResumes(self, max_resumes):
+    """Sets the max times of resuming the test after a test case is interrupted.
+
+    When the app crashes or a test case hangs, the test case is marked failed
+    and the tests which have not run are relaunched on the same device.
+
+    Args:
+      max_resumes: int, the max times of resuming the test.
+    """
+    if not max_resumes:
+      return
+    self._max_resumes = max_resumes
+
   def Run(self, device_id, sdk, derived_data_dir):
     """Runs the test with generated xctestrun file in the specific device.
 
+    The test events of all runs are saved in the derived data directory. See
+    xcodebuild_test_executor.TEST_EVENTS_FILE_NAME.
+
     Args:
       device_id: ID of the device.
       sdk: shared.ios_constants.SDK, sdk of the device.
@@ -150,9 +186,68 @@ class XctestRun(object):
     Returns:
       A value of type runner_exit_codes.EXITCODE.
     """
+    progress = test_event_parser.TestProgressTracker()
+    test_events_writer = test_event_parser.TestEventWriter(os.path.join(
+        derived_data_dir, xcodebuild_test_executor.TEST_EVENTS_FILE_NAME))
+
+    def _HandleTestEvent(event):
+      test_events_writer.Write(event)
+      progress.HandleEvent(event)
+
+    resume_count = 0
+    try:
+      xctestrun_file_path = self._xctestrun_file_path
+      while True:
+        output_file_path = os.path.join(
+            derived_data_dir, xcodebuild_test_executor.OUTPUT_FILE_NAME)
+        if resume_count:
+          file_name, file_ext = os.path.splitext(output_file_path)
+          output_file_path = '%s_resume%d%s' % (file_name, resume_count,
+                                                file_ext)
+        exit_code = self._RunXctestrunFile(
+            xctestrun_file_path, device_id, sdk, derived_data_dir,
+            output_file_path, _HandleTestEvent)
+        if resume_count:
+          os.remove(xctestrun_file_path)
+        interrupted_test = progress.MarkRunningTestInterrupted()
+        if not interrupted_test:
+          break
+        test_class, test_method = interrupted_test.split('/', 1)
+        test_events_writer.Write(test_event_parser.TestEvent(
+            test_event_parser.EventType.CASE_FINISHED,
+            test_class=test_class, test_method=test_method,
+            status=test_event_parser.TestStatus.FAILED,
+            message='The test was interrupted by a crash or hang.'))
+        logging.warning('The test %s was interrupted by a crash or hang.',
+                        interrupted_test)
+        if resume_count >= self._max_resumes:
+          break
+        resume_count += 1
+        logging.info('Resuming the test after %s (%d/%d).', interrupted_test,
+                     resume_count, self._max_resumes)
+        xctestrun_file_path = self._CreateResumeXctestrunFile(
+            resume_count, progress.finished_test_identifiers)
+    finally:
+      test_events_writer.Close()
+
+    if not resume_count:
+      return exit_code
+    logging.info('Resumed the test %d times. Interrupted tests: %s',
+                 resume_count, progress.interrupted_test_identifiers)
+    # The resumed run can not succeed or fail by itself. Other exit codes mean
+    # the rest tests could not run.
+    if exit_code in (runner_exit_codes.EXITCODE.SUCCEEDED,
+                     runner_exit_codes.EXITCODE.FAILED):
+      return runner_exit_codes.EXITCODE.FAILED
+    return exit_code
+
+  def _RunXctestrunFile(self, xctestrun_file_path, device_id, sdk,
+                        derived_data_dir, output_file_path,
+                        test_event_callback):
+    """Runs `xcodebuild test-without-building` with the xctestrun file."""
     logging.info('Running test-without-building with device %s', device_id)
     command = ['xcodebuild', 'test-without-building',
-               '-xctestrun', self._xctestrun_file_path,
+               '-xctestrun', xctestrun_file_path,
                '-destination', 'id=%s' % device_id,
                '-derivedDataPath', derived_data_dir]
     exit_code, _ = xcodebuild_test_executor.XcodebuildTestExecutor(
@@ -161,9 +256,57 @@ class XctestRun(object):
         failed_signal=_SIGNAL_TEST_WITHOUT_BUILDING_FAILED,
         sdk=sdk,
         test_type=self.test_type,
-        device_id=device_id).Execute(return_output=False)
+        device_id=device_id,
+        app_bundle_id=self._GetAppUnderTestBundleId(),
+        test_event_callback=test_event_callback).Execute(
+            return_output=False, output_file_path=output_file_path)
     return exit_code
 
+  def _CreateResumeXctestrunFile(self, resume_count, finished_tests):
+    """Creates the xctestrun file which skips the finished tests.
+
+    The file is in the same directory of the original xctestrun file, so the
+    __TESTROOT__ in the file still works.
+
+    Args:
+      resume_count: int, the count of the resume.
+      finished_tests: a list of string, the finished tests. The format of each
+          item is Test-Class-Name/Test-Method-Name.
+
+    Returns:
+      string, the path of the created xctestrun file.
+    """
+    resume_xctestrun_file_path = '%s_resume%d.xctestrun' % (
+        os.path.splitext(self._xctestrun_file_path)[0], resume_count)
+    shutil.copyfile(self._xctestrun_file_path, resume_xctestrun_file_path)
+    skip_tests = list(self.GetXctestrunField('SkipTestIdentifiers') or [])
+    for test in finished_tests:
+      if test not in skip_tests:
+        skip_tests.append(test)
+    XctestRun(resume_xctestrun_file_path, self._test_type).SetSkipTests(
+        skip_tests)
+    return resume_xctestrun_file_path
+
+  def _GetAppUnderTestBundleId(self):
+    """Gets the bundle id of the app under test or None if it is unknown."""
+    if self.test_type == ios_constants.TestType.XCUITEST:
+      app_under_test_path = self.GetXctestrunField('UITargetAppPath')
+    elif self.test_type == ios_constants.TestType.XCTEST:
+      app_under_test_path = self.GetXctestrunField('TestHostPath')
+    else:
+      return None
+    if not app_under_test_path:
+      return None
+    app_under_test_path = app_under_test_path.replace(
+        TESTROOT_RELATIVE_PATH,
+        os.path.dirname(os.path.abspath(self._xctestrun_file_path)))
+    try:
+      return bundle_util.GetBundleId(app_under_test_path)
+    except (ios_errors.PlistError, IOError):
+      logging.warning('Failed to get the bundle id of the app under test %s.',
+                      app_under_test_path)
+      return None
+
   @property
   def test_type(self):
     if not self._test_type:
@@ -237,7 +380,11 @@ class XctestRun(object):
 
 
 class XctestRunFactory(object):
-  """The class to generate xctestrunfile by building dummy project."""
+  """The class to generate xctestrunfile by building dummy project.
+
+  On simulator, the xctestrun file of XCTest and XCUITest can be synthesized
+  directly without building if it is enabled by SetXctestrunSynthesisEnabled.
+  """
 
   def __init__(self, app_under_test_dir, test_bundle_dir,
                sdk=ios_constants.SDK.IPHONESIMULATOR,
@@ -321,12 +468,15 @@ class XctestRunFactory(object):
           self._app_under_test_dir, self._test_root_dir)
     self._test_bundle_dir = _MoveAndReplaceFile(
         self._test_bundle_dir, self._test_root_dir)
-    if self._test_type == ios_constants.TestType.XCUITEST:
-      self._GenerateXctestrunFileForXcuitest()
-    elif self._test_type == ios_constants.TestType.XCTEST:
-      self._GenerateXctestrunFileForXctest()
-    elif self._test_type == ios_constants.TestType.LOGIC_TEST:
-      self._GenerateXctestrunFileForLogicTest()
+    with trace_util.Span('generate_xctestrun', test_type=self._test_type):
+      if self._test_type == ios_constants.TestType.XCUITEST:
+        if not self._SynthesizeXctestrunFile():
+          self._GenerateXctestrunFileForXcuitest()
+      elif self._test_type == ios_constants.TestType.XCTEST:
+        if not self._SynthesizeXctestrunFile():
+          self._GenerateXctestrunFileForXctest()
+      elif self._test_type == ios_constants.TestType.LOGIC_TEST:
+        self._GenerateXctestrunFileForLogicTest()
     # Replace the TESTROOT absolute path with __TESTROOT__ in xctestrun file.
     # Then the xctestrun file is not only used in the local machine, but also
     # other mac machines.
@@ -369,6 +519,56 @@ class XctestRunFactory(object):
     The approach is creating a dummy project. Run 'build-for-testing' with the
     dummy project. Then the xctestrun file and XCTRunner app template will be
     under the build products directory of dummy project's derived data dir.
+    The xctestrun file and XCTRunner app template are cached for the next runs
+    with the same build inputs.
+    """
+    xctrunner_app_dir = self._InstantiateOrBuildDummyProject(
+        self._BuildDummyProjectForXcuitest)
+    if (self._signing_options and
+        self._signing_options.get('xctrunner_app_enable_ui_file_sharing')):
+      try:
+        bundle_util.EnableUIFileSharing(xctrunner_app_dir)
+      except ios_errors.BundleError as e:
+        logging.warning(e.output)
+    # The test bundle under XCTRunner.app/PlugIns is not actual test bundle. It
+    # only contains Info.plist and _CodeSignature. So copy the real test bundle
+    # under XCTRunner.app/PlugIns to replace it.
+    xctrunner_plugins_dir = os.path.join(xctrunner_app_dir, 'PlugIns')
+    if os.path.exists(xctrunner_plugins_dir):
+      shutil.rmtree(xctrunner_plugins_dir)
+    os.mkdir(xctrunner_plugins_dir)
+    # The test bundle should not exist under the new generated XCTRunner.app.
+    if os.path.islink(self._test_bundle_dir):
+      # The test bundle under PlugIns can not be symlink since it will cause
+      # app installation error.
+      new_test_bundle_path = os.path.join(
+          xctrunner_plugins_dir, os.path.basename(self._test_bundle_dir))
+      staging_util.StageTree(self._test_bundle_dir, new_test_bundle_path)
+      self._test_bundle_dir = new_test_bundle_path
+    else:
+      self._test_bundle_dir = _MoveAndReplaceFile(
+          self._test_bundle_dir, xctrunner_plugins_dir)
+
+    self._xctestrun_obj = XctestRun(
+        self._xctestrun_file_path, self._test_type)
+    self._xctestrun_obj.SetXctestrunField('TestHostPath', xctrunner_app_dir)
+    self._xctestrun_obj.SetXctestrunField(
+        'UITargetAppPath', self._app_under_test_dir)
+    self._xctestrun_obj.SetXctestrunField(
+        'TestBundlePath', self._test_bundle_dir)
+    # When running on iphoneos, it is necessary to remove this field.
+    # For iphonesimulator, this field won't effect the test functionality. To
+    # be consistent, remove this field.
+    self._xctestrun_obj.DeleteXctestrunField(
+        'TestingEnvironmentVariables:IDEiPhoneInternalTestBundleName')
+
+  def _BuildDummyProjectForXcuitest(self):
+    """Builds the dummy project for XCUITest.
+
+    The generated xctestrun file is moved to TEST_ROOT/xctestrun.plist.
+
+    Returns:
+      string, the path of the generated XCTRunner app under TEST_ROOT.
     """
     dummyproject_derived_data_dir = os.path.join(self._work_dir,
                                                  'dummyproject_derived_data')
@@ -411,30 +611,6 @@ class XctestRunFactory(object):
     xctrunner_app_dir = os.path.join(
         self._test_root_dir, os.path.basename(generated_xctrunner_app_dirs[0]))
     shutil.move(generated_xctrunner_app_dirs[0], xctrunner_app_dir)
-    if (self._signing_options and
-        self._signing_options.get('xctrunner_app_enable_ui_file_sharing')):
-      try:
-        bundle_util.EnableUIFileSharing(xctrunner_app_dir)
-      except ios_errors.BundleError as e:
-        logging.warning(e.output)
-    # The test bundle under XCTRunner.app/PlugIns is not actual test bundle. It
-    # only contains Info.plist and _CodeSignature. So copy the real test bundle
-    # under XCTRunner.app/PlugIns to replace it.
-    xctrunner_plugins_dir = os.path.join(xctrunner_app_dir, 'PlugIns')
-    if os.path.exists(xctrunner_plugins_dir):
-      shutil.rmtree(xctrunner_plugins_dir)
-    os.mkdir(xctrunner_plugins_dir)
-    # The test bundle should not exist under the new generated XCTRunner.app.
-    if os.path.islink(self._test_bundle_dir):
-      # The test bundle under PlugIns can not be symlink since it will cause
-      # app installation error.
-      new_test_bundle_path = os.path.join(
-          xctrunner_plugins_dir, os.path.basename(self._test_bundle_dir))
-      shutil.copytree(self._test_bundle_dir, new_test_bundle_path)
-      self._test_bundle_dir = new_test_bundle_path
-    else:
-      self._test_bundle_dir = _MoveAndReplaceFile(
-          self._test_bundle_dir, xctrunner_plugins_dir)
 
     generated_xctestrun_file_paths = glob.glob('%s/*.xctestrun' %
                                                derived_data_build_products_dir)
@@ -446,35 +622,17 @@ class XctestRunFactory(object):
                                              'xctestrun.plist')
     shutil.move(generated_xctestrun_file_paths[0],
                 self._xctestrun_file_path)
-
-    self._xctestrun_obj = XctestRun(
-        self._xctestrun_file_path, self._test_type)
-    self._xctestrun_obj.SetXctestrunField('TestHostPath', xctrunner_app_dir)
-    self._xctestrun_obj.SetXctestrunField(
-        'UITargetAppPath', self._app_under_test_dir)
-    self._xctestrun_obj.SetXctestrunField(
-        'TestBundlePath', self._test_bundle_dir)
-    # When running on iphoneos, it is necessary to remove this field.
-    # For iphonesimulator, this field won't effect the test functionality. To
-    # be consistent, remove this field.
-    self._xctestrun_obj.DeleteXctestrunField(
-        'TestingEnvironmentVariables:IDEiPhoneInternalTestBundleName')
+    return xctrunner_app_dir
 
   def _GenerateXctestrunFileForXctest(self):
     """Generates the xctestrun file for XCTest.
 
     The approach is creating a dummy project. Run 'build-for-testing' with the
     dummy project. Then the xctestrun file will be under the build products
-    directory of dummy project's derived data dir.
+    directory of dummy project's derived data dir. The xctestrun file is cached
+    for the next runs with the same build inputs.
     """
-    dummyproject_derived_data_dir = os.path.join(self._work_dir,
-                                                 'dummyproject_derived_data')
-    with dummy_project.DummyProject(
-        self._app_under_test_dir, self._test_bundle_dir, self._sdk,
-        self._test_type, self._work_dir) as dummy_project_instance:
-      # Use TEST_ROOT as dummy project's build products dir.
-      dummy_project_instance.BuildForTesting(
-          self._test_root_dir, dummyproject_derived_data_dir)
+    self._InstantiateOrBuildDummyProject(self._BuildDummyProjectForXctest)
 
     app_under_test_plugins_dir = os.path.join(
         self._app_under_test_dir, 'PlugIns')
@@ -485,12 +643,34 @@ class XctestRunFactory(object):
     # The test bundle under PlugIns can not be symlink since it will cause
     # app installation error.
     if os.path.islink(self._test_bundle_dir):
-      shutil.copytree(self._test_bundle_dir, new_test_bundle_path)
+      staging_util.StageTree(self._test_bundle_dir, new_test_bundle_path)
       self._test_bundle_dir = new_test_bundle_path
     elif new_test_bundle_path != self._test_bundle_dir:
       self._test_bundle_dir = _MoveAndReplaceFile(
           self._test_bundle_dir, app_under_test_plugins_dir)
 
+    self._xctestrun_obj = XctestRun(
+        self._xctestrun_file_path, test_type=self._test_type)
+    self._xctestrun_obj.SetXctestrunField(
+        'TestBundlePath', self._test_bundle_dir)
+
+  def _BuildDummyProjectForXctest(self):
+    """Builds the dummy project for XCTest.
+
+    The generated xctestrun file is moved to TEST_ROOT/xctestrun.plist.
+
+    Returns:
+      None, since there is no XCTRunner app for XCTest.
+    """
+    dummyproject_derived_data_dir = os.path.join(self._work_dir,
+                                                 'dummyproject_derived_data')
+    with dummy_project.DummyProject(
+        self._app_under_test_dir, self._test_bundle_dir, self._sdk,
+        self._test_type, self._work_dir) as dummy_project_instance:
+      # Use TEST_ROOT as dummy project's build products dir.
+      dummy_project_instance.BuildForTesting(
+          self._test_root_dir, dummyproject_derived_data_dir)
+
     # The xctestrun file are under the build products directory of dummy
     # project's derived data dir.
     # DerivedData
@@ -512,10 +692,280 @@ class XctestRunFactory(object):
                                              'xctestrun.plist')
     shutil.move(generated_xctestrun_file_paths[0],
                 self._xctestrun_file_path)
+    return None
+
+  def _InstantiateOrBuildDummyProject(self, build_dummy_project):
+    """Instantiates the products of the dummy project from the cache or builds.
+
+    On a cache miss, the products are stored in the cache before they are
+    modified for this test run.
+
+    Args:
+      build_dummy_project: function, builds the dummy project, sets
+          self._xctestrun_file_path and returns the path of the XCTRunner app
+          or None.
+
+    Returns:
+      string, the path of the XCTRunner app under TEST_ROOT, or None for XCTest.
+    """
+    template_entry = self._GetXctestrunTemplateEntry()
+    if not template_entry:
+      return build_dummy_project()
+    with template_entry:
+      if template_entry.exists:
+        metrics_util.IncrementCounter(
+            'xctestrun_template_cache_total', result='hit', sdk=self._sdk,
+            test_type=self._test_type)
+        with trace_util.Span('instantiate_xctestrun_template',
+                             key=template_entry.key):
+          self._xctestrun_file_path, xctrunner_app_dir = (
+              template_entry.Instantiate(self._test_root_dir))
+        return xctrunner_app_dir
+      metrics_util.IncrementCounter(
+          'xctestrun_template_cache_total', result='miss', sdk=self._sdk,
+          test_type=self._test_type)
+      xctrunner_app_dir = build_dummy_project()
+      template_entry.Store(
+          self._xctestrun_file_path, self._test_root_dir, xctrunner_app_dir)
+      return xctrunner_app_dir
+
+  def _GetXctestrunTemplateEntry(self):
+    """Gets the xctestrun template cache entry of the dummy project build.
+
+    The key contains all inputs of the dummy project build, so the cached
+    products are the same as the built ones.
+
+    Returns:
+      a xctestrun_template_cache.XctestrunTemplateEntry object, or None if the
+      cache is not used.
+    """
+    if not xctestrun_template_cache.IsEnabled():
+      return None
+    # Building the XCTest dummy project on iphoneos signs the app under test,
+    # which is not part of the cached products.
+    if (self._test_type == ios_constants.TestType.XCTEST and
+        self._sdk != ios_constants.SDK.IPHONESIMULATOR):
+      return None
+    key_inputs = {
+        'xcode_developer_path': xcode_info_util.GetXcodeDeveloperPath(),
+        'xcode_version': xcode_info_util.GetXcodeVersionNumber(),
+        'sdk': self._sdk,
+        'sdk_version': xcode_info_util.GetSdkVersion(self._sdk),
+        'test_type': self._test_type,
+        'minimum_os_version': bundle_util.GetMinimumOSVersion(
+            self._app_under_test_dir),
+        'app_under_test_name': os.path.basename(self._app_under_test_dir),
+        'test_bundle_name': os.path.basename(self._test_bundle_dir),
+    }
+    if self._sdk == ios_constants.SDK.IPHONEOS:
+      key_inputs['test_bundle_id'] = bundle_util.GetBundleId(
+          self._test_bundle_dir)
+      key_inputs['development_team'] = bundle_util.GetDevelopmentTeam(
+          self._test_bundle_dir)
+      key_inputs['codesign_identity'] = bundle_util.GetCodesignIdentity(
+          self._app_under_test_dir)
+      key_inputs['embedded_provisioning_profile'] = _GetFileDigest(
+          os.path.join(self._app_under_test_dir, 'embedded.mobileprovision'))
+      xctrunner_app_provisioning_profile = (
+          self._signing_options and
+          self._signing_options.get('xctrunner_app_provisioning_profile'))
+      if xctrunner_app_provisioning_profile:
+        if (xctrunner_app_provisioning_profile.startswith('/') and
+            os.path.exists(xctrunner_app_provisioning_profile)):
+          xctrunner_app_provisioning_profile = _GetFileDigest(
+              xctrunner_app_provisioning_profile)
+        key_inputs['xctrunner_app_provisioning_profile'] = (
+            xctrunner_app_provisioning_profile)
+        key_inputs['test_bundle_codesign_identity'] = (
+            bundle_util.GetCodesignIdentity(self._test_bundle_dir))
+    return xctestrun_template_cache.XctestrunTemplateEntry(key_inputs)
+
+  def _SynthesizeXctestrunFile(self):
+    """Synthesizes the xctestrun file on simulator without building.
+
+    The xctestrun fields are written directly from the bundles and the sdk
+    platform, which takes less than a second instead of running
+    `xcodebuild build-for-testing` with the dummy project.
+
+    Returns:
+      True if the xctestrun file is synthesized. False if synthesis is not
+      enabled or not supported for the test, or it fails, then the dummy
+      project should be built instead.
+    """
+    if (not _xctestrun_synthesis_enabled or
+        self._sdk != ios_constants.SDK.IPHONESIMULATOR):
+      return False
+    test_bundle_dir = self._test_bundle_dir
+    with trace_util.Span('synthesize_xctestrun', test_type=self._test_type):
+      try:
+        if self._test_type == ios_constants.TestType.XCUITEST:
+          self._SynthesizeXctestrunFileForXcuitest()
+        else:
+          self._SynthesizeXctestrunFileForXctest()
+      # Synthesis is only an optimization of the dummy project build, so any
+      # error of it falls back to the build.
+      except Exception as e:  # pylint: disable=broad-except
+        logging.warning('Failed to synthesize the xctestrun file. Will build '
+                        'the dummy project instead: %s', e)
+        self._CleanUpFailedSynthesis(test_bundle_dir)
+        return False
+    return True
+
+  def _CleanUpFailedSynthesis(self, original_test_bundle_dir):
+    """Restores the bundles in TEST_ROOT after the synthesis fails.
+
+    Args:
+      original_test_bundle_dir: string, the path of the test bundle before the
+          synthesis, which may have moved it into PlugIns.
+    """
+    if (self._test_bundle_dir != original_test_bundle_dir and
+        os.path.exists(self._test_bundle_dir)):
+      if os.path.lexists(original_test_bundle_dir):
+        # The original test bundle is a symlink, which was staged.
+        shutil.rmtree(self._test_bundle_dir)
+      else:
+        shutil.move(self._test_bundle_dir, original_test_bundle_dir)
+    self._test_bundle_dir = original_test_bundle_dir
+    xctrunner_app_dir = os.path.join(
+        self._test_root_dir, '%s-Runner.app' % self._test_name)
+    if (self._test_type == ios_constants.TestType.XCUITEST and
+        os.path.exists(xctrunner_app_dir)):
+      shutil.rmtree(xctrunner_app_dir)
+    self._xctestrun_obj = None
+    self._xctestrun_file_path = None
+
+  def _SynthesizeXctestrunFileForXcuitest(self):
+    """Synthesizes the xctestrun file for XCUITest.
+
+    The XCTRunner app is assembled from the XCTRunner.app template of the sdk
+    platform and signed ad-hoc. The test frameworks are loaded from the sdk
+    platform by the DYLD paths.
+
+    Raises:
+      XctestrunError: when the XCTRunner.app template is not found.
+      BundleError: when failed to sign the XCTRunner app. The bundles are not
+          changed in this case.
+    """
+    platform_path = xcode_info_util.GetSdkPlatformPath(self._sdk)
+    xctrunner_template_dir = os.path.join(
+        platform_path, _XCTRUNNER_TEMPLATE_RELATIVE_PATH)
+    if not os.path.isdir(xctrunner_template_dir):
+      raise ios_errors.XctestrunError(
+          'The XCTRunner app template %s does not exist.'
+          % xctrunner_template_dir)
+    xctrunner_bundle_id = '%s.xctrunner' % bundle_util.GetBundleId(
+        self._test_bundle_dir)
+    app_under_test_bundle_id = bundle_util.GetBundleId(
+        self._app_under_test_dir)
+    xctrunner_name = '%s-Runner' % self._test_name
+    xctrunner_app_dir = os.path.join(
+        self._test_root_dir, xctrunner_name + '.app')
+    if os.path.exists(xctrunner_app_dir):
+      shutil.rmtree(xctrunner_app_dir)
+    staging_util.StageTree(
+        xctrunner_template_dir, xctrunner_app_dir, mutable=True)
+    try:
+      info_plist = plist_util.Plist(
+          os.path.join(xctrunner_app_dir, 'Info.plist'))
+      template_executable = info_plist.GetPlistField('CFBundleExecutable')
+      os.rename(os.path.join(xctrunner_app_dir, template_executable),
+                os.path.join(xctrunner_app_dir, xctrunner_name))
+      info_plist.SetPlistField('CFBundleExecutable', xctrunner_name)
+      info_plist.SetPlistField('CFBundleIdentifier', xctrunner_bundle_id)
+      info_plist.SetPlistField('CFBundleName', xctrunner_name)
+      bundle_util.CodesignBundle(xctrunner_app_dir, identity='-')
+    except (ios_errors.BundleError, ios_errors.PlistError, OSError):
+      shutil.rmtree(xctrunner_app_dir)
+      raise
+
+    xctrunner_plugins_dir = os.path.join(xctrunner_app_dir, 'PlugIns')
+    if not os.path.exists(xctrunner_plugins_dir):
+      os.mkdir(xctrunner_plugins_dir)
+    # The test bundle under PlugIns can not be symlink since it will cause
+    # app installation error.
+    if os.path.islink(self._test_bundle_dir):
+      new_test_bundle_path = os.path.join(
+          xctrunner_plugins_dir, os.path.basename(self._test_bundle_dir))
+      staging_util.StageTree(self._test_bundle_dir, new_test_bundle_path)
+      self._test_bundle_dir = new_test_bundle_path
+    else:
+      self._test_bundle_dir = _MoveAndReplaceFile(
+          self._test_bundle_dir, xctrunner_plugins_dir)
+
+    self._WriteSynthesizedXctestrunFile({
+        'TestHostPath': xctrunner_app_dir,
+        'TestHostBundleIdentifier': xctrunner_bundle_id,
+        'TestBundlePath': self._test_bundle_dir,
+        'UITargetAppPath': self._app_under_test_dir,
+        'UITargetAppBundleIdentifier': app_under_test_bundle_id,
+        'IsUITestBundle': True,
+        'IsXCTRunnerHostedTestBundle': True,
+        'TestingEnvironmentVariables': _GetTestFrameworksEnvVars(
+            platform_path),
+    })
+
+  def _SynthesizeXctestrunFileForXctest(self):
+    """Synthesizes the xctestrun file for XCTest.
+
+    The test bundle is injected into the app under test by the bundle
+    injection library of the sdk platform.
+
+    Raises:
+      XctestrunError: when the bundle injection library is not found.
+    """
+    platform_path = xcode_info_util.GetSdkPlatformPath(self._sdk)
+    bundle_inject_paths = [
+        os.path.join(platform_path, relative_path)
+        for relative_path in _XCTEST_BUNDLE_INJECT_RELATIVE_PATHS]
+    bundle_inject_paths = [path for path in bundle_inject_paths
+                           if os.path.exists(path)]
+    if not bundle_inject_paths:
+      raise ios_errors.XctestrunError(
+          'No bundle injection library was found in the sdk platform %s.'
+          % platform_path)
+    app_under_test_bundle_id = bundle_util.GetBundleId(
+        self._app_under_test_dir)
+    app_under_test_executable = plist_util.Plist(
+        os.path.join(self._app_under_test_dir, 'Info.plist')).GetPlistField(
+            'CFBundleExecutable')
+
+    app_under_test_plugins_dir = os.path.join(
+        self._app_under_test_dir, 'PlugIns')
+    if not os.path.exists(app_under_test_plugins_dir):
+      os.mkdir(app_under_test_plugins_dir)
+    new_test_bundle_path = os.path.join(
+        app_under_test_plugins_dir, os.path.basename(self._test_bundle_dir))
+    # The test bundle under PlugIns can not be symlink since it will cause
+    # app installation error.
+    if os.path.islink(self._test_bundle_dir):
+      staging_util.StageTree(self._test_bundle_dir, new_test_bundle_path)
+      self._test_bundle_dir = new_test_bundle_path
+    elif new_test_bundle_path != self._test_bundle_dir:
+      self._test_bundle_dir = _MoveAndReplaceFile(
+          self._test_bundle_dir, app_under_test_plugins_dir)
+
+    testing_env_vars = _GetTestFrameworksEnvVars(platform_path)
+    testing_env_vars['DYLD_INSERT_LIBRARIES'] = bundle_inject_paths[0]
+    testing_env_vars['XCInjectBundleInto'] = os.path.join(
+        self._app_under_test_dir, app_under_test_executable)
+    self._WriteSynthesizedXctestrunFile({
+        'TestHostPath': self._app_under_test_dir,
+        'TestHostBundleIdentifier': app_under_test_bundle_id,
+        'TestBundlePath': self._test_bundle_dir,
+        'IsAppHostedTestBundle': True,
+        'TestingEnvironmentVariables': testing_env_vars,
+    })
+
+  def _WriteSynthesizedXctestrunFile(self, fields):
+    """Writes the xctestrun file with the fields of the test target."""
+    self._xctestrun_file_path = os.path.join(
+        self._test_root_dir, 'xctestrun.plist')
+    if os.path.exists(self._xctestrun_file_path):
+      os.remove(self._xctestrun_file_path)
+    plist_util.Plist(self._xctestrun_file_path).SetPlistField(
+        self._test_name, fields)
     self._xctestrun_obj = XctestRun(
         self._xctestrun_file_path, test_type=self._test_type)
-    self._xctestrun_obj.SetXctestrunField(
-        'TestBundlePath', self._test_bundle_dir)
 
   def _GenerateXctestrunFileForLogicTest(self):
     """Generates the xctestrun file for Logic Test.
@@ -543,6 +993,38 @@ class XctestRunFactory(object):
          'DYLD_LIBRARY_PATH': dyld_framework_path})
 
 
+def SetXctestrunSynthesisEnabled(enabled):
+  """Sets whether the xctestrun file is synthesized on simulator.
+
+  Synthesis is disabled by default until the synthesized XCTRunner app is
+  validated on more Xcode versions.
+
+  Args:
+    enabled: bool, if False, the xctestrun file of XCTest and XCUITest is
+        always generated by building the dummy project.
+  """
+  global _xctestrun_synthesis_enabled
+  _xctestrun_synthesis_enabled = enabled
+
+
+def _GetTestFrameworksEnvVars(platform_path):
+  """Gets the DYLD environment variables to load the test frameworks."""
+  return {
+      'DYLD_FRAMEWORK_PATH': ':'.join(
+          os.path.join(platform_path, relative_path)
+          for relative_path in _FRAMEWORKS_RELATIVE_PATHS),
+      'DYLD_LIBRARY_PATH': ':'.join(
+          os.path.join(platform_path, relative_path)
+          for relative_path in _LIBRARIES_RELATIVE_PATHS),
+  }
+
+
+def _GetFileDigest(file_path):
+  """Gets the SHA-256 digest of the file content."""
+  with open(file_path, 'rb') as f:
+    return hashlib.sha256(f.read()).hexdigest()
+
+
 def _MoveAndReplaceFile(src_file, target_parent_dir):
   """Moves the file under target directory and replace it if it exists."""
   new_file_path = os.path.join(
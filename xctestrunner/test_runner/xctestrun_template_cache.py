@@ -0,0 +1,206 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The host-local cache of the products of the dummy project build.
+
+`xcodebuild build-for-testing` of the dummy project generates the xctestrun
+file and, for XCUITest, the XCTRunner app. The products only depend on the
+Xcode, the sdk, the test type, the deployment target, the bundle names and the
+signing settings, not on the test contents. The cache keeps the products of
+each combination, so only the first test run of the combination builds the
+dummy project.
+
+The absolute path of TEST_ROOT in the cached xctestrun file is replaced with
+__TESTROOT__ and is rewritten when the template is instantiated.
+
+Each entry is protected by a file lock, so the concurrent test runs of the same
+combination wait for the first one to build instead of building it again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from xctestrunner.shared import cache_util
+from xctestrunner.shared import file_lock_util
+from xctestrunner.shared import staging_util
+
+
+_CACHE_DIR_NAME = 'xctestrun_templates'
+_MANIFEST_FILE_NAME = 'manifest.json'
+_XCTESTRUN_FILE_NAME = 'xctestrun.plist'
+_TESTROOT_PLACEHOLDER = '__TESTROOT__'
+# The entries which are not used longer than the retention are deleted when a
+# new entry is stored.
+_RETENTION_SEC = 30 * 24 * 3600
+
+_enabled = True
+
+
+class XctestrunTemplateEntry(object):
+  """An entry of the cache, which is locked in the with statement.
+
+  Example:
+    with XctestrunTemplateEntry(key_inputs) as entry:
+      if entry.exists:
+        xctestrun_file_path, xctrunner_app_dir = entry.Instantiate(test_root)
+      else:
+        ...build the dummy project...
+        entry.Store(xctestrun_file_path, test_root, xctrunner_app_dir)
+  """
+
+  def __init__(self, key_inputs, cache_dir=None):
+    """Initializes the XctestrunTemplateEntry object.
+
+    Args:
+      key_inputs: dict, the inputs of the dummy project build. The values must
+          be JSON serializable.
+      cache_dir: string, the root directory of the cache. By default, it is
+          under the test runner cache directory.
+    """
+    self._key_inputs = key_inputs
+    self._key = hashlib.sha256(
+        json.dumps(key_inputs, sort_keys=True)).hexdigest()
+    self._cache_dir = cache_dir or cache_util.GetCacheDir(_CACHE_DIR_NAME)
+    self._entry_dir = os.path.join(self._cache_dir, self._key)
+    self._lock = file_lock_util.FileLock(self._entry_dir + '.lock')
+
+  def __enter__(self):
+    self._lock.Acquire()
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self._lock.Release()
+
+  @property
+  def key(self):
+    return self._key
+
+  @property
+  def exists(self):
+    """Whether the entry is complete in the cache."""
+    return os.path.exists(os.path.join(self._entry_dir, _MANIFEST_FILE_NAME))
+
+  def Instantiate(self, test_root_dir):
+    """Copies the cached products into the test root directory.
+
+    Args:
+      test_root_dir: string, the TEST_ROOT directory of the test run.
+
+    Returns:
+      a tuple of the path of the xctestrun file under test_root_dir and the
+      path of the XCTRunner app under test_root_dir. The XCTRunner app is None
+      if it is not cached, e.g., for XCTest.
+    """
+    with open(os.path.join(self._entry_dir, _MANIFEST_FILE_NAME)) as manifest:
+      xctrunner_app_name = json.load(manifest).get('xctrunner_app_name')
+    logging.info('Instantiating the xctestrun template %s.', self._key)
+    with open(os.path.join(self._entry_dir, _XCTESTRUN_FILE_NAME)) as template:
+      xctestrun_content = template.read()
+    xctestrun_file_path = os.path.join(test_root_dir, _XCTESTRUN_FILE_NAME)
+    with open(xctestrun_file_path, 'w') as xctestrun_file:
+      xctestrun_file.write(
+          xctestrun_content.replace(_TESTROOT_PLACEHOLDER, test_root_dir))
+    xctrunner_app_dir = None
+    if xctrunner_app_name:
+      xctrunner_app_name = str(xctrunner_app_name)
+      xctrunner_app_dir = os.path.join(test_root_dir, xctrunner_app_name)
+      if os.path.exists(xctrunner_app_dir):
+        shutil.rmtree(xctrunner_app_dir)
+      staging_util.StageTree(os.path.join(self._entry_dir, xctrunner_app_name),
+                             xctrunner_app_dir, mutable=True)
+    # The modification time of the entry is its last use time.
+    os.utime(self._entry_dir, None)
+    return xctestrun_file_path, xctrunner_app_dir
+
+  def Store(self, xctestrun_file_path, test_root_dir, xctrunner_app_dir=None):
+    """Stores the products of the dummy project build in the cache.
+
+    The errors are logged instead of being raised, so the cache never fails
+    the test run.
+
+    Args:
+      xctestrun_file_path: string, the path of the generated xctestrun file.
+      test_root_dir: string, the TEST_ROOT directory of the test run, which is
+          replaced with __TESTROOT__ in the template.
+      xctrunner_app_dir: string, the path of the generated XCTRunner app. It
+          should be stored before it is modified for the test run.
+    """
+    try:
+      temp_entry_dir = tempfile.mkdtemp(dir=self._cache_dir)
+      try:
+        with open(xctestrun_file_path) as xctestrun_file:
+          xctestrun_content = xctestrun_file.read()
+        with open(os.path.join(temp_entry_dir, _XCTESTRUN_FILE_NAME),
+                  'w') as template:
+          template.write(
+              xctestrun_content.replace(test_root_dir, _TESTROOT_PLACEHOLDER))
+        manifest = {'key_inputs': self._key_inputs,
+                    'created_time': time.time()}
+        if xctrunner_app_dir:
+          xctrunner_app_name = os.path.basename(xctrunner_app_dir)
+          # The XCTRunner app is modified for the test run after it is stored.
+          staging_util.StageTree(
+              xctrunner_app_dir,
+              os.path.join(temp_entry_dir, xctrunner_app_name), mutable=True)
+          manifest['xctrunner_app_name'] = xctrunner_app_name
+        with open(os.path.join(temp_entry_dir, _MANIFEST_FILE_NAME),
+                  'w') as manifest_file:
+          json.dump(manifest, manifest_file)
+        if os.path.exists(self._entry_dir):
+          shutil.rmtree(self._entry_dir)
+        os.rename(temp_entry_dir, self._entry_dir)
+      finally:
+        if os.path.exists(temp_entry_dir):
+          shutil.rmtree(temp_entry_dir)
+      logging.info('Stored the xctestrun template %s.', self._key)
+      _DeleteExpiredEntries(self._cache_dir, self._key)
+    except (IOError, OSError) as e:
+      logging.warning('Failed to store the xctestrun template: %s', e)
+
+
+def SetEnabled(enabled):
+  """Sets whether the xctestrun template cache is used.
+
+  Args:
+    enabled: bool, if False, the dummy project is built for every test run.
+  """
+  global _enabled
+  _enabled = enabled
+
+
+def IsEnabled():
+  return _enabled
+
+
+def _DeleteExpiredEntries(cache_dir, current_key):
+  """Deletes the entries which are not used longer than the retention."""
+  expire_time = time.time() - _RETENTION_SEC
+  for name in os.listdir(cache_dir):
+    entry_dir = os.path.join(cache_dir, name)
+    if (name == current_key or not os.path.isdir(entry_dir) or
+        os.path.getmtime(entry_dir) >= expire_time):
+      continue
+    lock = file_lock_util.FileLock(entry_dir + '.lock')
+    # The entry being used by another test run is skipped.
+    if not lock.Acquire(timeout_sec=0):
+      continue
+    try:
+      shutil.rmtree(entry_dir, ignore_errors=True)
+    finally:
+      lock.Release()